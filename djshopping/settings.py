@@ -57,6 +57,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mysite.middleware.MetricsMiddleware',
+    'mysite.middleware.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,13 +66,15 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mysite.middleware.GuestCartMiddleware',
 ]
 
 ROOT_URLCONF = 'djshopping.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates with render timings for /metrics.
+        'BACKEND': 'mysite.metrics.InstrumentedDjangoTemplates',
         'DIRS': [ BASE_DIR / 'templates' ],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -91,12 +95,74 @@ WSGI_APPLICATION = 'djshopping.wsgi.application'
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+    'default': env.db('DATABASE_URL', default=f'sqlite:///{BASE_DIR / "db.sqlite3"}')
+}
+
+# Single-node production profile for SQLite: WAL so readers never wait on
+# the writer, a busy timeout instead of immediate "database is locked"
+# errors, and BEGIN IMMEDIATE for cart write transactions.
+if env.bool('SQLITE_TUNED', default=False) and DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default']['ENGINE'] = 'mysite.backends.sqlite3'
+    # Keep connections (and their PRAGMAs) across requests.
+    DATABASES['default']['CONN_MAX_AGE'] = 60
+    DATABASES['default']['OPTIONS'] = {
+        'timeout': 5,
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'busy_timeout': 5000,
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024,
+            'temp_store': 'MEMORY',
+        },
     }
+
+# Read replicas for catalog traffic (mysite.routers), e.g.
+#   REPLICA_DATABASE_URLS=sqlite:////srv/db/replica1.sqlite3,sqlite:////srv/db/replica2.sqlite3
+#   REPLICA_WEIGHTS=3,1
+# `manage.py sync_sqlite_replicas` refreshes SQLite replica files locally.
+# Visitors read from the primary for REPLICA_PIN_SECONDS after they write.
+
+REPLICA_URLS = env.list('REPLICA_DATABASE_URLS', default=[])
+REPLICA_WEIGHTS = env.list('REPLICA_WEIGHTS', cast=int, default=[1] * len(REPLICA_URLS))
+DATABASE_REPLICAS = {}
+for index, (url, weight) in enumerate(zip(REPLICA_URLS, REPLICA_WEIGHTS), start=1):
+    alias = f'replica{index}'
+    DATABASES[alias] = env.db_url_config(url)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS[alias] = weight
+
+DATABASE_ROUTERS = ['mysite.routers.ReplicaRouter']
+REPLICA_PIN_SECONDS = env.int('REPLICA_PIN_SECONDS', default=5)
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# Use a shared backend (e.g. CACHE_URL=redis://...) when running several workers,
+# otherwise invalidations made by one process are not seen by the others.
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://')
 }
 
+CART_SUMMARY_CACHE_TIMEOUT = 60 * 60
+
+GUEST_CART_COOKIE_AGE = 60 * 60 * 24 * 14
+
+# `manage.py reap_carts` deletes database carts untouched for this long.
+CART_IDLE_DAYS = env.int('CART_IDLE_DAYS', default=30)
+
+PRODUCT_PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Per-process slug -> Item LRU used by cart clicks (mysite.slugs).
+ITEM_SLUG_CACHE_SIZE = env.int('ITEM_SLUG_CACHE_SIZE', default=2048)
+ITEM_SLUG_CACHE_TIMEOUT = 60
+
+# Per-process promo code caches (mysite.coupons). Unknown codes get their own,
+# larger LRU so guessing cannot evict the real coupons.
+COUPON_CACHE_SIZE = env.int('COUPON_CACHE_SIZE', default=512)
+COUPON_NEGATIVE_CACHE_SIZE = env.int('COUPON_NEGATIVE_CACHE_SIZE', default=10000)
+COUPON_CACHE_TIMEOUT = 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -139,9 +205,19 @@ STATICFILES_DIRS = [
 ]
 STATIC_ROOT = 'static_root'
 
+# Hashed names plus precompressed .gz/.br copies, built by collectstatic and
+# served by mysite.assets.serve_static when SERVE_STATIC is on. Off by
+# default because it needs collectstatic to have run before templates render.
+if env.bool('STATIC_MANIFEST', default=False):
+    STATICFILES_STORAGE = 'mysite.assets.CompressedManifestStaticFilesStorage'
+SERVE_STATIC = env.bool('SERVE_STATIC', default=False)
+
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Threads building Item image derivatives off the request path (mysite.images).
+IMAGE_PIPELINE_WORKERS = env.int('IMAGE_PIPELINE_WORKERS', default=2)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -163,6 +239,37 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'mysite': {'handlers': ['console'], 'level': env('LOG_LEVEL', default='INFO')},
+    },
+}
+
 
 STRIPE_PUBLIC_KEY = env('STRIPE_PUBLIC_KEY')
-STRIPE_SECRET_KEY = env('STRIPE_SECRET_KEY')
\ No newline at end of file
+STRIPE_SECRET_KEY = env('STRIPE_SECRET_KEY')
+# The webhook refuses every event while this is empty.
+STRIPE_WEBHOOK_SECRET = env('STRIPE_WEBHOOK_SECRET', default='')
+
+# mysite.gateway.FakeGateway keeps payments in memory for offline work.
+PAYMENT_GATEWAY = env('PAYMENT_GATEWAY', default='mysite.gateway.StripeGateway')
+
+# Metrics served at /metrics to staff users or to scrapers sending
+# "Authorization: Bearer <METRICS_TOKEN>". Point METRICS_DIR at a directory
+# shared by the worker processes of one host to aggregate all of them.
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+METRICS_DIR = env('METRICS_DIR', default='')
+
+# Threads that call Stripe for submitted checkouts (mysite.checkout), and
+# for async views waiting on Stripe (mysite.gateway.run_in_gateway_pool).
+CHECKOUT_WORKERS = env.int('CHECKOUT_WORKERS', default=4)
+
+# How long a checkout may stay pending before `manage.py expire_pending_checkouts`
+# settles it with Stripe: completed if charged, else failed with its stock freed.
+STOCK_HOLD_SECONDS = env.int('STOCK_HOLD_SECONDS', default=30 * 60)
+STRIPE_ASYNC_WORKERS = env.int('STRIPE_ASYNC_WORKERS', default=8)
\ No newline at end of file
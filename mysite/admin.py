@@ -1,18 +1,34 @@
+import datetime
+
 from django.contrib import admin
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund, UserProfile
+from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund, UserProfile, DailySales, Stock
+from .pagination import EstimatedCountPaginator
+from .reports import AMOUNT_FIELDS, record_refunds, sales_report
+from .transactions import immediate_atomic
 
 # Register your models here.
 
 def make_refund_accepted(modeladmin, request, queryset):
-    # queryset.update(refund_requested=False, refund_granted=True)
-    for order in queryset:
-        if order.refund_requested:
-            order.refund_requested=False
-            order.refund_granted=True
-            order.refund.accepted = True
-            order.refund.save()
-            order.save()
+    # Two UPDATEs whatever the selection size, plus the sales rollups. The
+    # requested orders are locked first and the UPDATE re-checks them, so two
+    # admins granting the same refunds at once record each refund only once.
+    with immediate_atomic():
+        order_ids = list(
+            Order.objects.select_for_update()
+            .filter(pk__in=queryset.values('pk'), refund_requested=True)
+            .values_list('pk', flat=True)
+        )
+        Refund.objects.filter(order__in=order_ids).update(accepted=True)
+        granted = Order.objects.filter(pk__in=order_ids, refund_requested=True).update(
+            refund_requested=False, refund_granted=True
+        )
+        record_refunds(order_ids)
+    modeladmin.message_user(request, f'{granted} refund(s) granted.')
 
 make_refund_accepted.short_description = 'Update orders to refund granted'    
 
@@ -26,24 +42,85 @@ class AddressAdmin(admin.ModelAdmin):
 
 class OrderAdmin(admin.ModelAdmin):
     list_display = [
-        'user', 'ordered', 'being_delivered', 'received', 'refund_requested', 'refund_granted', 'shipping_address','billing_address', 'payment', 'coupon'
+        'user', 'ordered', 'status', 'total', 'being_delivered', 'received', 'refund_requested', 'refund_granted', 'shipping_address','billing_address', 'payment', 'coupon'
     ]
     list_display_links = ['user', 'shipping_address', 'billing_address', 'payment', 'coupon']
     list_editable = ('being_delivered', 'received',)
-    list_filter = ['ordered', 'being_delivered', 'received', 'refund_requested', 'refund_granted']
+    list_filter = ['ordered', 'status', 'being_delivered', 'received', 'refund_requested', 'refund_granted']
     search_fields = ['user__username',]
     actions = [make_refund_accepted,]
+    # Every related column's __str__ reads its user.
+    list_select_related = [
+        'user', 'shipping_address__user', 'billing_address__user', 'payment__user', 'coupon'
+    ]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 class RefundAdmin(admin.ModelAdmin):
     list_display = [
         'user', 'accepted'
     ]
 
+class CouponAdmin(admin.ModelAdmin):
+    list_display = ['code', 'kind', 'amount', 'active', 'valid_from', 'valid_until', 'redemptions', 'max_redemptions']
+    list_filter = ['kind', 'active']
+    search_fields = ['code']
+    # Moved by checkout (coupons.redeem_coupon / release_coupon).
+    readonly_fields = ['redemptions']
+
+class StockAdmin(admin.ModelAdmin):
+    list_display = ['item', 'available', 'reserved']
+    list_select_related = ['item']
+    search_fields = ['item__title']
+    raw_id_fields = ['item']
+    # `reserved` only moves with checkouts.
+    readonly_fields = ['reserved']
+
+class DailySalesAdmin(admin.ModelAdmin):
+    # Read-only; the rows come from mysite.reports.
+    list_display = ['date', 'category', 'item', 'units', 'gross', 'discount', 'coupon', 'refunds', 'net']
+    list_filter = ['category']
+    list_select_related = ['item']
+    date_hierarchy = 'date'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('report/', self.admin_site.admin_view(self.report_view), name='mysite_dailysales_report'),
+        ] + super().get_urls()
+
+    def report_view(self, request):
+        today = timezone.now().date()
+        end = parse_date(request.GET.get('end', '')) or today
+        start = parse_date(request.GET.get('start', '')) or end - datetime.timedelta(days=29)
+        rows = list(sales_report(start, end))
+        totals = {field: sum(row[field] for row in rows) for field in AMOUNT_FIELDS}
+        for row in rows + [totals]:
+            row['net'] = row['gross'] - row['discount'] - row['coupon'] - row['refunds']
+        return TemplateResponse(request, 'admin/mysite/sales_report.html', {
+            **self.admin_site.each_context(request),
+            'title': 'Sales report',
+            'opts': self.model._meta,
+            'start': start,
+            'end': end,
+            'rows': rows,
+            'totals': totals,
+        })
+
 admin.site.register(UserProfile)
 admin.site.register(Item)
 admin.site.register(OrderItem)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(Payment)
-admin.site.register(Coupon)
+admin.site.register(Coupon, CouponAdmin)
 admin.site.register(Refund, RefundAdmin)
+admin.site.register(DailySales, DailySalesAdmin)
+admin.site.register(Stock, StockAdmin)
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class MysiteConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mysite'
+
+    def ready(self):
+        # Connects the Item signals that keep the search index, the product
+        # page cache, the slug cache and the image derivatives in sync, the
+        # Coupon signals behind the promo code cache, the login signal that
+        # merges guest carts, and the query timer behind /metrics.
+        from . import search, cart, page_cache, slugs, coupons, images, metrics
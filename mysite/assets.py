@@ -0,0 +1,144 @@
+import gzip
+import mimetypes
+import os
+import posixpath
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.map', '.txt', '.eot', '.ttf', '.otf'}
+MIN_COMPRESS_SIZE = 512
+
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{12}\.[^/]+$')
+STATIC_TAG_RE = re.compile(r"""{%\s*static\s+['"]([^'"]+)['"]""")
+CSS_URL_RE = re.compile(r"""url\(\s*['"]?([^'")]+?)['"]?\s*\)""")
+
+def compress_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    for suffix, compressed in variants:
+        # Keep only variants that actually save bytes.
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # Hashed file names plus precompressed .gz/.br siblings for serve_static.
+    def url_converter(self, name, hashed_files, template=None):
+        converter = super().url_converter(name, hashed_files, template)
+
+        def converter_skipping_missing(matchobj):
+            # The vendored MDB bundles point at source maps that are not shipped.
+            try:
+                return converter(matchobj)
+            except ValueError:
+                return matchobj.group(0)
+        return converter_skipping_missing
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        for name in set(self.hashed_files.values()):
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+                compress_file(self.path(name))
+
+def accepted_encodings(request):
+    encodings = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        token, _, params = part.partition(';')
+        params = params.strip()
+        quality = 1.0
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0
+        if quality > 0:
+            encodings.add(token.strip().lower())
+    return encodings
+
+def serve_static(request, path):
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except ValueError:
+        raise Http404('Invalid path')
+    if not os.path.isfile(full_path):
+        raise Http404(f'"{path}" does not exist')
+
+    stat = os.stat(full_path)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime):
+        return HttpResponseNotModified()
+
+    served_path, content_encoding = full_path, None
+    encodings = accepted_encodings(request)
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in encodings and os.path.isfile(full_path + suffix):
+            served_path, content_encoding = full_path + suffix, encoding
+            break
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    response = FileResponse(open(served_path, 'rb'), content_type=content_type)
+    response.headers['Content-Length'] = os.path.getsize(served_path)
+    response.headers['Last-Modified'] = http_date(stat.st_mtime)
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if HASHED_NAME_RE.search(path):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+def referenced_static_files(template_dirs, static_dirs):
+    # Names used through {% static %} in the templates, plus everything those
+    # stylesheets pull in through url().
+    pending = set()
+    for template_dir in template_dirs:
+        for template in Path(template_dir).rglob('*.html'):
+            pending.update(STATIC_TAG_RE.findall(template.read_text(encoding='utf-8')))
+
+    referenced = set()
+    while pending:
+        name = pending.pop()
+        if name in referenced:
+            continue
+        referenced.add(name)
+        if not name.endswith('.css'):
+            continue
+        for static_dir in static_dirs:
+            css = Path(static_dir) / name
+            if css.is_file():
+                for url in CSS_URL_RE.findall(css.read_text(encoding='utf-8', errors='ignore')):
+                    if url.startswith(('data:', 'http:', 'https:', '//', '#')):
+                        continue
+                    url = url.split('#')[0].split('?')[0]
+                    pending.add(posixpath.normpath(posixpath.join(posixpath.dirname(name), url)))
+                break
+    return referenced
+
+def project_static_files(static_dirs):
+    files = {}
+    for static_dir in static_dirs:
+        root = Path(static_dir)
+        for path in root.rglob('*'):
+            if path.is_file():
+                files[path.relative_to(root).as_posix()] = path.stat().st_size
+    return files
@@ -0,0 +1,24 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    # The stock SQLite backend, plus PRAGMAs from OPTIONS['pragmas'] run on
+    # every new connection and an opt-in BEGIN IMMEDIATE for write
+    # transactions (see mysite.transactions.immediate_atomic).
+    begin_immediate = False
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.pragmas = params.pop('pragmas', {})
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        # A deferred BEGIN takes the write lock at the first write, and SQLite
+        # fails that upgrade at once instead of waiting out busy_timeout.
+        self.cursor().execute('BEGIN IMMEDIATE' if self.begin_immediate else 'BEGIN')
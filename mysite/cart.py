@@ -0,0 +1,444 @@
+import datetime
+import json
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
+from django.core.signing import BadSignature
+from django.db import IntegrityError, connections, router
+from django.db.models import F, Count, Sum, ExpressionWrapper, IntegerField, OuterRef, Subquery, Case, When, Value
+from django.db.models.functions import Coalesce, NullIf
+from django.http import Http404
+from django.utils import timezone
+
+from .models import Item, OrderItem, Order
+from .slugs import resolve_item
+from .transactions import immediate_atomic, retry_on_lock
+
+# Order statuses whose lines may still change; 'P' is locked for payment.
+OPEN_CART_STATUSES = ('C', 'F')
+
+EMPTY_CART_SUMMARY = {
+    'item_count': 0,
+    'quantity': 0,
+    'subtotal': 0,
+}
+
+def cart_summary_key(user_id):
+    return f'cart-summary:{user_id}'
+
+def cart_summary_query(user):
+    line_total = ExpressionWrapper(
+        F('quantity') * Coalesce(NullIf(F('item__discount_price'), 0), F('item__price')),
+        output_field=IntegerField()
+    )
+    return OrderItem.objects.filter(order__user=user, order__ordered=False), dict(
+        item_count=Count('id'),
+        quantity=Coalesce(Sum('quantity'), 0),
+        subtotal=Coalesce(Sum(line_total), 0),
+    )
+
+def get_cart_summary(user):
+    if not user.is_authenticated:
+        return EMPTY_CART_SUMMARY
+    key = cart_summary_key(user.pk)
+    summary = cache.get(key)
+    if summary is None:
+        queryset, aggregates = cart_summary_query(user)
+        summary = queryset.aggregate(**aggregates)
+        cache.set(key, summary, settings.CART_SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+async def aget_cart_summary(user):
+    # For async views, which pass it to templates as `cart_summary`.
+    if not user.is_authenticated:
+        return EMPTY_CART_SUMMARY
+    key = cart_summary_key(user.pk)
+    summary = await cache.aget(key)
+    if summary is None:
+        queryset, aggregates = cart_summary_query(user)
+        summary = await queryset.aaggregate(**aggregates)
+        await cache.aset(key, summary, settings.CART_SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+def invalidate_cart_summary(user):
+    if user.is_authenticated:
+        cache.delete(cart_summary_key(user.pk))
+
+def invalidates_cart_summary(view):
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                # The view has loaded request.user by now.
+                invalidate_cart_summary(request.user)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            invalidate_cart_summary(request.user)
+    return wrapper
+
+
+# Cart mutations shared by the cart views. Each operation resolves the item,
+# the active order and the matching cart line in one query, then runs at most
+# two single-statement writes in autocommit, with no BEGIN: 2 queries to bump,
+# decrease or remove a line or to add one to an existing cart, 3 to create the
+# cart or to remove its last line (which deletes the order too), plus one
+# UPDATE an hour to record activity (touch). Every write re-checks in the same
+# statement that the order is still open, so a line can never change after
+# checkout.initiate_payment has locked the cart for payment. Concurrent
+# duplicates hit unique_active_order (one open order per user) or
+# unique_order_item (one line per item in an order) and are retried once
+# against the row that won. Operations that lose the SQLite write lock are
+# re-run whole (mysite.transactions).
+class CartService:
+    ADDED = 'added'
+    UPDATED = 'updated'
+    REMOVED = 'removed'
+    EMPTIED = 'emptied'
+    NOT_IN_CART = 'not_in_cart'
+    NO_ORDER = 'no_order'
+    LOCKED = 'locked'
+
+    # Cart changes record activity for reap_carts at most this often, so
+    # most clicks cost no extra write.
+    activity_resolution = datetime.timedelta(hours=1)
+
+    def __init__(self, user):
+        self.user = user
+
+    def lookup(self, slug):
+        active_order = Order.objects.filter(user=self.user, ordered=False)
+        active_line = OrderItem.objects.filter(order__user=self.user, order__ordered=False, item=OuterRef('pk'))
+        item = Item.objects.filter(slug=slug).annotate(
+            order_id=Subquery(active_order.values('pk')[:1]),
+            order_status=Subquery(active_order.values('status')[:1]),
+            order_activity=Subquery(active_order.values('last_activity')[:1]),
+            line_id=Subquery(active_line.values('pk')[:1]),
+            line_quantity=Subquery(active_line.values('quantity')[:1]),
+            line_count=Subquery(active_order.annotate(n=Count('items')).values('n')[:1]),
+        ).first()
+        if item is None:
+            raise Http404('No Item matches the given query.')
+        return item
+
+    @retry_on_lock
+    def add(self, slug, retry=True):
+        item = self.lookup(slug)
+        if item.order_status == 'P':
+            # The cart is locked while its payment is being finalized.
+            return item, self.LOCKED
+        if item.line_id:
+            if open_lines().filter(pk=item.line_id).update(quantity=F('quantity') + 1):
+                self.touch(item)
+                return item, self.UPDATED
+            # Locked for payment or removed since the lookup; look again.
+            return self.add(slug, retry=False) if retry else (item, self.LOCKED)
+        try:
+            order_id = item.order_id
+            if not order_id:
+                # Left empty if the line INSERT fails; the next add uses it.
+                order_id = Order.objects.create(user=self.user, ordered_date=timezone.now()).pk
+            added = insert_open_line(order_id, item.pk)
+        except IntegrityError:
+            # A concurrent request created the order or the line first.
+            if not retry:
+                raise
+            return self.add(slug, retry=False)
+        if not added:
+            # Locked for payment or the line appeared since the lookup.
+            return self.add(slug, retry=False) if retry else (item, self.LOCKED)
+        self.touch(item)
+        return item, self.ADDED
+
+    def touch(self, item):
+        if item.order_id and item.order_activity < timezone.now() - self.activity_resolution:
+            Order.objects.filter(pk=item.order_id).update(last_activity=timezone.now())
+
+    def get_order(self):
+        return Order.objects.for_cart().filter(user=self.user, ordered=False).first()
+
+    async def aget_order(self):
+        return await Order.objects.for_cart().filter(user=self.user, ordered=False).afirst()
+
+    @retry_on_lock
+    def merge(self, lines):
+        # Folds a guest cart ({item_id: quantity}) into the active order with
+        # a fixed number of bulk statements, whatever the number of lines.
+        # Returns False, merging nothing, while that order is locked for
+        # payment: its lines must stay what is being charged.
+        item_ids = list(Item.objects.filter(pk__in=lines).values_list('pk', flat=True))
+        if not item_ids:
+            return True
+        with immediate_atomic():
+            order = Order.objects.filter(user=self.user, ordered=False).first()
+            if order is None:
+                order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+            elif not Order.objects.filter(pk=order.pk, status__in=OPEN_CART_STATUSES).update(
+                last_activity=timezone.now()
+            ):
+                return False
+            existing = dict(
+                OrderItem.objects.filter(order=order, item_id__in=item_ids).values_list('item_id', 'pk')
+            )
+            if existing:
+                OrderItem.objects.filter(pk__in=existing.values()).update(
+                    quantity=F('quantity') + Case(
+                        *[When(item_id=item_id, then=Value(lines[item_id])) for item_id in existing],
+                        output_field=IntegerField()
+                    )
+                )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, item_id=item_id, quantity=lines[item_id])
+                for item_id in item_ids if item_id not in existing
+            ])
+        invalidate_cart_summary(self.user)
+        return True
+
+    @retry_on_lock
+    def decrease(self, slug):
+        item = self.lookup(slug)
+        if not item.order_id:
+            return item, self.NO_ORDER
+        if item.order_status == 'P':
+            return item, self.LOCKED
+        if not item.line_id:
+            return item, self.NOT_IN_CART
+        if item.line_quantity > 1:
+            updated = open_lines().filter(pk=item.line_id, quantity__gt=1).update(
+                quantity=F('quantity') - 1
+            )
+            if updated:
+                self.touch(item)
+                return item, self.UPDATED
+        return item, self._remove_line(item)
+
+    @retry_on_lock
+    def remove(self, slug):
+        item = self.lookup(slug)
+        if not item.order_id:
+            return item, self.NO_ORDER
+        if item.order_status == 'P':
+            return item, self.LOCKED
+        if not item.line_id:
+            return item, self.NOT_IN_CART
+        return item, self._remove_line(item)
+
+    def _remove_line(self, item):
+        # No transaction needed: the order is only deleted once it really has
+        # no lines, so a line added in between keeps it.
+        removed, _ = open_lines().filter(pk=item.line_id).delete()
+        if not removed:
+            # Locked for payment or already removed since the lookup.
+            locked = Order.objects.filter(pk=item.order_id, status='P').exists()
+            return self.LOCKED if locked else self.NOT_IN_CART
+        if item.line_count > 1:
+            self.touch(item)
+            return self.REMOVED
+        return self.EMPTIED if delete_empty_order(item.order_id) else self.REMOVED
+
+def open_lines():
+    return OrderItem.objects.filter(order__status__in=OPEN_CART_STATUSES)
+
+def insert_open_line(order_id, item_id):
+    # One INSERT ... SELECT that adds the line only while the order is open
+    # and has no line for the item yet; returns whether it did. Where the
+    # database supports it the order row is locked, so initiate_payment's
+    # UPDATE either waits for this line or makes this insert a no-op.
+    using = router.db_for_write(OrderItem)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    lines, orders = qn(OrderItem._meta.db_table), qn(Order._meta.db_table)
+    lock = ' FOR UPDATE' if connection.features.has_select_for_update else ''
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {lines} (order_id, item_id, quantity) '
+            f'SELECT o.id, %s, 1 FROM {orders} o WHERE o.id = %s AND o.status IN (%s, %s) '
+            f'AND NOT EXISTS (SELECT 1 FROM {lines} l WHERE l.order_id = o.id AND l.item_id = %s){lock}',
+            [item_id, order_id, *OPEN_CART_STATUSES, item_id]
+        )
+        return cursor.rowcount == 1
+
+def delete_empty_order(order_id):
+    # A plain DELETE rather than QuerySet.delete(), whose Collector would look
+    # for lines and refunds to cascade to; an open order without lines has none.
+    using = router.db_for_write(Order)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    lines, orders = qn(OrderItem._meta.db_table), qn(Order._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {orders} WHERE id = %s AND status IN (%s, %s) '
+            f'AND NOT EXISTS (SELECT 1 FROM {lines} WHERE order_id = %s)',
+            [order_id, *OPEN_CART_STATUSES, order_id]
+        )
+        return cursor.rowcount == 1
+
+
+def reap_idle_carts(cutoff, batch_size=500):
+    # Deletes open carts ('C' or 'F') untouched since `cutoff` with their
+    # lines. Each batch is its own short transaction, so writers are never
+    # held up for long. Yields (carts, lines) deleted per batch.
+    idle = Order.objects.filter(ordered=False, status__in=OPEN_CART_STATUSES, last_activity__lt=cutoff)
+    while True:
+        with immediate_atomic():
+            order_ids = list(
+                idle.select_for_update(skip_locked=True).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not order_ids:
+                break
+            lines, _ = OrderItem.objects.filter(order_id__in=order_ids).delete()
+            carts, _ = Order.objects.filter(pk__in=order_ids).delete()
+        yield carts, lines
+
+
+class GuestOrderItems(list):
+    # Quacks like order.items for the summary template.
+    def all(self):
+        return self
+
+    def count(self):
+        return len(self)
+
+class GuestOrder:
+    coupon = None
+
+    def __init__(self, lines):
+        self.items = GuestOrderItems(lines)
+
+    def calculate_order_total(self):
+        return sum(line.get_order_item_total_price() for line in self.items)
+
+# Guest carts live in a signed cookie ({item_id: quantity}), so browsing
+# visitors cost no database writes. GuestCartMiddleware writes the cookie back
+# on the response, and merge_guest_cart moves it into the database at login.
+class CookieCartStorage:
+    cookie_name = 'guest_cart'
+    salt = 'mysite.cart'
+    max_lines = 50
+
+    ADDED = CartService.ADDED
+    UPDATED = CartService.UPDATED
+    REMOVED = CartService.REMOVED
+    EMPTIED = CartService.EMPTIED
+    NOT_IN_CART = CartService.NOT_IN_CART
+    NO_ORDER = CartService.NO_ORDER
+    LOCKED = CartService.LOCKED
+
+    def __init__(self, request):
+        self.request = request
+        self.lines = self.load()
+        self.modified = False
+
+    def load(self):
+        try:
+            raw = self.request.get_signed_cookie(self.cookie_name, default=None, salt=self.salt)
+            data = json.loads(raw) if raw else {}
+            return {
+                int(item_id): int(quantity) for item_id, quantity in data.items() if int(quantity) > 0
+            }
+        except (BadSignature, ValueError, TypeError, AttributeError):
+            return {}
+
+    def lookup(self, slug):
+        return resolve_item(slug)
+
+    def add(self, slug):
+        item = self.lookup(slug)
+        if item.pk in self.lines:
+            self.lines[item.pk] += 1
+            status = self.UPDATED
+        elif len(self.lines) < self.max_lines:
+            self.lines[item.pk] = 1
+            status = self.ADDED
+        else:
+            return item, self.NOT_IN_CART
+        self.modified = True
+        return item, status
+
+    def decrease(self, slug):
+        item = self.lookup(slug)
+        if not self.lines:
+            return item, self.NO_ORDER
+        if item.pk not in self.lines:
+            return item, self.NOT_IN_CART
+        if self.lines[item.pk] > 1:
+            self.lines[item.pk] -= 1
+            self.modified = True
+            return item, self.UPDATED
+        return item, self._remove_line(item)
+
+    def remove(self, slug):
+        item = self.lookup(slug)
+        if not self.lines:
+            return item, self.NO_ORDER
+        if item.pk not in self.lines:
+            return item, self.NOT_IN_CART
+        return item, self._remove_line(item)
+
+    def _remove_line(self, item):
+        del self.lines[item.pk]
+        self.modified = True
+        return self.REMOVED if self.lines else self.EMPTIED
+
+    def clear(self):
+        self.lines = {}
+        self.modified = True
+
+    def get_order(self):
+        if not self.lines:
+            return None
+        return self.build_order(Item.objects.in_bulk(list(self.lines)))
+
+    async def aget_order(self):
+        if not self.lines:
+            return None
+        return self.build_order(await Item.objects.ain_bulk(list(self.lines)))
+
+    def build_order(self, items):
+        return GuestOrder([
+            OrderItem(item=items[item_id], quantity=quantity)
+            for item_id, quantity in self.lines.items() if item_id in items
+        ])
+
+    def persist(self, response):
+        if not self.modified:
+            return
+        if self.lines:
+            response.set_signed_cookie(
+                self.cookie_name,
+                json.dumps(self.lines),
+                salt=self.salt,
+                max_age=settings.GUEST_CART_COOKIE_AGE,
+                httponly=True,
+                samesite='Lax'
+            )
+        else:
+            response.delete_cookie(self.cookie_name, samesite='Lax')
+
+def get_cart(request):
+    if request.user.is_authenticated:
+        return CartService(request.user)
+    if not hasattr(request, 'guest_cart'):
+        request.guest_cart = CookieCartStorage(request)
+    return request.guest_cart
+
+def merge_guest_cart(sender, request, user, **kwargs):
+    if request is None:
+        return
+    guest_cart = CookieCartStorage(request)
+    # Held in the cookie, for the next login, while the cart is being paid.
+    if guest_cart.lines and CartService(user).merge(guest_cart.lines):
+        guest_cart.clear()
+        request.guest_cart = guest_cart
+
+user_logged_in.connect(merge_guest_cart)
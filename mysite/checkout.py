@@ -0,0 +1,297 @@
+import datetime
+import logging
+import random
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .cart import invalidate_cart_summary
+from .gateway import GatewayUnavailable, get_gateway
+from .coupons import CouponUnavailable, redeem_coupon, release_coupon
+from .inventory import commit_reservations, release_reservations, reserve_stock
+from .models import Order, OrderItem, Payment, UserProfile
+from .reports import record_sale
+from .transactions import immediate_atomic, retry_on_lock
+
+import stripe
+
+logger = logging.getLogger(__name__)
+
+# Checkout runs in two phases. PaymentView.post only locks the cart and
+# records a pending Payment (initiate_payment), then hands the Stripe calls to
+# a small worker pool (process_payment). The order is finalized either by that
+# worker or by the Stripe webhook, whichever comes first; both go through the
+# conditional updates in complete_order / fail_order, so finalizing twice is
+# harmless.
+
+CART = 'C'
+PENDING = 'P'
+PAID = 'S'
+FAILED = 'F'
+OPEN_STATUSES = (CART, FAILED)
+
+COMPLETE_ATTEMPTS = 3
+CHARGE_ATTEMPTS = 3
+CHARGE_RETRY_DELAY = 0.5
+
+_executor = None
+
+def create_refrence_key():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.CHECKOUT_WORKERS,
+            thread_name_prefix='checkout'
+        )
+    return _executor
+
+@retry_on_lock
+def initiate_payment(order, user):
+    # Returns the pending Payment, or None when the order is already being
+    # paid. Raises inventory.OutOfStock or coupons.CouponUnavailable, leaving
+    # the cart open.
+    with immediate_atomic():
+        locked = Order.objects.filter(pk=order.pk, status__in=OPEN_STATUSES).update(status=PENDING)
+        if not locked:
+            return None
+        # Cart writes check the status, so the lines are final from here on.
+        # Waiting on the row locks of writes still in flight (elsewhere than
+        # SQLite, whose write lock is already held) lets the total see them.
+        list(OrderItem.objects.select_for_update().filter(order=order).values_list('pk', flat=True))
+        locked_order = Order.objects.get(pk=order.pk)
+        if locked_order.coupon_id and not redeem_coupon(locked_order.coupon_id):
+            raise CouponUnavailable(locked_order.coupon_id)
+        locked_order.snapshot_prices()
+        payment = Payment.objects.create(
+            user=user,
+            stripe_charge_id='',
+            amount=locked_order.total
+        )
+        Order.objects.filter(pk=order.pk).update(payment=payment)
+        reserve_stock(order, payment)
+    return payment
+
+def schedule_payment(payment_id, token, save, use_default):
+    # The card token is single-use and short-lived, so it is only ever held in
+    # memory by the job and never written to the database.
+    return get_executor().submit(_process_payment_logged, payment_id, token, save, use_default)
+
+def _process_payment_logged(*args):
+    # process_payment fails the order itself when the card was not charged.
+    # Anything that escapes it may have happened after Stripe took the money,
+    # so the order is left PENDING rather than failed.
+    # Worker threads live outside the request cycle, so nothing else closes
+    # their connections; drop stale or broken ones around every job.
+    close_old_connections()
+    try:
+        process_payment(*args)
+    except Exception:
+        logger.exception('Payment processing failed for payment %s', args[0])
+    finally:
+        close_old_connections()
+
+def process_payment(payment_id, token, save, use_default):
+    payment = Payment.objects.select_related('user').get(pk=payment_id)
+    try:
+        charge = charge_payment(payment, token, save, use_default)
+    except ChargeOutcomeUnknown as e:
+        # Stripe may have charged the card. The order keeps its Payment, and
+        # so its idempotency key, until the webhook or expire_pending_checkouts
+        # settles it; failing it here would let the customer pay twice.
+        logger.error('Charge for payment %s has an unknown outcome, leaving it pending: %s', payment.pk, e)
+        return False
+    except stripe.error.StripeError as e:
+        logger.warning('Stripe declined payment %s: %s', payment.pk, e)
+        fail_order(payment.pk)
+        return False
+
+    if charge['status'] == 'succeeded':
+        return complete_charged_order(payment.pk, charge['id'])
+    # 'pending' charges are finalized by the charge.succeeded/failed webhook.
+    Payment.objects.filter(pk=payment.pk).update(stripe_charge_id=charge['id'])
+    return False
+
+class ChargeOutcomeUnknown(Exception):
+    pass
+
+def charge_payment(payment, token, save, use_default):
+    try:
+        userprofile = UserProfile.objects.get(user=payment.user)
+        gateway = get_gateway()
+        if save:
+            if userprofile.stripe_customer_id != '' and userprofile.stripe_customer_id is not None:
+                gateway.create_source(userprofile.stripe_customer_id, source=token)
+            else:
+                customer = gateway.create_customer(email=payment.user.email, source=token)
+                userprofile.stripe_customer_id = customer['id']
+                userprofile.one_click_purchasing = True
+                userprofile.save()
+    except stripe.error.StripeError:
+        raise
+    except Exception:
+        # Nothing has been charged yet.
+        fail_order(payment.pk)
+        raise
+
+    charge = {
+        'amount': int(payment.amount * 100),
+        'currency': 'usd',
+        'metadata': {'payment_id': payment.pk},
+        'idempotency_key': f'payment-{payment.pk}',
+    }
+    if use_default or save:
+        charge['customer'] = userprofile.stripe_customer_id
+    else:
+        charge['source'] = token
+    return create_charge(gateway, charge)
+
+def create_charge(gateway, charge):
+    # Connection errors and 5xx answers leave the outcome unknown, so they are
+    # retried with the same idempotency key: Stripe charges at most once and
+    # replays the first result. Declines and bad requests raise at once.
+    sent = False
+    for attempt in range(1, CHARGE_ATTEMPTS + 1):
+        try:
+            return gateway.create_charge(**charge)
+        except GatewayUnavailable:
+            # Refused by the circuit breaker without reaching Stripe.
+            if not sent:
+                raise
+        except (stripe.error.APIConnectionError, stripe.error.APIError):
+            sent = True
+        except stripe.error.StripeError:
+            raise
+        except Exception as e:
+            raise ChargeOutcomeUnknown(repr(e)) from e
+        if attempt < CHARGE_ATTEMPTS:
+            time.sleep(CHARGE_RETRY_DELAY * 2 ** (attempt - 1))
+    raise ChargeOutcomeUnknown(f'no answer after {CHARGE_ATTEMPTS} attempts')
+
+def complete_charged_order(payment_id, charge_id):
+    # The card is charged, so the order must not fail: retry completion and
+    # leave it PENDING, with the charge recorded, if it still does not go through.
+    for attempt in range(1, COMPLETE_ATTEMPTS + 1):
+        try:
+            completed = complete_order(payment_id, charge_id)
+        except Exception:
+            logger.exception('Completing charged payment %s failed (attempt %s)', payment_id, attempt)
+            continue
+        if not completed:
+            refund_orphaned_charge(payment_id, charge_id)
+        return completed
+    Payment.objects.filter(pk=payment_id).update(stripe_charge_id=charge_id)
+    logger.critical('Payment %s was charged (%s) but its order could not be completed', payment_id, charge_id)
+    return False
+
+def refund_orphaned_charge(payment_id, charge_id):
+    # complete_order found the order no longer pending. Unless it is already
+    # paid (a repeated webhook), it was failed while the card was being
+    # charged, so nothing was sold for this money: give it back.
+    if Order.objects.filter(payment_id=payment_id, status=PAID).exists():
+        return
+    logger.critical('Payment %s was charged (%s) after its order was failed; refunding', payment_id, charge_id)
+    try:
+        get_gateway().create_refund(charge_id)
+    except stripe.error.StripeError:
+        logger.critical('Refunding charge %s failed; refund it by hand', charge_id, exc_info=True)
+
+@retry_on_lock
+def complete_order(payment_id, charge_id=None):
+    with immediate_atomic():
+        completed = Order.objects.filter(payment_id=payment_id, status=PENDING).update(
+            status=PAID,
+            ordered=True,
+            ordered_date=timezone.now(),
+            refrence_key=create_refrence_key()
+        )
+        if not completed:
+            return False
+        order = Order.objects.select_related('user').get(payment_id=payment_id)
+        commit_reservations([payment_id])
+        record_sale(order.pk)
+        if charge_id:
+            Payment.objects.filter(pk=payment_id).update(stripe_charge_id=charge_id)
+    invalidate_cart_summary(order.user)
+
+    send_mail(
+        subject='Yo!',
+        message=f'Purchased successfully. Your refrence code for the order is {order.refrence_key}. Please use that key to refund your order.',
+        from_email='admin-luffy@hello.com',
+        recipient_list=[order.user.email]
+    )
+    return True
+
+@retry_on_lock
+def fail_order(payment_id):
+    # Reopens the cart so the customer can try again.
+    with immediate_atomic():
+        order = Order.objects.filter(payment_id=payment_id).values('pk', 'coupon_id').first()
+        # The reopened cart follows live prices again.
+        failed = Order.objects.filter(payment_id=payment_id, status=PENDING).update(
+            status=FAILED, payment=None, subtotal=None, discount=None, total=None
+        )
+        if failed:
+            OrderItem.objects.filter(order_id=order['pk']).update(unit_price=None, unit_discount_price=None)
+            release_reservations([payment_id])
+            if order['coupon_id']:
+                release_coupon(order['coupon_id'])
+            Payment.objects.filter(pk=payment_id).delete()
+    return bool(failed)
+
+def expire_pending_checkouts(now=None, batch_size=500):
+    # Settles checkouts still PENDING after STOCK_HOLD_SECONDS, whether or
+    # not they hold stock: the worker died with the process, Stripe never
+    # answered or the webhook got lost. Stripe is asked about each one, so a
+    # paid order is completed and only an uncharged one is failed. Returns
+    # (completed, failed).
+    now = now or timezone.now()
+    cutoff = now - datetime.timedelta(seconds=settings.STOCK_HOLD_SECONDS)
+    stale = Order.objects.filter(status=PENDING, payment__timestamp__lt=cutoff).order_by('payment_id')
+    gateway = get_gateway()
+    completed = failed = 0
+    last = 0
+    while True:
+        # Keyset batches: orders Stripe cannot settle yet stay PENDING.
+        payment_ids = list(stale.filter(payment_id__gt=last).values_list('payment_id', flat=True)[:batch_size])
+        if not payment_ids:
+            return completed, failed
+        last = payment_ids[-1]
+        for payment_id in payment_ids:
+            outcome = settle_pending_payment(gateway, payment_id)
+            if outcome == PAID:
+                completed += 1
+            elif outcome == FAILED:
+                failed += 1
+
+def settle_pending_payment(gateway, payment_id):
+    # Returns PAID or FAILED when the order was settled, None otherwise.
+    try:
+        charge = gateway.find_charge(payment_id)
+    except stripe.error.StripeError as e:
+        logger.warning('Could not look up the charge for payment %s: %s', payment_id, e)
+        return None
+    if charge is None or charge['status'] == 'failed':
+        return FAILED if fail_order(payment_id) else None
+    if charge['status'] == 'succeeded':
+        return PAID if complete_charged_order(payment_id, charge['id']) else None
+    # Still pending at Stripe; its webhook or a later sweep finishes it.
+    return None
+
+def handle_stripe_event(event):
+    if event['type'] not in ('charge.succeeded', 'charge.failed'):
+        return False
+    charge = event['data']['object']
+    payment_id = (charge.get('metadata') or {}).get('payment_id')
+    if not payment_id:
+        return False
+    if event['type'] == 'charge.succeeded':
+        return complete_charged_order(int(payment_id), charge['id'])
+    return fail_order(int(payment_id))
@@ -0,0 +1,65 @@
+import copy
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from .lru import LRUCache
+from .models import Coupon, normalize_coupon_code
+
+# Promo codes are looked up per process: known coupons in one LRU, codes that
+# matched nothing in another, so guessing during a campaign neither reaches
+# the database nor pushes the real coupons out. Saving or deleting a Coupon
+# evicts it here; other processes catch up within COUPON_CACHE_TIMEOUT.
+# The cached redemption count may lag, which only matters for the message:
+# checkout takes a redemption with redeem_coupon before charging.
+
+known_coupons = LRUCache(settings.COUPON_CACHE_SIZE, settings.COUPON_CACHE_TIMEOUT)
+unknown_codes = LRUCache(settings.COUPON_NEGATIVE_CACHE_SIZE, settings.COUPON_CACHE_TIMEOUT)
+
+CODE_MAX_LENGTH = Coupon._meta.get_field('code').max_length
+
+def find_coupon(code):
+    code = normalize_coupon_code(code)
+    if not code or len(code) > CODE_MAX_LENGTH:
+        return None
+    coupon = known_coupons.get(code)
+    if coupon is None:
+        if unknown_codes.get(code):
+            return None
+        coupon = Coupon.objects.filter(code=code).first()
+        if coupon is None:
+            unknown_codes.set(code, True)
+            return None
+        known_coupons.set(code, coupon)
+    return copy.copy(coupon)
+
+class CouponUnavailable(Exception):
+    pass
+
+def redeem_coupon(coupon_id, now=None):
+    # Takes one redemption for a checkout, or returns False when the coupon
+    # is used up, expired or switched off. One conditional UPDATE against
+    # the live row, so concurrent checkouts never go past max_redemptions
+    # whatever the caches say.
+    now = now or timezone.now()
+    return bool(
+        Coupon.objects.filter(pk=coupon_id, active=True)
+        .filter(Q(valid_from__isnull=True) | Q(valid_from__lte=now))
+        .filter(Q(valid_until__isnull=True) | Q(valid_until__gt=now))
+        .filter(Q(max_redemptions__isnull=True) | Q(redemptions__lt=F('max_redemptions')))
+        .update(redemptions=F('redemptions') + 1)
+    )
+
+def release_coupon(coupon_id):
+    # Gives back the redemption of a checkout that failed.
+    Coupon.objects.filter(pk=coupon_id, redemptions__gt=0).update(redemptions=F('redemptions') - 1)
+
+def post_coupon_change_cache_signal(sender, instance, *args, **kwargs):
+    # By pk as well, in case the code itself was edited.
+    known_coupons.discard(lambda code, coupon: code == instance.code or coupon.pk == instance.pk)
+    unknown_codes.discard(lambda code, _: code == instance.code)
+
+post_save.connect(post_coupon_change_cache_signal, sender=Coupon)
+post_delete.connect(post_coupon_change_cache_signal, sender=Coupon)
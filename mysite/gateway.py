@@ -0,0 +1,234 @@
+import asyncio
+import functools
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+from .metrics import STRIPE_LATENCY
+
+# Every Stripe call made by the shop goes through a gateway object returned by
+# get_gateway(). StripeGateway talks to Stripe over one pooled HTTP session
+# with bounded timeouts behind a circuit breaker, and caches customer card
+# lists. FakeGateway keeps everything in memory for tests and offline work.
+
+class GatewayUnavailable(stripe.error.APIConnectionError):
+    pass
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive connection failures and fails fast
+    # for `cooldown` seconds, then lets a single trial call through.
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown:
+                raise GatewayUnavailable('Payment provider is temporarily unavailable')
+            # Half-open: allow this call, the next failure re-opens at once.
+            self.opened_at = None
+            self.failures = self.threshold - 1
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+def card_cache_key(customer_id):
+    return f'stripe-cards:{customer_id}'
+
+def pick_charge(charges):
+    # One idempotency key per Payment means one charge, but prefer a
+    # successful one should there ever be several.
+    for status in ('succeeded', 'pending', 'failed'):
+        for charge in charges:
+            if charge['status'] == status:
+                return charge
+    return None
+
+class StripeGateway:
+    connect_timeout = 3.05
+    read_timeout = 10
+    max_connections = 20
+    card_cache_timeout = 60 * 5
+
+    def __init__(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+        session.mount('https://', adapter)
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        stripe.default_http_client = stripe.http_client.RequestsClient(
+            timeout=(self.connect_timeout, self.read_timeout),
+            session=session
+        )
+        self.breaker = CircuitBreaker()
+
+    def call(self, operation, func, *args, **kwargs):
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            self.breaker.before_call()
+            try:
+                result = func(*args, **kwargs)
+            except (stripe.error.APIConnectionError, stripe.error.APIError):
+                # Network trouble or a 5xx from Stripe; card declines and bad
+                # requests are the caller's problem and do not trip the breaker.
+                self.breaker.record_failure()
+                raise
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            STRIPE_LATENCY.observe(time.perf_counter() - start, operation=operation, outcome=outcome)
+        self.breaker.record_success()
+        return result
+
+    def list_cards(self, customer_id, limit=3):
+        key = card_cache_key(customer_id)
+        cards = cache.get(key)
+        if cards is None:
+            response = self.call('Customer.list_sources', stripe.Customer.list_sources, customer_id, limit=limit, object='card')
+            cards = [
+                {'id': card['id'], 'last4': card['last4'], 'exp_month': card['exp_month'], 'exp_year': card['exp_year']}
+                for card in response['data']
+            ]
+            cache.set(key, cards, self.card_cache_timeout)
+        return cards
+
+    def create_customer(self, email, source):
+        customer = self.call('Customer.create', stripe.Customer.create, email=email, source=source)
+        cache.delete(card_cache_key(customer['id']))
+        return customer
+
+    def create_source(self, customer_id, source):
+        card = self.call('Customer.create_source', stripe.Customer.create_source, customer_id, source=source)
+        cache.delete(card_cache_key(customer_id))
+        return card
+
+    def create_charge(self, **kwargs):
+        return self.call('Charge.create', stripe.Charge.create, **kwargs)
+
+    def create_refund(self, charge_id):
+        # Keyed on the charge, so a repeated call never refunds twice.
+        return self.call('Refund.create', stripe.Refund.create, charge=charge_id, idempotency_key=f'refund-{charge_id}')
+
+    def find_charge(self, payment_id):
+        # The charge made for one of our Payments, found by its metadata, or
+        # None. Search is eventually consistent (about a minute behind), so
+        # only use it for payments older than that.
+        result = self.call(
+            'Charge.search', stripe.Charge.search,
+            query=f"metadata['payment_id']:'{int(payment_id)}'", limit=10
+        )
+        return pick_charge(result['data'])
+
+class FakeGateway:
+    # Tokens behave like Stripe's test tokens: 'tok_chargeDeclined' is declined,
+    # anything else is a Visa ending in 4242.
+    ids = itertools.count(1)
+
+    def __init__(self):
+        self.customers = {}
+        self.charges = []
+        self.refunds = []
+        self.calls = []
+
+    def _card(self, source):
+        if source == 'tok_chargeDeclined':
+            raise stripe.error.CardError('Your card was declined.', None, 'card_declined')
+        return {'id': f'card_{next(self.ids)}', 'last4': '4242', 'exp_month': 12, 'exp_year': 2030}
+
+    def list_cards(self, customer_id, limit=3):
+        self.calls.append('list_cards')
+        return list(self.customers.get(customer_id, []))[:limit]
+
+    def create_customer(self, email, source):
+        self.calls.append('create_customer')
+        customer_id = f'cus_{next(self.ids)}'
+        self.customers[customer_id] = [self._card(source)]
+        return {'id': customer_id, 'email': email}
+
+    def create_source(self, customer_id, source):
+        self.calls.append('create_source')
+        card = self._card(source)
+        self.customers.setdefault(customer_id, []).append(card)
+        return card
+
+    def find_charge(self, payment_id):
+        self.calls.append('find_charge')
+        return pick_charge([
+            charge for charge in self.charges if str(charge['metadata'].get('payment_id')) == str(payment_id)
+        ])
+
+    def create_charge(self, amount, currency, customer=None, source=None, metadata=None, idempotency_key=None):
+        self.calls.append('create_charge')
+        if source is not None:
+            self._card(source)
+        charge = {
+            'id': f'ch_{next(self.ids)}',
+            'amount': amount,
+            'currency': currency,
+            'customer': customer,
+            'status': 'succeeded',
+            'metadata': metadata or {},
+        }
+        self.charges.append(charge)
+        return charge
+
+    def create_refund(self, charge_id):
+        self.calls.append('create_refund')
+        refund = {'id': f're_{next(self.ids)}', 'charge': charge_id, 'status': 'succeeded'}
+        self.refunds.append(refund)
+        return refund
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = import_string(settings.PAYMENT_GATEWAY)()
+    return _gateway
+
+_executor = None
+
+async def run_in_gateway_pool(func, *args, **kwargs):
+    # Async views await Stripe through a small dedicated pool, so a slow
+    # Stripe holds at most STRIPE_ASYNC_WORKERS threads and never the event
+    # loop or the thread that runs ORM queries.
+    global _executor
+    if _executor is None:
+        with _gateway_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.STRIPE_ASYNC_WORKERS,
+                    thread_name_prefix='stripe'
+                )
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def set_gateway(gateway):
+    # Swaps the process-wide gateway, e.g. for a FakeGateway in tests.
+    global _gateway
+    _gateway = gateway
@@ -0,0 +1,126 @@
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_save
+from PIL import Image, ImageOps
+
+from .models import Item
+
+logger = logging.getLogger(__name__)
+
+# Resized copies of Item.image, stored under MEDIA_ROOT/derivatives/ with the
+# same relative name as the original, e.g. derivatives/shirt-card.webp.
+DERIVATIVE_DIR = 'derivatives'
+DERIVATIVE_WIDTHS = {
+    'thumb': 160,
+    'card': 400,
+    'detail': 900,
+}
+DERIVATIVE_FORMATS = {
+    'webp': 'WEBP',
+    'jpg': 'JPEG',
+}
+DERIVATIVE_QUALITY = 82
+
+# Originals brought in by import_catalog, named by content hash.
+IMPORT_DIR = 'catalog'
+IMPORT_TIMEOUT = (3.05, 20)
+
+_executor = None
+
+def derivative_name(name, size, ext):
+    stem = os.path.splitext(name)[0]
+    return f'{DERIVATIVE_DIR}/{stem}-{size}.{ext}'
+
+def derivative_names(name):
+    return [
+        derivative_name(name, size, ext)
+        for size in DERIVATIVE_WIDTHS for ext in DERIVATIVE_FORMATS
+    ]
+
+def derivatives_ready(name):
+    # The largest JPEG is written last, so it marks a complete set.
+    return default_storage.exists(derivative_name(name, 'detail', 'jpg'))
+
+def build_derivatives(name, force=False):
+    if not force and all(default_storage.exists(target) for target in derivative_names(name)):
+        return 0
+    with default_storage.open(name) as f:
+        image = ImageOps.exif_transpose(Image.open(f))
+        image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    built = 0
+    for size, width in DERIVATIVE_WIDTHS.items():
+        if image.width > width:
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.Resampling.LANCZOS)
+        else:
+            resized = image
+        for ext, image_format in DERIVATIVE_FORMATS.items():
+            target = derivative_name(name, size, ext)
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, quality=DERIVATIVE_QUALITY, optimize=image_format == 'JPEG')
+            if default_storage.exists(target):
+                default_storage.delete(target)
+            default_storage.save(target, ContentFile(buffer.getvalue()))
+            built += 1
+    return built
+
+def import_image(source, image_root=None):
+    # Fetches (http/https) or copies one catalog image into MEDIA_ROOT/catalog/
+    # and builds its derivatives. Naming by content hash makes re-imports
+    # store nothing twice. Runs in import_catalog's process pool, so it must
+    # not touch the database.
+    if source.startswith(('http://', 'https://')):
+        response = requests.get(source, timeout=IMPORT_TIMEOUT)
+        response.raise_for_status()
+        data = response.content
+    else:
+        path = os.path.join(image_root, source) if image_root else source
+        with open(path, 'rb') as f:
+            data = f.read()
+    Image.open(io.BytesIO(data)).verify()
+
+    ext = os.path.splitext(urlparse(source).path)[1].lower() or '.jpg'
+    name = f'{IMPORT_DIR}/{hashlib.sha1(data).hexdigest()[:20]}{ext}'
+    if not default_storage.exists(name):
+        default_storage.save(name, ContentFile(data))
+    build_derivatives(name)
+    return name
+
+def _build_in_background(name):
+    try:
+        build_derivatives(name)
+    except Exception:
+        logger.exception('Could not build image derivatives for %s', name)
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_PIPELINE_WORKERS,
+            thread_name_prefix='image-derivatives'
+        )
+    return _executor
+
+def schedule_derivatives(name):
+    return get_executor().submit(_build_in_background, name)
+
+def post_item_save_image_signal(sender, instance, *args, **kwargs):
+    if instance.image:
+        name = instance.image.name
+        transaction.on_commit(lambda: schedule_derivatives(name))
+
+post_save.connect(post_item_save_image_signal, sender=Item)
@@ -0,0 +1,54 @@
+from django.db.models import F, Sum
+
+from .models import Item, Stock, StockReservation
+
+# Checkout holds stock with one conditional UPDATE per tracked item
+# (available >= quantity), in the same short transaction that locks the
+# order for payment. No row stays locked while Stripe is called; the hold is
+# a StockReservation row, committed when the order completes and released
+# when the payment fails or the checkout expires
+# (checkout.expire_pending_checkouts).
+
+class OutOfStock(Exception):
+    def __init__(self, items):
+        self.items = items
+        super().__init__(', '.join(item.title for item in items))
+
+def reserve_stock(order, payment):
+    # Runs inside the caller's transaction, which must roll back when
+    # OutOfStock is raised. Items are taken in id order so that concurrent
+    # checkouts cannot deadlock on each other.
+    quantities = dict(order.items.values_list('item_id', 'quantity'))
+    tracked = sorted(Stock.objects.filter(item_id__in=quantities).values_list('item_id', flat=True))
+    short = [
+        item_id for item_id in tracked
+        if not Stock.objects.filter(item_id=item_id, available__gte=quantities[item_id]).update(
+            available=F('available') - quantities[item_id],
+            reserved=F('reserved') + quantities[item_id]
+        )
+    ]
+    if short:
+        raise OutOfStock(list(Item.objects.filter(pk__in=short)))
+    StockReservation.objects.bulk_create([
+        StockReservation(payment=payment, item_id=item_id, quantity=quantities[item_id])
+        for item_id in tracked
+    ])
+
+def _settle(payment_ids, release):
+    holds = StockReservation.objects.filter(payment_id__in=payment_ids)
+    per_item = holds.values('item_id').annotate(quantity=Sum('quantity')).order_by('item_id')
+    for row in per_item:
+        changes = {'reserved': F('reserved') - row['quantity']}
+        if release:
+            changes['available'] = F('available') + row['quantity']
+        Stock.objects.filter(item_id=row['item_id']).update(**changes)
+    holds.delete()
+
+# Both run in the transaction that moved the order out of PENDING, so each
+# hold is settled exactly once.
+
+def commit_reservations(payment_ids):
+    _settle(payment_ids, release=False)
+
+def release_reservations(payment_ids):
+    _settle(payment_ids, release=True)
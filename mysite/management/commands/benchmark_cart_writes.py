@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import OperationalError
+
+from mysite.cart import CartService
+from mysite.models import Item
+
+PROFILES = (
+    ('stock', {'SQLITE_TUNED': 'false'}),
+    ('tuned', {'SQLITE_TUNED': 'true'}),
+)
+ITEM_COUNT = 20
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure cart-write throughput with N concurrent worker processes, on '
+        'the stock SQLite settings and on the SQLITE_TUNED profile. Runs '
+        'against throwaway database files, never the configured database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--ops', type=int, default=200, help='Cart operations per worker')
+        parser.add_argument('--worker', type=int, help='Internal: run as worker number N')
+        parser.add_argument('--seed', action='store_true', help='Internal: create the benchmark items')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            return self.seed()
+        if options['worker'] is not None:
+            return self.work(options['worker'], options['ops'])
+
+        self.stdout.write(f'{options["workers"]} workers x {options["ops"]} cart operations')
+        for name, env in PROFILES:
+            result = self.run_profile(env, options['workers'], options['ops'])
+            self.stdout.write(
+                f'{name:>6}: {result["ops"]:>6} ops in {result["seconds"]:.2f}s '
+                f'= {result["ops"] / result["seconds"]:8.1f} ops/s, '
+                f'{result["errors"]} "database is locked" errors'
+            )
+
+    def run_profile(self, profile_env, workers, ops):
+        manage = [sys.executable, str(settings.BASE_DIR / 'manage.py')]
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, **profile_env, DATABASE_URL=f'sqlite:///{directory}/bench.sqlite3')
+            subprocess.run(manage + ['migrate', '-v0'], env=env, check=True, stderr=subprocess.DEVNULL)
+            subprocess.run(manage + ['benchmark_cart_writes', '--seed'], env=env, check=True, stderr=subprocess.DEVNULL)
+
+            procs = [
+                subprocess.Popen(
+                    manage + ['benchmark_cart_writes', '--worker', str(n), '--ops', str(ops)],
+                    env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+                )
+                for n in range(workers)
+            ]
+            results = [json.loads(proc.communicate()[0].strip().splitlines()[-1]) for proc in procs]
+        # Wall time from the first worker starting its loop to the last one
+        # finishing, so interpreter and Django start-up are not counted.
+        return {
+            'ops': sum(r['ops'] for r in results),
+            'errors': sum(r['errors'] for r in results),
+            'seconds': max(r['end'] for r in results) - min(r['start'] for r in results),
+        }
+
+    def seed(self):
+        for n in range(ITEM_COUNT):
+            Item.objects.create(title=f'Bench {n}', category='Shirt', price=10 + n)
+
+    def work(self, number, ops):
+        user = get_user_model().objects.create_user(f'bench-{number}-{os.getpid()}')
+        service = CartService(user)
+        slugs = list(Item.objects.values_list('slug', flat=True))
+        done = errors = 0
+        start = time.time()
+        for n in range(ops):
+            slug = slugs[(number + n) % len(slugs)]
+            try:
+                # Adds build the cart up, every third operation takes a line away.
+                if n % 3 == 2:
+                    service.remove(slug)
+                else:
+                    service.add(slug)
+                done += 1
+            except OperationalError:
+                errors += 1
+        end = time.time()
+        self.stdout.write(json.dumps({'ops': done, 'errors': errors, 'start': start, 'end': end}))
@@ -0,0 +1,34 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from mysite.images import build_derivatives
+from mysite.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Build thumbnail, card and detail derivatives for every Item image'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--force', action='store_true', help='Rebuild derivatives that already exist')
+
+    def handle(self, *args, **options):
+        names = sorted(set(
+            Item.objects.exclude(image='').exclude(image__isnull=True).values_list('image', flat=True)
+        ))
+        force = [options['force']] * len(names)
+        started = time.monotonic()
+        built = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            results = executor.map(build_derivatives, names, force, chunksize=8)
+            for done, (name, count) in enumerate(zip(names, results), 1):
+                built += count
+                if done % 100 == 0:
+                    self.stdout.write(f'{done}/{len(names)} images')
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Built {built} derivatives for {len(names)} images in {elapsed:.1f}s.'
+        ))
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mysite.checkout import expire_pending_checkouts
+
+
+class Command(BaseCommand):
+    help = 'Settle checkouts left pending past STOCK_HOLD_SECONDS: complete the charged ones, fail the rest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--every', type=int, metavar='SECONDS', help='Keep sweeping at this interval instead of once')
+
+    def handle(self, *args, **options):
+        while True:
+            completed, failed = expire_pending_checkouts(batch_size=options['batch_size'])
+            self.stdout.write(f'Completed {completed} and failed {failed} pending checkout(s).')
+            if not options['every']:
+                return
+            time.sleep(options['every'])
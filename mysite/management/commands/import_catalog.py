@@ -0,0 +1,186 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from mysite.images import import_image
+from mysite.models import CATEGORY_CHOICE, LABEL_CHOICE, Item, build_item_slug, normalize_item_slug
+from mysite.page_cache import invalidate_product_page
+from mysite.search import rebuild_index
+from mysite.slugs import evict_items
+
+CATEGORIES = {value for value, _ in CATEGORY_CHOICE}
+LABELS = {value for value, _ in LABEL_CHOICE}
+UPDATE_FIELDS = ['title', 'price', 'discount_price', 'category', 'label', 'description', 'updated_at']
+
+
+def read_rows(path, file_format):
+    # Yields (row, location) pairs without ever holding the whole file.
+    with open(path, newline='', encoding='utf-8') as f:
+        if file_format == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield row, f'line {reader.line_num}'
+        else:
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        row = json.loads(line)
+                    except ValueError as e:
+                        row = e
+                    yield row, f'line {line_number}'
+
+
+def optional_int(value):
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
+def parse_row(row):
+    if isinstance(row, Exception):
+        raise ValueError(f'invalid JSON ({row})')
+    if not isinstance(row, dict):
+        raise ValueError('expected an object')
+    title = (row.get('title') or '').strip()
+    category = (row.get('category') or '').strip()
+    if not title:
+        raise ValueError('title is required')
+    if category not in CATEGORIES:
+        raise ValueError(f'unknown category {category!r}')
+    label = (row.get('label') or '').strip() or None
+    if label is not None and label not in LABELS:
+        raise ValueError(f'unknown label {label!r}')
+    price = optional_int(row.get('price'))
+    if price is None:
+        raise ValueError('price is required')
+    # A slug from the file is the upsert key, so it is only normalized (as
+    # the model would), never suffixed, and rows whose slug normalizes to
+    # nothing are skipped.
+    slug = (row.get('slug') or '').strip()
+    if slug:
+        slug = normalize_item_slug(slug)
+        if not slug:
+            raise ValueError(f'invalid slug {row.get("slug")!r}')
+    else:
+        slug = build_item_slug(category, title[:50])
+    return {
+        'title': title[:50],
+        'category': category,
+        'label': label,
+        'price': price,
+        'discount_price': optional_int(row.get('discount_price')),
+        'description': row.get('description') or None,
+        'slug': slug,
+        'image': (row.get('image') or '').strip(),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Stream Items from a CSV or JSONL file and upsert them by slug in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Image processes')
+        parser.add_argument('--image-root', help="Directory for relative image paths (default: the file's directory)")
+        parser.add_argument('--skip-images', action='store_true')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'No such file: {path}')
+        file_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        self.image_root = options['image_root'] or os.path.dirname(os.path.abspath(path))
+        self.totals = {'rows': 0, 'created': 0, 'updated': 0, 'skipped': 0, 'image_errors': 0}
+        self.started = time.monotonic()
+
+        executor = None
+        if not options['skip_images']:
+            # Fork the image workers before any query, with no open connection.
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=options['workers'])
+        try:
+            rows = read_rows(path, file_format)
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                self.import_batch(batch, executor)
+                self.report()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        # bulk_create skips the post_save hooks, so index everything at once.
+        rebuild_index()
+        self.report(final=True)
+
+    def import_batch(self, batch, executor):
+        items = {}
+        for row, where in batch:
+            self.totals['rows'] += 1
+            try:
+                fields = parse_row(row)
+            except (ValueError, TypeError) as e:
+                self.totals['skipped'] += 1
+                self.stderr.write(f'Skipped {where}: {e}')
+                continue
+            # A slug repeated within the batch keeps its last row, as a
+            # later batch would.
+            items[fields['slug']] = fields
+
+        images = {}
+        if executor is not None:
+            futures = {
+                slug: executor.submit(import_image, fields['image'], self.image_root)
+                for slug, fields in items.items() if fields['image']
+            }
+            for slug, future in futures.items():
+                try:
+                    images[slug] = future.result()
+                except Exception as e:
+                    self.totals['image_errors'] += 1
+                    self.stderr.write(f'Image for {slug!r} failed: {e}')
+
+        with_image, without_image = [], []
+        for slug, fields in items.items():
+            image = fields.pop('image')
+            item = Item(**fields)
+            if slug in images:
+                item.image = images[slug]
+                with_image.append(item)
+            else:
+                without_image.append(item)
+
+        with transaction.atomic():
+            existing = Item.objects.filter(slug__in=list(items)).count()
+            for objs, update_fields in ((with_image, UPDATE_FIELDS + ['image']), (without_image, UPDATE_FIELDS)):
+                if objs:
+                    Item.objects.bulk_create(
+                        objs,
+                        update_conflicts=True,
+                        unique_fields=['slug'],
+                        update_fields=update_fields
+                    )
+        self.totals['updated'] += existing
+        self.totals['created'] += len(items) - existing
+        for slug in items:
+            invalidate_product_page(slug)
+        evict_items(items)
+
+    def report(self, final=False):
+        elapsed = time.monotonic() - self.started
+        totals = self.totals
+        line = (
+            f'{totals["rows"]} rows in {elapsed:.1f}s ({totals["rows"] / max(elapsed, 1e-6):.0f} rows/s): '
+            f'{totals["created"]} created, {totals["updated"]} updated, {totals["skipped"]} skipped, '
+            f'{totals["image_errors"]} image errors'
+        )
+        self.stdout.write(self.style.SUCCESS(line) if final else line)
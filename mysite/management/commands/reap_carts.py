@@ -0,0 +1,33 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from mysite.cart import reap_idle_carts
+
+
+class Command(BaseCommand):
+    help = 'Delete carts idle for more than --days days, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CART_IDLE_DAYS)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0, metavar='SECONDS',
+                            help='Sleep between batches to leave room for other writers')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError('--days must be at least 1')
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        total_carts = total_lines = 0
+        for carts, lines in reap_idle_carts(cutoff, options['batch_size']):
+            total_carts += carts
+            total_lines += lines
+            self.stdout.write(f'Deleted {carts} carts and {lines} lines')
+            if options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Reaped {total_carts} carts idle since {cutoff:%Y-%m-%d %H:%M} and {total_lines} lines.'
+        ))
@@ -0,0 +1,52 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from mysite.models import Order
+from mysite.reports import rebuild_rows
+
+
+def date_argument(value):
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily sales rollups from the orders, a few days at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date_argument, help='First day (default: the first order)')
+        parser.add_argument('--end', type=date_argument, help='Last day, inclusive (default: today)')
+        parser.add_argument('--chunk-days', type=int, default=7)
+
+    def handle(self, *args, **options):
+        start = options['start']
+        if start is None:
+            first = Order.objects.filter(ordered=True).aggregate(first=Min('ordered_date'))['first']
+            if first is None:
+                self.stdout.write('No completed orders, nothing to do.')
+                return
+            start = first.date()
+        end = options['end'] or timezone.now().date()
+        if end < start:
+            raise CommandError('--end is before --start')
+        if options['chunk_days'] < 1:
+            raise CommandError('--chunk-days must be at least 1')
+
+        step = datetime.timedelta(days=options['chunk_days'])
+        day = start
+        while day <= end:
+            chunk_end = min(day + step, end + datetime.timedelta(days=1))
+            # Each chunk is replaced in its own transaction.
+            rows = rebuild_rows(
+                datetime.datetime.combine(day, datetime.time.min),
+                datetime.datetime.combine(chunk_end, datetime.time.min)
+            )
+            self.stdout.write(f'{day} to {chunk_end - datetime.timedelta(days=1)}: {rows} rollup rows')
+            day = chunk_end
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt sales rollups from {start} to {end}.'))
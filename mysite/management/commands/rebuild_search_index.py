@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from mysite.search import rebuild_index, search_backend_available
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Item full-text search index from scratch'
+
+    def handle(self, *args, **options):
+        if not search_backend_available():
+            self.stdout.write(self.style.WARNING('Full-text search is only available on SQLite, nothing to do.'))
+            return
+        count = rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} items.'))
@@ -0,0 +1,66 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mysite.assets import referenced_static_files, project_static_files
+
+
+class Command(BaseCommand):
+    help = (
+        'Report project static files that no template references. '
+        'With --prune, remove them (and their hashed and compressed copies) from STATIC_ROOT.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', action='store_true', help='Delete unreferenced files from STATIC_ROOT')
+
+    def handle(self, *args, **options):
+        # Only the project's own static dirs are considered, so files that
+        # apps like the admin bring along are never pruned.
+        static_dirs = [
+            str(d) for d in settings.STATICFILES_DIRS
+            if os.path.isdir(d) and os.path.abspath(d).startswith(str(settings.BASE_DIR))
+        ]
+        template_dirs = [d for engine in settings.TEMPLATES for d in engine.get('DIRS', [])]
+
+        files = project_static_files(static_dirs)
+        referenced = referenced_static_files(template_dirs, static_dirs)
+        unreferenced = sorted(name for name in files if name not in referenced)
+
+        used_bytes = sum(size for name, size in files.items() if name in referenced)
+        unused_bytes = sum(files[name] for name in unreferenced)
+        self.stdout.write(f'{len(files) - len(unreferenced)} referenced files, {used_bytes / 1024:.0f} KiB')
+        self.stdout.write(f'{len(unreferenced)} unreferenced files, {unused_bytes / 1024:.0f} KiB')
+        if options['verbosity'] > 1:
+            for name in unreferenced:
+                self.stdout.write(f'  {name}')
+
+        if options['prune']:
+            removed = self.prune(unreferenced)
+            self.stdout.write(self.style.SUCCESS(f'Removed {removed} files from {settings.STATIC_ROOT}.'))
+
+    def prune(self, unreferenced):
+        manifest_path = os.path.join(settings.STATIC_ROOT, 'staticfiles.json')
+        manifest = None
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        removed = 0
+        for name in unreferenced:
+            names = [name]
+            if manifest is not None and name in manifest['paths']:
+                names.append(manifest['paths'].pop(name))
+            for stored in names:
+                for suffix in ('', '.gz', '.br'):
+                    path = os.path.join(settings.STATIC_ROOT, stored + suffix)
+                    if os.path.isfile(path):
+                        os.remove(path)
+                        removed += 1
+
+        if manifest is not None:
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f)
+        return removed
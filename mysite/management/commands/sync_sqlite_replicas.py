@@ -0,0 +1,38 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from mysite.routers import PRIMARY
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database onto the configured SQLite read replicas'
+
+    def handle(self, *args, **options):
+        # By vendor, so the tuned backend (mysite.backends.sqlite3) counts too.
+        primary = settings.DATABASES[PRIMARY]
+        if connections[PRIMARY].vendor != 'sqlite':
+            raise CommandError('The primary database is not SQLite; use real replication instead.')
+        if not settings.DATABASE_REPLICAS:
+            self.stdout.write(self.style.WARNING('No replicas configured (REPLICA_DATABASE_URLS), nothing to do.'))
+            return
+
+        source = sqlite3.connect(primary['NAME'])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                replica = settings.DATABASES[alias]
+                if connections[alias].vendor != 'sqlite':
+                    self.stdout.write(self.style.WARNING(f'Skipping {alias}: not a SQLite database.'))
+                    continue
+                # Drop Django's handle so the copy is not made under an open connection.
+                connections[alias].close()
+                target = sqlite3.connect(replica['NAME'])
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(self.style.SUCCESS(f'Copied {primary["NAME"]} to {alias} ({replica["NAME"]}).'))
+        finally:
+            source.close()
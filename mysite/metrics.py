@@ -0,0 +1,176 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates
+
+# Minimal Prometheus-style histograms. Each worker process keeps its own
+# samples in memory. With METRICS_DIR set, every worker also dumps them to
+# METRICS_DIR/<pid>.json now and then, and the /metrics view merges those
+# files, so a scrape sees every process and not just the one answering it.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+class Registry:
+    flush_interval = 5
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.last_flush = 0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: {json.dumps(key): [list(counts), total] for key, (counts, total) in metric.samples.items()}
+                for name, metric in self.metrics.items()
+            }
+
+    def flush(self, force=False):
+        directory = settings.METRICS_DIR
+        now = time.monotonic()
+        if not directory or (not force and now - self.last_flush < self.flush_interval):
+            return
+        self.last_flush = now
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path, os.path.join(directory, f'{os.getpid()}.json'))
+
+    def collect(self):
+        directory = settings.METRICS_DIR
+        if not directory:
+            return self.snapshot()
+        self.flush(force=True)
+        merged = {}
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, samples in snapshot.items():
+                target = merged.setdefault(name, {})
+                for key, (counts, total) in samples.items():
+                    if key in target:
+                        target[key][0] = [a + b for a, b in zip(target[key][0], counts)]
+                        target[key][1] += total
+                    else:
+                        target[key] = [counts, total]
+        return merged
+
+    def render(self):
+        lines = []
+        collected = self.collect()
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, (counts, total) in sorted(collected.get(name, {}).items()):
+                labels = [(label, value) for label, value in json.loads(key)]
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + [("le", str(bound))])} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {total}')
+                lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for label, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=DURATION_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.samples = {}
+        self.registry = registry
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self.registry.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                sample = self.samples[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            sample[0][index] += 1
+            sample[1] += value
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time spent answering a request, per URL name.')
+REQUEST_QUERIES = Histogram('http_request_sql_queries', 'SQL queries executed per request.', QUERY_COUNT_BUCKETS)
+REQUEST_SQL_TIME = Histogram('http_request_sql_duration_seconds', 'Time spent in SQL per request.')
+TEMPLATE_RENDER = Histogram('template_render_duration_seconds', 'Time spent rendering a top-level template.')
+STRIPE_LATENCY = Histogram('stripe_request_duration_seconds', 'Latency of Stripe API calls by operation and outcome.')
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+# The timer of the request being served. A context variable rather than a
+# per-request execute_wrapper, so queries made from sync_to_async threads
+# on behalf of an async view are counted too.
+current_query_timer = ContextVar('current_query_timer', default=None)
+
+def time_query(execute, sql, params, many, context):
+    timer = current_query_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.count += 1
+        timer.duration += time.perf_counter() - start
+
+def install_query_timer(sender, connection, **kwargs):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+connection_created.connect(install_query_timer)
+
+class TimedTemplate:
+    def __init__(self, template, name):
+        self.template = template
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.template, attr)
+
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            TEMPLATE_RENDER.observe(time.perf_counter() - start, template=self.name)
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    # Same engine as DjangoTemplates; templates returned by it time their
+    # own render(). Included templates count towards their parent.
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code), '<string>')
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name), template_name)
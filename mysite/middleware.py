@@ -0,0 +1,91 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import routers
+from .metrics import (
+    REGISTRY, REQUEST_LATENCY, REQUEST_QUERIES, REQUEST_SQL_TIME, QueryTimer, current_query_timer
+)
+
+class HybridMiddleware:
+    # Runs natively under both WSGI and ASGI, so async views are not pushed
+    # back onto a thread. Subclasses implement process_request(), whose
+    # return value is handed to process_response(); neither may touch the
+    # database.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = self.process_request(request)
+        return self.process_response(request, self.get_response(request), state)
+
+    async def __acall__(self, request):
+        state = self.process_request(request)
+        return self.process_response(request, await self.get_response(request), state)
+
+    def process_request(self, request):
+        return None
+
+    def process_response(self, request, response, state):
+        return response
+
+class GuestCartMiddleware(HybridMiddleware):
+    # Writes a guest cart changed during the request back to its cookie.
+    def process_response(self, request, response, state):
+        guest_cart = getattr(request, 'guest_cart', None)
+        if guest_cart is not None:
+            guest_cart.persist(response)
+        return response
+
+class MetricsMiddleware(HybridMiddleware):
+    def process_request(self, request):
+        timer = QueryTimer()
+        return time.perf_counter(), timer, current_query_timer.set(timer)
+
+    def process_response(self, request, response, state):
+        start, timer, token = state
+        duration = time.perf_counter() - start
+        current_query_timer.reset(token)
+
+        # Label by URL name, never by path, so 404 probes cannot blow up the
+        # number of series.
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        REQUEST_LATENCY.observe(duration, view=view, method=request.method, status=f'{response.status_code // 100}xx')
+        REQUEST_QUERIES.observe(timer.count, view=view)
+        REQUEST_SQL_TIME.observe(timer.duration, view=view)
+        REGISTRY.flush()
+        return response
+
+class ReplicaPinMiddleware(HybridMiddleware):
+    # Read-your-writes for the replica router: a request that wrote to the
+    # primary sets a short-lived cookie, and requests carrying it read from
+    # the primary only.
+    cookie_name = 'pin_primary'
+
+    def process_request(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return None
+        return routers.begin_request(pinned=self.cookie_name in request.COOKIES)
+
+    def process_response(self, request, response, state):
+        if state is None:
+            return response
+        request_state, token = state
+        routers.end_request(token)
+        if request_state.wrote:
+            response.set_cookie(
+                self.cookie_name, '1',
+                max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite='Lax'
+            )
+        return response
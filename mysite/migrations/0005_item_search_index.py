@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# FTS5 virtual tables backing mysite.search. They are plain (not external
+# content) tables keyed by the Item id, kept in sync by Item signals.
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS mysite_item_fts USING fts5("
+        "title, category, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS mysite_item_trigram USING fts5("
+        "title, category, tokenize='trigram')"
+    )
+    for table in ('mysite_item_fts', 'mysite_item_trigram'):
+        schema_editor.execute(
+            f'INSERT INTO {table} (rowid, title, category) '
+            'SELECT id, title, category FROM mysite_item'
+        )
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS mysite_item_fts')
+    schema_editor.execute('DROP TABLE IF EXISTS mysite_item_trigram')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0004_alter_userprofile_user'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
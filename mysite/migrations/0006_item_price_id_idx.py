@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0005_item_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['price', 'id'], name='mysite_item_price_id_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:16
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicate_carts(apps, schema_editor):
+    # The old cart views could leave several active orders per user, and
+    # active order items that no order points at. Fold them together so the
+    # unique constraints below can be created.
+    Order = apps.get_model('mysite', 'Order')
+    OrderItem = apps.get_model('mysite', 'OrderItem')
+
+    OrderItem.objects.filter(ordered=False, order__isnull=True).delete()
+
+    duplicate_orders = Order.objects.filter(ordered=False).values('user').annotate(
+        n=Count('id')
+    ).filter(n__gt=1)
+    for row in duplicate_orders:
+        orders = list(Order.objects.filter(user=row['user'], ordered=False).order_by('-start_date', '-id'))
+        keep = orders[0]
+        for extra in orders[1:]:
+            keep.items.add(*extra.items.all())
+            extra.delete()
+
+    duplicate_lines = OrderItem.objects.filter(ordered=False).values('user', 'item').annotate(
+        n=Count('id'), total=Sum('quantity')
+    ).filter(n__gt=1)
+    for row in duplicate_lines:
+        lines = list(OrderItem.objects.filter(user=row['user'], item=row['item'], ordered=False).order_by('id'))
+        lines[0].quantity = row['total']
+        lines[0].save()
+        OrderItem.objects.filter(pk__in=[line.pk for line in lines[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0006_item_price_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('ordered', False)), fields=('user',), name='unique_active_order'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('ordered', False)), fields=('user', 'item'), name='unique_active_order_item'),
+        ),
+    ]
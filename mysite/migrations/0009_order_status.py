@@ -0,0 +1,24 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:23
+
+from django.db import migrations, models
+
+
+def mark_completed_orders_paid(apps, schema_editor):
+    Order = apps.get_model('mysite', 'Order')
+    Order.objects.filter(ordered=True).update(status='S')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0008_item_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('C', 'Cart'), ('P', 'Payment pending'), ('S', 'Paid'), ('F', 'Payment failed')], default='C', max_length=1),
+        ),
+        migrations.RunPython(mark_completed_orders_paid, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:26
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_coupons(apps, schema_editor):
+    # AddCounponView already failed on duplicated codes; keep the oldest
+    # coupon for each code and point orders at it.
+    Coupon = apps.get_model('mysite', 'Coupon')
+    Order = apps.get_model('mysite', 'Order')
+
+    duplicates = Coupon.objects.values('code').annotate(n=Count('id')).filter(n__gt=1)
+    for row in duplicates:
+        ids = list(Coupon.objects.filter(code=row['code']).order_by('id').values_list('id', flat=True))
+        Order.objects.filter(coupon_id__in=ids[1:]).update(coupon_id=ids[0])
+        Coupon.objects.filter(id__in=ids[1:]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0009_order_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_coupons, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=25, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'address_type', 'default'], name='mysite_address_default_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered'], name='mysite_order_user_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['user', 'item', 'ordered'], name='mysite_orderitem_user_item_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('refrence_key__isnull', False)), fields=('refrence_key',), name='unique_order_refrence_key'),
+        ),
+    ]
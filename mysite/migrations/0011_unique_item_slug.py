@@ -0,0 +1,30 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:39
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def rename_duplicate_slugs(apps, schema_editor):
+    # Items sharing a category and title got the same slug; keep it on the
+    # oldest one and suffix the others with their id.
+    Item = apps.get_model('mysite', 'Item')
+    duplicates = Item.objects.exclude(slug=None).values('slug').annotate(n=Count('id')).filter(n__gt=1)
+    for row in duplicates:
+        for item in Item.objects.filter(slug=row['slug']).order_by('id')[1:]:
+            Item.objects.filter(pk=item.pk).update(slug=f'{item.slug}-{item.pk}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0010_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='item',
+            name='slug',
+            field=models.SlugField(blank=True, null=True, unique=True),
+        ),
+    ]
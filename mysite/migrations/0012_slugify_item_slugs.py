@@ -0,0 +1,30 @@
+from django.db import migrations
+from django.utils.text import slugify
+
+
+def slugify_existing(apps, schema_editor):
+    # Slugs used to be '<category>-<title>' verbatim, spaces and case included.
+    Item = apps.get_model('mysite', 'Item')
+    taken = set(Item.objects.exclude(slug=None).values_list('slug', flat=True))
+    for item in Item.objects.order_by('pk').iterator():
+        if item.slug and slugify(item.slug) == item.slug:
+            continue
+        base = slugify(item.slug or f'{item.category}-{item.title}')[:44].strip('-') or 'item'
+        candidate, n = base, 1
+        while candidate in taken:
+            n += 1
+            candidate = f'{base}-{n}'
+        taken.discard(item.slug)
+        taken.add(candidate)
+        Item.objects.filter(pk=item.pk).update(slug=candidate)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0011_unique_item_slug'),
+    ]
+
+    operations = [
+        migrations.RunPython(slugify_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0012_slugify_item_slugs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('category', models.CharField(choices=[('Shirt', 'Shirt'), ('Pant', 'Pant'), ('T-Shirt', 'T-Shirt')], max_length=50)),
+                ('units', models.IntegerField(default=0)),
+                ('gross', models.IntegerField(default=0)),
+                ('discount', models.IntegerField(default=0)),
+                ('coupon', models.IntegerField(default=0)),
+                ('refunds', models.IntegerField(default=0)),
+                ('item', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='mysite.item')),
+            ],
+            options={
+                'verbose_name_plural': 'Daily sales',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailysales',
+            constraint=models.UniqueConstraint(fields=('date', 'category', 'item'), name='unique_daily_sales'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0013_daily_sales'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Stock',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock', serialize=False, to='mysite.item')),
+                ('available', models.IntegerField(default=0)),
+                ('reserved', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mysite.item')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='mysite.payment')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='stock',
+            constraint=models.CheckConstraint(check=models.Q(('available__gte', 0)), name='stock_available_gte_0'),
+        ),
+        migrations.AddConstraint(
+            model_name='stock',
+            constraint=models.CheckConstraint(check=models.Q(('reserved__gte', 0)), name='stock_reserved_gte_0'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:48
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def backfill_last_activity(apps, schema_editor):
+    # Existing carts have no better record of activity than their start.
+    Order = apps.get_model('mysite', 'Order')
+    Order.objects.update(last_activity=F('start_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0014_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_last_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['ordered', 'last_activity'], name='mysite_order_activity_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    # Step 1 of replacing Order.items (M2M) with OrderItem.order. The FK is
+    # nullable and uses a temporary reverse name until the M2M is gone.
+
+    dependencies = [
+        ('mysite', '0015_order_last_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='mysite.order'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_discount_price',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,97 @@
+from django.db import migrations, transaction
+from django.db.models import Count, Min, Sum
+
+BATCH_SIZE = 1000
+
+
+def move_lines(apps, schema_editor):
+    # Batches of M2M rows, each in its own transaction, so the tables are
+    # never locked for long. A line linked to several orders keeps the first.
+    Order = apps.get_model('mysite', 'Order')
+    OrderItem = apps.get_model('mysite', 'OrderItem')
+    Through = Order.items.through
+    db = schema_editor.connection.alias
+
+    last = 0
+    while True:
+        with transaction.atomic(using=db):
+            links = list(
+                Through.objects.using(db).filter(pk__gt=last).order_by('pk')
+                .values_list('pk', 'order_id', 'orderitem_id')[:BATCH_SIZE]
+            )
+            if not links:
+                break
+            last = links[-1][0]
+            lines = OrderItem.objects.using(db).in_bulk([line_id for _, _, line_id in links])
+            for _, order_id, line_id in links:
+                if lines[line_id].order_id is None:
+                    lines[line_id].order_id = order_id
+            OrderItem.objects.using(db).bulk_update(lines.values(), ['order'])
+
+    # Lines in no order were never reachable; the FK becomes required.
+    while True:
+        with transaction.atomic(using=db):
+            orphans = list(OrderItem.objects.using(db).filter(order=None).values_list('pk', flat=True)[:BATCH_SIZE])
+            if not orphans:
+                break
+            OrderItem.objects.using(db).filter(pk__in=orphans).delete()
+
+    # One line per item and order from now on.
+    duplicates = (
+        OrderItem.objects.using(db).values('order_id', 'item_id')
+        .annotate(n=Count('pk'), quantity=Sum('quantity'), keep=Min('pk')).filter(n__gt=1)
+    )
+    for row in duplicates:
+        with transaction.atomic(using=db):
+            OrderItem.objects.using(db).filter(pk=row['keep']).update(quantity=row['quantity'])
+            OrderItem.objects.using(db).filter(
+                order_id=row['order_id'], item_id=row['item_id']
+            ).exclude(pk=row['keep']).delete()
+
+
+def snapshot_completed_orders(apps, schema_editor):
+    # Past orders have no record of what was paid; today's prices are the
+    # best approximation, and at least they stop moving from here on.
+    Order = apps.get_model('mysite', 'Order')
+    OrderItem = apps.get_model('mysite', 'OrderItem')
+    db = schema_editor.connection.alias
+
+    last = 0
+    while True:
+        with transaction.atomic(using=db):
+            orders = list(
+                Order.objects.using(db).filter(ordered=True, pk__gt=last).order_by('pk')
+                .select_related('coupon')[:BATCH_SIZE]
+            )
+            if not orders:
+                break
+            last = orders[-1].pk
+            lines = list(OrderItem.objects.using(db).filter(order__in=orders).select_related('item'))
+            totals = {order.pk: [0, 0] for order in orders}
+            for line in lines:
+                line.unit_price = line.item.price
+                line.unit_discount_price = line.item.discount_price
+                price = line.unit_price * line.quantity
+                totals[line.order_id][0] += price
+                totals[line.order_id][1] += line.unit_discount_price * line.quantity if line.unit_discount_price else price
+            for order in orders:
+                subtotal, items_total = totals[order.pk]
+                order.subtotal = subtotal
+                order.discount = subtotal - items_total
+                order.total = items_total - (order.coupon.amount if order.coupon else 0)
+            OrderItem.objects.using(db).bulk_update(lines, ['unit_price', 'unit_discount_price'])
+            Order.objects.using(db).bulk_update(orders, ['subtotal', 'discount', 'total'])
+
+
+class Migration(migrations.Migration):
+    # Step 2: copy the M2M rows onto OrderItem.order, batch by batch.
+    atomic = False
+
+    dependencies = [
+        ('mysite', '0016_orderitem_order'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_lines, migrations.RunPython.noop),
+        migrations.RunPython(snapshot_completed_orders, migrations.RunPython.noop),
+    ]
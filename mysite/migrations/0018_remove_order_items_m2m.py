@@ -0,0 +1,43 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    # Step 3: drop the M2M and the per-line user/ordered copies of what the
+    # order already says, then make the FK required.
+
+    dependencies = [
+        ('mysite', '0017_move_order_lines'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='orderitem',
+            name='unique_active_order_item',
+        ),
+        migrations.RemoveIndex(
+            model_name='orderitem',
+            name='mysite_orderitem_user_item_idx',
+        ),
+        migrations.RemoveField(
+            model_name='orderitem',
+            name='ordered',
+        ),
+        migrations.RemoveField(
+            model_name='orderitem',
+            name='user',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='items',
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='mysite.order'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('order', 'item'), name='unique_order_item'),
+        ),
+    ]
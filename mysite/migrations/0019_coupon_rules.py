@@ -0,0 +1,72 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:53
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def normalize_codes(apps, schema_editor):
+    # Codes are now matched case-insensitively. Codes that only differed in
+    # case collapse onto the oldest coupon, as 0010 did for exact duplicates,
+    # and completed orders so far count as redemptions.
+    Coupon = apps.get_model('mysite', 'Coupon')
+    Order = apps.get_model('mysite', 'Order')
+
+    groups = {}
+    for coupon in Coupon.objects.order_by('id'):
+        groups.setdefault(coupon.code.strip().upper(), []).append(coupon)
+    for code, coupons in groups.items():
+        keep, duplicates = coupons[0], [coupon.id for coupon in coupons[1:]]
+        if duplicates:
+            Order.objects.filter(coupon_id__in=duplicates).update(coupon_id=keep.id)
+            Coupon.objects.filter(id__in=duplicates).delete()
+        if keep.code != code:
+            Coupon.objects.filter(id=keep.id).update(code=code)
+
+    used = Order.objects.filter(ordered=True, coupon__isnull=False).values('coupon').annotate(n=Count('id'))
+    for row in used:
+        Coupon.objects.filter(id=row['coupon']).update(redemptions=row['n'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mysite', '0018_remove_order_items_m2m'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='kind',
+            field=models.CharField(choices=[('A', 'Fixed amount'), ('P', 'Percentage')], default='A', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_redemptions',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='redemptions',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_from',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(normalize_codes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='coupon',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('kind', 'P'), _negated=True), models.Q(('amount__gte', 0), ('amount__lte', 100)), _connector='OR'), name='coupon_percent_range'),
+        ),
+    ]
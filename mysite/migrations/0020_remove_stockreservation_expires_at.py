@@ -0,0 +1,19 @@
+# Generated by Django 4.1.7 on 2026-10-18 21:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Holds expire with their checkout, which the sweep finds by payment
+    # timestamp (checkout.expire_pending_checkouts).
+
+    dependencies = [
+        ('mysite', '0019_coupon_rules'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='stockreservation',
+            name='expires_at',
+        ),
+    ]
@@ -1,7 +1,12 @@
 from django.conf import settings
 from django.db import models
 from django.shortcuts import reverse
+from django.db.models import F, Sum, Case, When, ExpressionWrapper, OuterRef, Subquery
+from django.db.models.functions import Coalesce, NullIf
 from django.db.models.signals import pre_save, post_save
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.text import slugify
 from django_countries.fields import CountryField
 
 # Create your models here.
@@ -23,6 +28,13 @@ ADDRESS_CHOICE = (
     ('B', 'Billing Address'),
 )
 
+ORDER_STATUS_CHOICE = (
+    ('C', 'Cart'),
+    ('P', 'Payment pending'),
+    ('S', 'Paid'),
+    ('F', 'Payment failed'),
+)
+
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     stripe_customer_id = models.CharField(max_length=50, blank=True, null=True)
@@ -39,8 +51,15 @@ class Item(models.Model):
     category = models.CharField(max_length=50, choices=CATEGORY_CHOICE)
     label = models.CharField(max_length=50, choices=LABEL_CHOICE, blank=True, null=True)
     description = models.TextField(blank=True, null=True)
-    slug = models.SlugField(blank=True, null=True)
+    slug = models.SlugField(blank=True, null=True, unique=True)
     image = models.ImageField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Backs the ('-price', '-id') listing and its keyset pagination.
+            models.Index(fields=['price', 'id'], name='mysite_item_price_id_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -64,32 +83,84 @@ class Item(models.Model):
         return reverse('mysite:remove', kwargs={ 'slug': self.slug })
 
 class OrderItem(models.Model):
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    order = models.ForeignKey('Order', on_delete=models.CASCADE, related_name='items')
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
-    ordered = models.BooleanField(default=False)
+    # Copied from the Item when checkout starts (Order.snapshot_prices), so
+    # the order keeps the prices that were charged. Open carts leave them
+    # empty and follow the live Item prices.
+    unit_price = models.IntegerField(blank=True, null=True)
+    unit_discount_price = models.IntegerField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'item'], name='unique_order_item'),
+        ]
 
     def __str__(self):
         return f'{self.quantity} of {self.item.title}'
+
+    @property
+    def price(self):
+        return self.item.price if self.unit_price is None else self.unit_price
+
+    @property
+    def discount_price(self):
+        return self.item.discount_price if self.unit_price is None else self.unit_discount_price
     
     def calculate_total_price(self):
-        return self.item.price * self.quantity
+        return self.price * self.quantity
     
     def calculate_total_discount_price(self):
-        return self.item.discount_price * self.quantity
+        return self.discount_price * self.quantity
     
     def calculate_amount_saved(self):
         return self.calculate_total_price() - self.calculate_total_discount_price()
     
     def get_order_item_total_price(self):
-        if self.item.discount_price:
+        if self.discount_price:
             return self.calculate_total_discount_price()
         return self.calculate_total_price()
     
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        # One aggregate over OrderItem -> Item instead of a query per line.
+        # A discount_price of 0 counts as "no discount", like get_order_item_total_price.
+        # Lines with a price snapshot use it, like OrderItem.price; the others
+        # follow the live Item prices.
+        price = Coalesce(F('items__unit_price'), F('items__item__price'))
+        discount_price = Case(
+            When(items__unit_price__isnull=True, then=F('items__item__discount_price')),
+            default=F('items__unit_discount_price'),
+        )
+        line_price = ExpressionWrapper(
+            F('items__quantity') * price,
+            output_field=models.IntegerField()
+        )
+        line_total = ExpressionWrapper(
+            F('items__quantity') * Coalesce(NullIf(discount_price, 0), price),
+            output_field=models.IntegerField()
+        )
+        return self.annotate(
+            order_subtotal=Coalesce(Sum(line_price), 0),
+            order_items_total=Coalesce(Sum(line_total), 0),
+        ).annotate(
+            order_coupon=Case(
+                When(
+                    coupon__kind=Coupon.PERCENT,
+                    then=F('order_items_total') * F('coupon__amount') / 100
+                ),
+                default=Coalesce(F('coupon__amount'), 0),
+                output_field=models.IntegerField()
+            ),
+        )
+
+    def for_cart(self):
+        return self.with_totals().select_related('coupon').prefetch_related('items__item')
+
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     refrence_key = models.CharField(max_length=20, blank=True, null=True)
-    items = models.ManyToManyField(OrderItem)
     start_date = models.DateTimeField(auto_now_add=True)
     ordered_date = models.DateTimeField()
     ordered = models.BooleanField(default=False)
@@ -101,18 +172,97 @@ class Order(models.Model):
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
+    # 'C' and 'F' are open carts, 'P' is locked while the payment is finalized
+    # in the background (mysite.checkout), 'S' is a completed order.
+    status = models.CharField(max_length=1, choices=ORDER_STATUS_CHOICE, default='C')
+    # Last cart change, to the hour (CartService.touch); reap_carts uses it.
+    last_activity = models.DateTimeField(default=timezone.now)
+    # Saved with the line prices when checkout starts; cleared again if the
+    # payment fails.
+    subtotal = models.IntegerField(blank=True, null=True)
+    discount = models.IntegerField(blank=True, null=True)
+    total = models.IntegerField(blank=True, null=True)
 
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user'],
+                condition=models.Q(ordered=False),
+                name='unique_active_order'
+            ),
+            # CreateRefundView looks orders up by the key sent to the customer.
+            models.UniqueConstraint(
+                fields=['refrence_key'],
+                condition=models.Q(refrence_key__isnull=False),
+                name='unique_order_refrence_key'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'ordered'], name='mysite_order_user_ordered_idx'),
+            models.Index(fields=['ordered', 'last_activity'], name='mysite_order_activity_idx'),
+        ]
 
     def __str__(self):
         return self.user.username
     
+    @cached_property
+    def totals(self):
+        # Memoized per instance, so repeated template calls cost nothing.
+        # Completed orders read their saved columns; orders loaded through
+        # with_totals() already carry the numbers.
+        if self.total is not None:
+            return {
+                'subtotal': self.subtotal,
+                'discount': self.discount,
+                'coupon': self.subtotal - self.discount - self.total,
+                'total': self.total,
+            }
+        if not hasattr(self, 'order_subtotal'):
+            values = Order.objects.filter(pk=self.pk).with_totals().values(
+                'order_subtotal', 'order_items_total', 'order_coupon'
+            ).get()
+            self.order_subtotal = values['order_subtotal']
+            self.order_items_total = values['order_items_total']
+            self.order_coupon = values['order_coupon']
+        return {
+            'subtotal': self.order_subtotal,
+            'discount': self.order_subtotal - self.order_items_total,
+            'coupon': self.order_coupon,
+            'total': self.order_items_total - self.order_coupon,
+        }
+
+    def calculate_order_subtotal(self):
+        return self.totals['subtotal']
+
+    def calculate_order_discount(self):
+        return self.totals['discount']
+
+    def calculate_order_coupon(self):
+        return self.totals['coupon']
+
     def calculate_order_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_order_item_total_price()
-        if self.coupon:
-            total -= self.coupon.amount
-        return total
+        return self.totals['total']
+
+    def snapshot_prices(self):
+        # Copies the live Item prices onto the lines, then the totals computed
+        # from those copies onto the order. Called by checkout.initiate_payment
+        # under the order lock, so the amount charged, the saved totals and the
+        # sales rollups all come from the same prices.
+        item = Item.objects.filter(pk=OuterRef('item_id'))
+        self.items.update(
+            unit_price=Subquery(item.values('price')[:1]),
+            unit_discount_price=Subquery(item.values('discount_price')[:1]),
+        )
+        totals = Order.objects.filter(pk=self.pk).with_totals().values(
+            'order_subtotal', 'order_items_total', 'order_coupon'
+        ).get()
+        self.subtotal = totals['order_subtotal']
+        self.discount = totals['order_subtotal'] - totals['order_items_total']
+        self.total = totals['order_items_total'] - totals['order_coupon']
+        Order.objects.filter(pk=self.pk).update(subtotal=self.subtotal, discount=self.discount, total=self.total)
+        self.__dict__.pop('totals', None)
 
 class Address(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -126,6 +276,10 @@ class Address(models.Model):
     class Meta:
         verbose_name = 'Address'
         verbose_name_plural = 'Addresses'
+        indexes = [
+            # CheckoutView's default shipping/billing address lookups.
+            models.Index(fields=['user', 'address_type', 'default'], name='mysite_address_default_idx'),
+        ]
 
     def __str__(self):
         return self.user.username
@@ -139,12 +293,58 @@ class Payment(models.Model):
     def __str__(self):
         return self.user.username
 
+def normalize_coupon_code(code):
+    return code.strip().upper()
+
 class Coupon(models.Model):
-    code = models.CharField(max_length=25)
+    FIXED = 'A'
+    PERCENT = 'P'
+    KIND_CHOICE = (
+        (FIXED, 'Fixed amount'),
+        (PERCENT, 'Percentage'),
+    )
+
+    # Stored normalized (pre_coupon_save_signal), so lookups hit the unique index.
+    code = models.CharField(max_length=25, unique=True)
+    kind = models.CharField(max_length=1, choices=KIND_CHOICE, default=FIXED)
+    # Dollars off for FIXED, percent off the discounted items for PERCENT.
     amount = models.IntegerField()
+    active = models.BooleanField(default=True)
+    valid_from = models.DateTimeField(blank=True, null=True)
+    valid_until = models.DateTimeField(blank=True, null=True)
+    max_redemptions = models.PositiveIntegerField(blank=True, null=True)
+    # Taken when a checkout starts (checkout.initiate_payment), given back if it fails.
+    redemptions = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=~models.Q(kind='P') | models.Q(amount__gte=0, amount__lte=100),
+                name='coupon_percent_range',
+            ),
+        ]
 
     def __str__(self):
         return self.code
+
+    def clean(self):
+        # Normalized before validate_unique, so forms report a clash with an
+        # existing code instead of hitting the unique index.
+        if self.code:
+            self.code = normalize_coupon_code(self.code)
+
+    def unavailable_reason(self, now=None):
+        # None when the coupon can be applied right now.
+        now = now or timezone.now()
+        if not self.active:
+            return 'This coupon is no longer active.'
+        if self.valid_from and now < self.valid_from:
+            return 'This coupon is not valid yet.'
+        if self.valid_until and now >= self.valid_until:
+            return 'This coupon has expired.'
+        if self.max_redemptions is not None and self.redemptions >= self.max_redemptions:
+            return 'This coupon has been fully redeemed.'
+        return None
     
 class Refund(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True)
@@ -156,12 +356,88 @@ class Refund(models.Model):
     def __str__(self):
         return f'{self.email}'
 
+class Stock(models.Model):
+    # Items without a Stock row are not tracked and never run out.
+    # `available` is what can still be reserved; `reserved` is held by
+    # checkouts whose payment is pending (see mysite.inventory).
+    item = models.OneToOneField(Item, on_delete=models.CASCADE, primary_key=True, related_name='stock')
+    available = models.IntegerField(default=0)
+    reserved = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(check=models.Q(available__gte=0), name='stock_available_gte_0'),
+            models.CheckConstraint(check=models.Q(reserved__gte=0), name='stock_reserved_gte_0'),
+        ]
+
+    def __str__(self):
+        return f'{self.item_id}: {self.available} available, {self.reserved} reserved'
+
+class StockReservation(models.Model):
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='reservations')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f'{self.quantity} of {self.item_id} for payment {self.payment_id}'
+
+class DailySales(models.Model):
+    # Maintained incrementally by mysite.reports.
+    date = models.DateField()
+    category = models.CharField(max_length=50, choices=CATEGORY_CHOICE)
+    # No constraint, so the history outlives deleted Items.
+    item = models.ForeignKey(Item, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    units = models.IntegerField(default=0)
+    gross = models.IntegerField(default=0)
+    discount = models.IntegerField(default=0)
+    coupon = models.IntegerField(default=0)
+    refunds = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'Daily sales'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'category', 'item'], name='unique_daily_sales'),
+        ]
+
+    def __str__(self):
+        return f'{self.date} {self.category}'
+
+    @property
+    def net(self):
+        return self.gross - self.discount - self.coupon - self.refunds
+
+def normalize_item_slug(value):
+    # Leaves room in the 50 characters for a collision suffix. Also applied
+    # by import_catalog to slugs given in the file.
+    return slugify(value)[:44].strip('-')
+
+def build_item_slug(category, title):
+    # Also used by import_catalog, which bulk-creates Items without signals.
+    return normalize_item_slug(f'{category}-{title}') or 'item'
+
+def unique_item_slug(slug, pk=None):
+    # One query for the slug and all its suffixed variants.
+    taken = set(
+        Item.objects.filter(slug__startswith=slug).exclude(pk=pk).values_list('slug', flat=True)
+    )
+    candidate, n = slug, 1
+    while candidate in taken:
+        n += 1
+        candidate = f'{slug}-{n}'
+    return candidate
+
 def pre_item_create_slug_signal(sender, instance, *args, **kwargs):
-    instance.slug = f'{instance.category.lower()}-{instance.title}'
+    # Only set once, so renaming an Item keeps its URLs and cart links.
+    if not instance.slug:
+        instance.slug = unique_item_slug(build_item_slug(instance.category, instance.title), instance.pk)
+
+def pre_coupon_save_signal(sender, instance, *args, **kwargs):
+    instance.code = normalize_coupon_code(instance.code)
 
 def post_user_profile_create_signal(sender, instance, created, *args, **kwargs):
     if created:
-        UserProfile.objects.create(user=isinstance)
+        UserProfile.objects.create(user=instance)
 
 pre_save.connect(pre_item_create_slug_signal, sender=Item)
+pre_save.connect(pre_coupon_save_signal, sender=Coupon)
 post_save.connect(post_user_profile_create_signal, sender=settings.AUTH_USER_MODEL)
\ No newline at end of file
@@ -0,0 +1,89 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.http import Http404
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import Item
+from .routers import PRIMARY
+
+# Product pages are cached as two entries per slug: the validators used for
+# conditional GETs and the rendered, user-independent product markup. The
+# navbar and messages are rendered around it on every request.
+#
+# The validators are always read from the primary and written through on
+# save, so they are authoritative. The markup may be rendered from a read
+# replica, but only cached when the replica has caught up with them.
+
+def _slug_digest(slug):
+    # Slugs may hold characters that are not valid in memcached keys.
+    return hashlib.md5(slug.encode()).hexdigest()
+
+def product_meta_key(slug):
+    return f'product-meta:{_slug_digest(slug)}'
+
+def product_html_key(slug):
+    return f'product-html:{_slug_digest(slug)}'
+
+async def aget_product_meta(slug):
+    key = product_meta_key(slug)
+    meta = await cache.aget(key)
+    if meta is None:
+        meta = await Item.objects.using(PRIMARY).filter(slug=slug).values('pk', 'updated_at').afirst()
+        if meta is None:
+            raise Http404('No Item matches the given query.')
+        await cache.aset(key, meta, settings.PRODUCT_PAGE_CACHE_TIMEOUT)
+    return meta
+
+async def aget_product_html(slug, meta):
+    key = product_html_key(slug)
+    html = await cache.aget(key)
+    if html is None:
+        item = await Item.objects.filter(pk=meta['pk']).afirst()
+        fresh = item is not None and item.updated_at == meta['updated_at']
+        if not fresh:
+            item = await Item.objects.using(PRIMARY).aget(pk=meta['pk'])
+        html = render_to_string('shopping/product-detail.html', {'item': item})
+        if fresh:
+            await cache.aset(key, html, settings.PRODUCT_PAGE_CACHE_TIMEOUT)
+    return mark_safe(html)
+
+def product_etag(request, slug, meta, cart_summary):
+    # The navbar is part of the page, so the validator covers the visitor's
+    # identity and cart badge as well as the item itself.
+    user = request.user
+    if user.is_authenticated:
+        visitor = f'{user.pk}:{cart_summary["item_count"]}'
+    else:
+        visitor = f'guest:{request.COOKIES.get("guest_cart", "")}'
+    raw = f'{slug}:{meta["pk"]}:{meta["updated_at"].isoformat()}:{visitor}'
+    return '"' + hashlib.md5(raw.encode()).hexdigest() + '"'
+
+def has_pending_messages(request):
+    return bool(request.COOKIES.get('messages')) or '_messages' in request.session
+
+def invalidate_product_page(slug):
+    if slug:
+        cache.delete_many([product_meta_key(slug), product_html_key(slug)])
+
+def pre_item_save_page_cache_signal(sender, instance, using, *args, **kwargs):
+    # An admin may have edited the slug, so drop the entries under the old one.
+    if instance.pk:
+        old_slug = Item.objects.using(using).filter(pk=instance.pk).values_list('slug', flat=True).first()
+        invalidate_product_page(old_slug)
+
+def post_item_save_page_cache_signal(sender, instance, *args, **kwargs):
+    invalidate_product_page(instance.slug)
+    if instance.slug:
+        meta = {'pk': instance.pk, 'updated_at': instance.updated_at}
+        cache.set(product_meta_key(instance.slug), meta, settings.PRODUCT_PAGE_CACHE_TIMEOUT)
+
+def post_item_change_page_cache_signal(sender, instance, *args, **kwargs):
+    invalidate_product_page(instance.slug)
+
+pre_save.connect(pre_item_save_page_cache_signal, sender=Item)
+post_save.connect(post_item_save_page_cache_signal, sender=Item)
+post_delete.connect(post_item_change_page_cache_signal, sender=Item)
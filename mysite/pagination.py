@@ -0,0 +1,159 @@
+import base64
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.core.exceptions import EmptyResultSet
+from django.db import DatabaseError, connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+class CachedCountPaginator(Paginator):
+    # COUNT(*) over the whole catalog is as expensive as the page itself,
+    # so remember it for a short while per distinct query.
+    count_timeout = 60
+
+    def count_key(self):
+        try:
+            sql = str(self.object_list.query)
+        except (AttributeError, EmptyResultSet):
+            return None
+        return 'paginator-count:' + hashlib.md5(sql.encode()).hexdigest()
+
+    @cached_property
+    def count(self):
+        key = self.count_key()
+        if key is None:
+            return super().count
+        count = cache.get(key)
+        if count is None:
+            count = super().count
+            cache.set(key, count, self.count_timeout)
+        return count
+
+    async def acount(self):
+        # Fills the count cached_property, so page() and friends need no
+        # further queries from async code.
+        if 'count' not in self.__dict__:
+            key = self.count_key()
+            count = await cache.aget(key) if key else None
+            if count is None:
+                count = await self.object_list.acount()
+                if key:
+                    await cache.aset(key, count, self.count_timeout)
+            self.__dict__['count'] = count
+        return self.count
+
+    async def apage(self, number):
+        await self.acount()
+        page = self.page(number)
+        page.object_list = [obj async for obj in page.object_list]
+        return page
+
+class EstimatedCountPaginator(CachedCountPaginator):
+    # For admin changelists over large tables: an unfiltered list takes its
+    # size from the database statistics (PostgreSQL's reltuples, SQLite's
+    # sqlite_stat1 after ANALYZE) instead of a COUNT(*). Small tables, filtered
+    # lists and missing statistics fall back to the cached exact count.
+    estimate_threshold = 10000
+
+    def estimated_count(self):
+        queryset = self.object_list
+        if getattr(queryset, 'query', None) is None or queryset.query.where or queryset.query.is_sliced:
+            return None
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        if connection.vendor == 'postgresql':
+            sql, params = 'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table]
+        elif connection.vendor == 'sqlite':
+            sql, params = 'SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table]
+        else:
+            return None
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+        except DatabaseError:
+            return None
+        if row is None:
+            return None
+        # sqlite_stat1.stat starts with the row count, e.g. '1000 1 1'.
+        return int(str(row[0]).split()[0])
+
+    @cached_property
+    def count(self):
+        estimate = self.estimated_count()
+        if estimate is not None and estimate >= self.estimate_threshold:
+            return estimate
+        return super().count
+
+def encode_cursor(item, direction):
+    raw = json.dumps([item.price, item.pk, direction]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        price, pk, direction = json.loads(raw)
+    except (ValueError, TypeError):
+        raise Http404('Invalid cursor')
+    if direction not in ('next', 'prev') or not isinstance(price, int) or not isinstance(pk, int):
+        raise Http404('Invalid cursor')
+    return price, pk, direction
+
+class KeysetPage:
+    cursor_mode = True
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+def keyset_queryset(queryset, cursor, per_page):
+    # Seeks on the (price, id) index instead of using OFFSET, for a listing
+    # ordered by ('-price', '-id'). No COUNT(*) is ever issued.
+    price, pk, direction = decode_cursor(cursor)
+    if direction == 'next':
+        queryset = queryset.filter(Q(price__lt=price) | Q(price=price, pk__lt=pk)).order_by('-price', '-pk')
+    else:
+        queryset = queryset.filter(Q(price__gt=price) | Q(price=price, pk__gt=pk)).order_by('price', 'pk')
+    return queryset[:per_page + 1], direction
+
+def keyset_page(rows, direction, per_page):
+    has_more = len(rows) > per_page
+    if direction == 'next':
+        rows = rows[:per_page]
+        has_next, has_previous = has_more, True
+    else:
+        rows = rows[:per_page][::-1]
+        has_next, has_previous = True, has_more
+
+    if not rows:
+        return KeysetPage([])
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor(rows[-1], 'next') if has_next else None,
+        previous_cursor=encode_cursor(rows[0], 'prev') if has_previous else None,
+    )
+
+def keyset_paginate(queryset, cursor, per_page):
+    queryset, direction = keyset_queryset(queryset, cursor, per_page)
+    return keyset_page(list(queryset), direction, per_page)
+
+async def akeyset_paginate(queryset, cursor, per_page):
+    queryset, direction = keyset_queryset(queryset, cursor, per_page)
+    return keyset_page([row async for row in queryset], direction, per_page)
@@ -0,0 +1,98 @@
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+
+from .models import DailySales, Order
+
+# Daily sales per (date, category, item), maintained as orders complete and
+# refunds are granted, so reports never touch Order or OrderItem. Amounts
+# are attributed to the day the order was placed, refunds included, which
+# keeps `manage.py rebuild_sales_rollups` able to reproduce them exactly.
+
+AMOUNT_FIELDS = ('units', 'gross', 'discount', 'coupon', 'refunds')
+
+def completed_orders():
+    return Order.objects.filter(ordered=True).prefetch_related('items__item')
+
+def order_rows(order, sale=True, refund=False):
+    # {(date, category, item_id): {field: amount}} for one completed order.
+    # The coupon is spread over the lines pro rata to what they cost after
+    # discounts, the rounding remainder going to the last line.
+    lines = list(order.items.all())
+    if not lines:
+        return {}
+    totals = [line.get_order_item_total_price() for line in lines]
+    coupon = order.calculate_order_coupon()
+    items_total = sum(totals)
+    shares = [coupon * total // items_total if items_total else 0 for total in totals]
+    shares[-1] += coupon - sum(shares)
+
+    day = order.ordered_date.date()
+    rows = defaultdict(lambda: dict.fromkeys(AMOUNT_FIELDS, 0))
+    for line, total, share in zip(lines, totals, shares):
+        row = rows[day, line.item.category, line.item_id]
+        if sale:
+            gross = line.calculate_total_price()
+            row['units'] += line.quantity
+            row['gross'] += gross
+            row['discount'] += gross - total
+            row['coupon'] += share
+        if refund:
+            row['refunds'] += total - share
+    return rows
+
+def apply_rows(rows):
+    # Adds the amounts to existing rollup rows, creating missing ones.
+    for (day, category, item_id), amounts in rows.items():
+        amounts = {field: value for field, value in amounts.items() if value}
+        if not amounts:
+            continue
+        key = {'date': day, 'category': category, 'item_id': item_id}
+        increments = {field: F(field) + value for field, value in amounts.items()}
+        if DailySales.objects.filter(**key).update(**increments):
+            continue
+        try:
+            with transaction.atomic():
+                DailySales.objects.create(**key, **amounts)
+        except IntegrityError:
+            # Created concurrently by another order of the same day.
+            DailySales.objects.filter(**key).update(**increments)
+
+def record_sale(order_id):
+    apply_rows(order_rows(completed_orders().get(pk=order_id)))
+
+def merge_rows(row_sets):
+    # Sums several order_rows() results into one, key by key.
+    merged = defaultdict(lambda: dict.fromkeys(AMOUNT_FIELDS, 0))
+    for rows in row_sets:
+        for key, amounts in rows.items():
+            for field, value in amounts.items():
+                merged[key][field] += value
+    return merged
+
+def record_refunds(order_ids):
+    # One write per (date, category, item) touched, however many orders.
+    orders = completed_orders().filter(pk__in=order_ids)
+    apply_rows(merge_rows(order_rows(order, sale=False, refund=True) for order in orders))
+
+def rebuild_rows(start, end):
+    # Recomputes [start, end) from the orders, replacing what is stored.
+    orders = completed_orders().filter(ordered_date__gte=start, ordered_date__lt=end)
+    rows = merge_rows(order_rows(order, refund=order.refund_granted) for order in orders.iterator(chunk_size=500))
+    with transaction.atomic():
+        DailySales.objects.filter(date__gte=start.date(), date__lt=end.date()).delete()
+        DailySales.objects.bulk_create([
+            DailySales(date=day, category=category, item_id=item_id, **amounts)
+            for (day, category, item_id), amounts in rows.items()
+        ], batch_size=500)
+    return len(rows)
+
+def sales_report(start, end):
+    # Per day and category, from the rollups only.
+    return (
+        DailySales.objects.filter(date__gte=start, date__lte=end)
+        .values('date', 'category')
+        .annotate(**{field: Sum(field) for field in AMOUNT_FIELDS})
+        .order_by('-date', 'category')
+    )
@@ -0,0 +1,64 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# Catalog reads (Item queries made by the list, detail and search views) may
+# go to the replicas in settings.DATABASE_REPLICAS. Everything else, and any
+# request from a visitor who wrote in the last REPLICA_PIN_SECONDS, stays on
+# the primary so carts and checkouts always see their own writes.
+
+PRIMARY = 'default'
+CATALOG_MODELS = {'mysite.item'}
+
+_catalog_reads = ContextVar('catalog_reads', default=False)
+_request_state = ContextVar('replica_request_state', default=None)
+
+class RequestState:
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+@contextmanager
+def catalog_reads():
+    token = _catalog_reads.set(True)
+    try:
+        yield
+    finally:
+        _catalog_reads.reset(token)
+
+def begin_request(pinned):
+    state = RequestState(pinned)
+    return state, _request_state.set(state)
+
+def end_request(token):
+    _request_state.reset(token)
+
+def pick_replica():
+    replicas = settings.DATABASE_REPLICAS
+    if not replicas:
+        return PRIMARY
+    return random.choices(list(replicas), weights=list(replicas.values()))[0]
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _catalog_reads.get() or model._meta.label_lower not in CATALOG_MODELS:
+            return PRIMARY
+        state = _request_state.get()
+        if state is not None and state.pinned:
+            return PRIMARY
+        return pick_replica()
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None and model._meta.app_label != 'sessions':
+            state.pinned = state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
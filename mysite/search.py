@@ -0,0 +1,118 @@
+import re
+
+from django.db import connection, connections, router, transaction
+from django.db.models import Q, Case, When, IntegerField
+from django.db.models.signals import post_save, post_delete
+
+from .models import Item
+
+# SQLite FTS5 tables created by migration 0005. The word table answers prefix
+# queries ("shi" -> "Shirt"), the trigram table answers substring queries the
+# old icontains search used to match ("hirt" -> "T-Shirt").
+FTS_TABLE = 'mysite_item_fts'
+TRIGRAM_TABLE = 'mysite_item_trigram'
+SEARCH_TABLES = (FTS_TABLE, TRIGRAM_TABLE)
+
+# bm25() column weights: a hit in the title ranks above a hit in the category.
+TITLE_WEIGHT = 10.0
+CATEGORY_WEIGHT = 2.0
+
+def search_backend_available():
+    return connection.vendor == 'sqlite'
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def prefix_expression(query):
+    terms = re.findall(r'\w+', query.lower())
+    return ' '.join(f'{_quote(term)}*' for term in terms)
+
+def trigram_expression(query):
+    query = query.strip()
+    if len(query) < 3:
+        return ''
+    return _quote(query)
+
+def _ranked_ids(table, expression, limit=None, using=None):
+    if not expression:
+        return []
+    sql = (
+        f'SELECT rowid FROM {table} WHERE {table} MATCH %s '
+        f'ORDER BY bm25({table}, {TITLE_WEIGHT}, {CATEGORY_WEIGHT})'
+    )
+    params = [expression]
+    if limit:
+        sql += ' LIMIT %s'
+        params.append(limit)
+    with connections[using or router.db_for_read(Item)].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+def search_item_ids(query, limit=None, using=None):
+    ids = _ranked_ids(FTS_TABLE, prefix_expression(query), limit, using)
+    if not ids:
+        ids = _ranked_ids(TRIGRAM_TABLE, trigram_expression(query), limit, using)
+    return ids
+
+def search_items(query, queryset=None, limit=None):
+    if queryset is None:
+        queryset = Item.objects.all()
+    if not search_backend_available():
+        qs = queryset.filter(
+            Q(title__icontains=query) |
+            Q(category__icontains=query)
+        )
+        return qs[:limit] if limit else qs
+
+    # Rank and fetch from the same database, so both see the same rows
+    # when catalog reads are spread over replicas.
+    using = router.db_for_read(Item)
+    ids = search_item_ids(query, limit, using)
+    if not ids:
+        return queryset.none()
+    rank = Case(
+        *[When(pk=pk, then=position) for position, pk in enumerate(ids)],
+        output_field=IntegerField()
+    )
+    return queryset.using(using).filter(pk__in=ids).order_by(rank)
+
+def index_item(item):
+    if not search_backend_available():
+        return
+    with connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [item.pk])
+            cursor.execute(
+                f'INSERT INTO {table} (rowid, title, category) VALUES (%s, %s, %s)',
+                [item.pk, item.title, item.category]
+            )
+
+def unindex_item(item_id):
+    if not search_backend_available():
+        return
+    with connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [item_id])
+
+def rebuild_index():
+    if not search_backend_available():
+        return 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            cursor.execute(f'DELETE FROM {table}')
+            cursor.execute(
+                f'INSERT INTO {table} (rowid, title, category) '
+                f'SELECT id, title, category FROM {Item._meta.db_table}'
+            )
+            cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+        cursor.execute(f'SELECT count(*) FROM {FTS_TABLE}')
+        return cursor.fetchone()[0]
+
+def post_item_save_index_signal(sender, instance, *args, **kwargs):
+    index_item(instance)
+
+def post_item_delete_index_signal(sender, instance, *args, **kwargs):
+    unindex_item(instance.pk)
+
+post_save.connect(post_item_save_index_signal, sender=Item)
+post_delete.connect(post_item_delete_index_signal, sender=Item)
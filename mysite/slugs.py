@@ -0,0 +1,36 @@
+import copy
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.http import Http404
+
+from .lru import LRUCache
+from .models import Item
+
+# Cart clicks resolve the slug in their URL to an Item. Slugs do not change
+# once set, so each process keeps the most recently used Items in a bounded
+# LRU. Saves and deletes evict entries in the process that made them; other
+# processes see the change after ITEM_SLUG_CACHE_TIMEOUT seconds at most.
+
+slug_cache = LRUCache(settings.ITEM_SLUG_CACHE_SIZE, settings.ITEM_SLUG_CACHE_TIMEOUT)
+
+def resolve_item(slug):
+    # Returns a copy, so callers may set attributes on it freely.
+    item = slug_cache.get(slug)
+    if item is None:
+        item = Item.objects.filter(slug=slug).first()
+        if item is None:
+            raise Http404('No Item matches the given query.')
+        slug_cache.set(slug, item)
+    return copy.copy(item)
+
+def evict_items(slugs=(), pks=()):
+    slugs, pks = set(slugs), set(pks)
+    slug_cache.discard(lambda slug, item: slug in slugs or item.pk in pks)
+
+def post_item_change_slug_cache_signal(sender, instance, *args, **kwargs):
+    # By pk as well, in case an admin edited the slug.
+    evict_items([instance.slug], [instance.pk])
+
+post_save.connect(post_item_change_slug_cache_signal, sender=Item)
+post_delete.connect(post_item_change_slug_cache_signal, sender=Item)
@@ -1,12 +1,29 @@
 from django import template
-from mysite.models import Order
+from mysite.cart import get_cart, get_cart_summary
 
 register = template.Library()
 
 @register.filter
 def cart_item_count(user):
-    qs = Order.objects.filter(user=user, ordered=False)
-    if qs.exists():
-        # print(qs[0].items.all())
-        return qs[0].items.count()
-    return 0
\ No newline at end of file
+    return get_cart_summary(user)['item_count']
+
+
+@register.filter
+def guest_cart_item_count(request):
+    # Read from the signed cookie, no queries.
+    if request.user.is_authenticated:
+        return cart_item_count(request.user)
+    return len(get_cart(request).lines)
+
+
+@register.simple_tag(takes_context=True)
+def cart_badge_count(context):
+    # Async views load the summary up front and pass it as `cart_summary`,
+    # since a template cannot query the database from the event loop. Sync
+    # views leave it out and get the cached lookup; guests always read their
+    # cookie.
+    request = context['request']
+    summary = context.get('cart_summary')
+    if summary is not None and request.user.is_authenticated:
+        return summary['item_count']
+    return guest_cart_item_count(request)
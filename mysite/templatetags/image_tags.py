@@ -0,0 +1,37 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+from mysite.images import DERIVATIVE_WIDTHS, derivative_name, derivatives_ready
+
+register = template.Library()
+
+SIZES = {
+    'thumb': '160px',
+    'card': '(min-width: 992px) 25vw, (min-width: 768px) 50vw, 100vw',
+    'detail': '(min-width: 768px) 50vw, 100vw',
+}
+
+def _srcset(name, ext):
+    return ', '.join(
+        f'{default_storage.url(derivative_name(name, size, ext))} {width}w'
+        for size, width in DERIVATIVE_WIDTHS.items()
+    )
+
+@register.simple_tag
+def item_image(item, size='card', css_class='', alt=''):
+    if not item.image:
+        return ''
+    name = item.image.name
+    if not derivatives_ready(name):
+        # Still being processed in the background, serve the original.
+        return format_html('<img src="{}" class="{}" alt="{}">', item.image.url, css_class, alt)
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" class="{}" alt="{}" loading="lazy">'
+        '</picture>',
+        _srcset(name, 'webp'), SIZES[size],
+        default_storage.url(derivative_name(name, size, 'jpg')), _srcset(name, 'jpg'), SIZES[size],
+        css_class, alt
+    )
@@ -0,0 +1,46 @@
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.urls import reverse
+
+# Stand-in for Stripe's webhook delivery, used by the tests and for trying the
+# checkout flow locally without a Stripe account.
+
+def fake_charge(payment, status='succeeded'):
+    return {
+        'id': f'ch_{uuid.uuid4().hex[:24]}',
+        'object': 'charge',
+        'amount': int(payment.amount * 100),
+        'currency': 'usd',
+        'status': status,
+        'metadata': {'payment_id': str(payment.pk)},
+    }
+
+class FakeStripeWebhookSender:
+    def __init__(self, client, secret=None):
+        self.client = client
+        self.secret = secret if secret is not None else settings.STRIPE_WEBHOOK_SECRET
+
+    def sign(self, payload, timestamp=None):
+        timestamp = timestamp or int(time.time())
+        signed = f'{timestamp}.{payload}'.encode()
+        signature = hmac.new(self.secret.encode(), signed, hashlib.sha256).hexdigest()
+        return f't={timestamp},v1={signature}'
+
+    def send(self, event_type, obj, signature=None):
+        payload = json.dumps({
+            'id': f'evt_{uuid.uuid4().hex[:24]}',
+            'object': 'event',
+            'type': event_type,
+            'data': {'object': obj},
+        })
+        return self.client.post(
+            reverse('mysite:stripe-webhook'),
+            payload,
+            content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=signature or self.sign(payload)
+        )
@@ -1,3 +1,1326 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from unittest import mock, skipUnless
+
+import stripe
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template import Context, Template
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import Http404
+from django.db import IntegrityError, OperationalError, connection
+from django.db.models import Sum
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .cart import CartService, get_cart_summary
+from .models import Item, OrderItem, Order, Coupon, Address, Payment, Refund, DailySales, Stock, StockReservation
+from .search import search_items, rebuild_index
+from .slugs import resolve_item, slug_cache
+from .coupons import CouponUnavailable, find_coupon, known_coupons, unknown_codes
+from .pagination import keyset_paginate, encode_cursor
+from .images import build_derivatives, derivative_name
+from .assets import compress_file, serve_static
+from .checkout import (
+    PENDING, PAID, FAILED, complete_order, expire_pending_checkouts, fail_order, initiate_payment, process_payment
+)
+from .inventory import OutOfStock
+from .testing import FakeStripeWebhookSender, fake_charge
+from .metrics import REGISTRY, REQUEST_LATENCY
+from .transactions import is_lock_error, retry_on_lock
+from .routers import ReplicaRouter, begin_request, catalog_reads, end_request
+from .gateway import CircuitBreaker, FakeGateway, GatewayUnavailable, StripeGateway, set_gateway
 
 # Create your tests here.
+
+User = get_user_model()
+
+
+def make_cart(user, lines, coupon=None):
+    order = Order.objects.create(user=user, ordered_date=timezone.now(), coupon=coupon)
+    for i in range(lines):
+        item = Item.objects.create(
+            title=f'Item {i}',
+            price=10 + i,
+            discount_price=8 + i if i % 2 else None,
+            category='Shirt'
+        )
+        OrderItem.objects.create(order=order, item=item, quantity=2)
+    return order
+
+
+class OrderTotalTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+
+    def test_totals_match_python_calculation(self):
+        coupon = Coupon.objects.create(code='TEN', amount=10)
+        order = make_cart(self.user, 5, coupon=coupon)
+        expected = sum(
+            order_item.get_order_item_total_price() for order_item in order.items.all()
+        ) - coupon.amount
+
+        annotated = Order.objects.with_totals().get(pk=order.pk)
+        self.assertEqual(annotated.calculate_order_total(), expected)
+        self.assertEqual(Order.objects.get(pk=order.pk).calculate_order_total(), expected)
+
+    def test_total_is_memoized(self):
+        order = Order.objects.get(pk=make_cart(self.user, 3).pk)
+        with self.assertNumQueries(1):
+            order.calculate_order_total()
+            order.calculate_order_total()
+            order.calculate_order_discount()
+
+    def test_completed_order_keeps_its_prices(self):
+        coupon = Coupon.objects.create(code='TEN', amount=10)
+        order = make_cart(self.user, 3, coupon=coupon)
+        expected = order.calculate_order_total()
+        order.snapshot_prices()
+        Item.objects.update(price=99, discount_price=None)
+
+        order = Order.objects.get(pk=order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.calculate_order_total(), expected)
+            self.assertEqual(order.calculate_order_subtotal(), 2 * (10 + 11 + 12))
+        line = order.items.select_related('item').get(item__title='Item 1')
+        self.assertEqual((line.price, line.discount_price), (11, 9))
+
+    def test_summary_page_query_count_is_constant(self):
+        self.client.force_login(self.user)
+        order = make_cart(self.user, 1)
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(reverse('mysite:order-summary'))
+
+        for i in range(20):
+            item = Item.objects.create(title=f'Extra {i}', price=5, category='Pant')
+            OrderItem.objects.create(order=order, item=item)
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(reverse('mysite:order-summary'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(small), len(large))
+
+
+class CartSummaryCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+
+    def test_summary_is_cached_until_cart_changes(self):
+        make_cart(self.user, 2)
+        with self.assertNumQueries(1):
+            get_cart_summary(self.user)
+        with self.assertNumQueries(0):
+            summary = get_cart_summary(self.user)
+        self.assertEqual(summary['item_count'], 2)
+        self.assertEqual(summary['quantity'], 4)
+
+        item = Item.objects.create(title='New', price=3, category='Pant')
+        self.client.force_login(self.user)
+        self.client.get(reverse('mysite:add-to-cart', kwargs={'slug': item.slug}))
+        self.assertEqual(get_cart_summary(self.user)['item_count'], 3)
+
+
+class ItemSearchTests(TestCase):
+    def setUp(self):
+        self.shirt = Item.objects.create(title='Blue Oxford', category='Shirt', price=20)
+        self.tee = Item.objects.create(title='Graphic Tee', category='T-Shirt', price=10)
+        self.pant = Item.objects.create(title='Chino', category='Pant', price=30)
+
+    def titles(self, query):
+        return [item.title for item in search_items(query)]
+
+    def test_prefix_and_substring_matches(self):
+        self.assertEqual(self.titles('chi'), ['Chino'])
+        self.assertCountEqual(self.titles('shirt'), ['Blue Oxford', 'Graphic Tee'])
+        self.assertEqual(self.titles('xfor'), ['Blue Oxford'])
+        self.assertEqual(self.titles('nothing'), [])
+
+    def test_title_hits_rank_first(self):
+        Item.objects.create(title='Shirt Jacket', category='Pant', price=50)
+        self.assertEqual(self.titles('shirt')[0], 'Shirt Jacket')
+
+    def test_index_follows_saves_and_deletes(self):
+        self.pant.title = 'Cargo'
+        self.pant.save()
+        self.assertEqual(self.titles('chino'), [])
+        self.assertEqual(self.titles('cargo'), ['Cargo'])
+        self.pant.delete()
+        self.assertEqual(self.titles('cargo'), [])
+
+    def test_listing_search_is_paginated_and_capped(self):
+        for i in range(150):
+            Item.objects.create(title=f'Shirt {i}', category='Shirt', price=i, image='shirt.jpg')
+        response = self.client.get(reverse('mysite:home'), {'search': 'shirt', 'page': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['items']), 8)
+        self.assertEqual(response.context['paginator'].count, 96)
+        self.assertContains(response, 'search=shirt')
+
+    def test_rebuild(self):
+        self.assertEqual(rebuild_index(), 3)
+        self.assertEqual(self.titles('graphic'), ['Graphic Tee'])
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        for i in range(10):
+            Item.objects.create(title=f'Item {i}', category='Shirt', price=i // 2)
+        self.ordered = list(Item.objects.order_by('-price', '-id'))
+
+    def test_walks_forward_and_back_without_gaps(self):
+        qs = Item.objects.all()
+        first = self.ordered[:3]
+        page = keyset_paginate(qs, encode_cursor(first[-1], 'next'), 3)
+        self.assertEqual(page.object_list, self.ordered[3:6])
+
+        seen = first + page.object_list
+        while page.has_next():
+            with self.assertNumQueries(1):
+                page = keyset_paginate(qs, page.next_cursor, 3)
+            seen += page.object_list
+        self.assertEqual(seen, self.ordered)
+
+        page = keyset_paginate(qs, page.previous_cursor, 3)
+        self.assertEqual(page.object_list, self.ordered[6:9])
+
+    def test_previous_reaches_start(self):
+        page = keyset_paginate(Item.objects.all(), encode_cursor(self.ordered[3], 'prev'), 3)
+        self.assertEqual(page.object_list, self.ordered[:3])
+        self.assertFalse(page.has_previous())
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        self.cart = CartService(self.user)
+        self.shirt = Item.objects.create(title='Oxford', category='Shirt', price=20)
+        self.pant = Item.objects.create(title='Chino', category='Pant', price=30)
+
+    def assertQueries(self, count, expected_status, func, *args):
+        # Cart writes run in autocommit, so there is no BEGIN (or test
+        # SAVEPOINT) to discount: this is every statement sent.
+        with self.assertNumQueries(count):
+            item, status = func(*args)
+        self.assertEqual(status, expected_status)
+
+    def test_add_and_increase(self):
+        self.assertQueries(3, CartService.ADDED, self.cart.add, self.shirt.slug)
+        self.assertQueries(2, CartService.ADDED, self.cart.add, self.pant.slug)
+        self.assertQueries(2, CartService.UPDATED, self.cart.add, self.shirt.slug)
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.count(), 2)
+        self.assertEqual(order.items.get(item=self.shirt).quantity, 2)
+
+    def test_decrease_and_remove(self):
+        self.assertQueries(1, CartService.NO_ORDER, self.cart.remove, self.pant.slug)
+        self.cart.add(self.shirt.slug)
+        self.cart.add(self.shirt.slug)
+        self.cart.add(self.pant.slug)
+
+        self.assertQueries(2, CartService.UPDATED, self.cart.decrease, self.shirt.slug)
+        self.assertQueries(2, CartService.REMOVED, self.cart.decrease, self.shirt.slug)
+        self.assertQueries(1, CartService.NOT_IN_CART, self.cart.decrease, self.shirt.slug)
+        self.assertQueries(3, CartService.EMPTIED, self.cart.remove, self.pant.slug)
+        self.assertQueries(1, CartService.NO_ORDER, self.cart.remove, self.pant.slug)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+        self.cart.add(self.shirt.slug)
+        self.cart.add(self.pant.slug)
+        self.assertQueries(2, CartService.REMOVED, self.cart.remove, self.shirt.slug)
+        Order.objects.update(status=PENDING)
+        self.assertQueries(1, CartService.LOCKED, self.cart.add, self.pant.slug)
+
+    def test_lost_race_is_retried(self):
+        self.cart.add(self.shirt.slug)
+        lookup = self.cart.lookup
+        calls = []
+
+        def stale_lookup(slug):
+            # The first call behaves as if the line did not exist yet.
+            item = lookup(slug)
+            if not calls:
+                item.line_id = None
+            calls.append(slug)
+            return item
+
+        self.cart.lookup = stale_lookup
+        self.assertEqual(self.cart.add(self.shirt.slug)[1], CartService.UPDATED)
+        self.assertEqual(OrderItem.objects.get(item=self.shirt).quantity, 2)
+        self.assertEqual(Order.objects.filter(user=self.user, ordered=False).count(), 1)
+
+    def test_writes_recheck_the_payment_lock(self):
+        self.cart.add(self.shirt.slug)
+        lookup = self.cart.lookup
+
+        def stale_lookup(slug):
+            # Checkout locks the cart between the lookup and the write.
+            item = lookup(slug)
+            Order.objects.filter(pk=item.order_id).update(status=PENDING)
+            item.order_status = 'C'
+            return item
+
+        self.cart.lookup = stale_lookup
+        for operation in (self.cart.add, self.cart.decrease, self.cart.remove):
+            self.assertEqual(operation(self.shirt.slug)[1], CartService.LOCKED)
+        self.assertEqual(self.cart.add(self.pant.slug)[1], CartService.LOCKED)
+        self.assertEqual(list(OrderItem.objects.values_list('item_id', 'quantity')), [(self.shirt.pk, 1)])
+
+    def test_merge_waits_while_the_cart_is_being_paid(self):
+        self.cart.add(self.shirt.slug)
+        Order.objects.filter(user=self.user).update(status=PENDING)
+        self.assertFalse(self.cart.merge({self.pant.pk: 2}))
+        self.assertFalse(OrderItem.objects.filter(item=self.pant).exists())
+
+
+class CartReaperTests(TestCase):
+    def test_reaps_idle_carts_in_batches(self):
+        idle_since = timezone.now() - datetime.timedelta(days=40)
+        for n in range(3):
+            make_cart(User.objects.create_user(f'idle{n}'), 2)
+        Order.objects.update(last_activity=idle_since)
+        active = make_cart(User.objects.create_user('active'), 1)
+        paid = make_cart(User.objects.create_user('paid'), 1)
+        Order.objects.filter(pk=paid.pk).update(ordered=True, status=PAID, last_activity=idle_since)
+
+        out = io.StringIO()
+        call_command('reap_carts', '--days', '30', '--batch-size', '2', stdout=out)
+
+        self.assertIn('Reaped 3 carts', out.getvalue())
+        self.assertIn('and 6 lines', out.getvalue())
+        self.assertEqual(set(Order.objects.values_list('pk', flat=True)), {active.pk, paid.pk})
+        self.assertEqual(OrderItem.objects.count(), 2)
+
+    def test_cart_activity_is_recorded(self):
+        user = User.objects.create_user('buyer')
+        item = Item.objects.create(title='Oxford', category='Shirt', price=20)
+        cart = CartService(user)
+        cart.add(item.slug)
+        Order.objects.update(last_activity=timezone.now() - datetime.timedelta(days=2))
+        cart.add(item.slug)
+        self.assertGreater(Order.objects.get().last_activity, timezone.now() - datetime.timedelta(hours=1))
+
+        # Removing what is not in the cart writes nothing.
+        other = Item.objects.create(title='Chino', category='Pant', price=30)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(cart.remove(other.slug)[1], CartService.NOT_IN_CART)
+        self.assertEqual([q['sql'] for q in ctx.captured_queries if not q['sql'].startswith('SELECT')], [])
+
+
+class GuestCartTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        self.shirt = Item.objects.create(title='Oxford', category='Shirt', price=20)
+        self.pant = Item.objects.create(title='Chino', category='Pant', price=30)
+
+    def test_guest_cart_writes_nothing_to_the_database(self):
+        self.client.get(reverse('mysite:add-to-cart', kwargs={'slug': self.shirt.slug}))
+        self.client.get(reverse('mysite:add-to-cart', kwargs={'slug': self.shirt.slug}))
+        self.client.get(reverse('mysite:add-to-cart', kwargs={'slug': self.pant.slug}))
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+        response = self.client.get(reverse('mysite:order-summary'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['order'].calculate_order_total(), 70)
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies['guest_cart'] = '{"1": 99}'
+        response = self.client.get(reverse('mysite:order-summary'))
+        self.assertNotIn('order', response.context)
+
+    def test_login_merges_guest_cart(self):
+        CartService(self.user).add(self.shirt.slug)
+        self.client.get(reverse('mysite:add-to-cart', kwargs={'slug': self.shirt.slug}))
+        self.client.get(reverse('mysite:add-to-cart', kwargs={'slug': self.pant.slug}))
+
+        self.client.post(reverse('account_login'), {'login': 'buyer', 'password': 'secret'})
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        quantities = {line.item_id: line.quantity for line in order.items.all()}
+        self.assertEqual(quantities, {self.shirt.pk: 2, self.pant.pk: 1})
+        self.assertEqual(self.client.cookies['guest_cart'].value, '')
+
+
+class ItemSlugTests(TestCase):
+    def setUp(self):
+        slug_cache.clear()
+
+    def test_slugs_are_slugified_unique_and_stable(self):
+        first = Item.objects.create(title='Slim Fit Oxford', category='Shirt', price=20)
+        second = Item.objects.create(title='Slim Fit Oxford', category='Shirt', price=25)
+        self.assertEqual((first.slug, second.slug), ('shirt-slim-fit-oxford', 'shirt-slim-fit-oxford-2'))
+
+        first.title = 'Regular Fit Oxford'
+        first.save()
+        first.refresh_from_db()
+        self.assertEqual(first.slug, 'shirt-slim-fit-oxford')
+
+    def test_resolve_item_is_cached_until_the_item_changes(self):
+        item = Item.objects.create(title='Oxford', category='Shirt', price=20)
+        resolve_item(item.slug)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_item(item.slug).pk, item.pk)
+
+        item.price = 22
+        item.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(resolve_item(item.slug).price, 22)
+
+        item.delete()
+        with self.assertRaises(Http404):
+            resolve_item('shirt-oxford')
+
+
+class CouponTests(TestCase):
+    def setUp(self):
+        known_coupons.clear()
+        unknown_codes.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+
+    def test_percent_coupon_comes_off_the_items_total(self):
+        coupon = Coupon.objects.create(code='TENPC', kind=Coupon.PERCENT, amount=10)
+        # 2 x 10 plus 2 x 11 discounted to 9 is 38; 10% of it rounds down to 3.
+        order = Order.objects.get(pk=make_cart(self.user, 2, coupon).pk)
+        self.assertEqual((order.calculate_order_coupon(), order.calculate_order_total()), (3, 35))
+
+        with self.assertRaises(IntegrityError):
+            Coupon.objects.create(code='TOOMUCH', kind=Coupon.PERCENT, amount=150)
+
+    def test_codes_are_normalized_and_cached(self):
+        coupon = Coupon.objects.create(code=' save5 ', amount=5)
+        self.assertEqual(coupon.code, 'SAVE5')
+        self.assertEqual(find_coupon('Save5').pk, coupon.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(find_coupon('SAVE5 ').amount, 5)
+
+        coupon.amount = 7
+        coupon.save()
+        self.assertEqual(find_coupon('save5').amount, 7)
+
+    def test_unknown_codes_are_remembered_until_created(self):
+        self.assertIsNone(find_coupon('GUESS1'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(find_coupon('guess1'))
+            self.assertIsNone(find_coupon('x' * 100))
+
+        Coupon.objects.create(code='GUESS1', amount=5)
+        self.assertIsNotNone(find_coupon('guess1'))
+
+    def test_unavailable_coupons_are_refused(self):
+        self.client.force_login(self.user)
+        order = make_cart(self.user, 1)
+        now = timezone.now()
+        Coupon.objects.create(code='OLD', amount=5, valid_until=now - datetime.timedelta(days=1))
+        Coupon.objects.create(code='SOON', amount=5, valid_from=now + datetime.timedelta(days=1))
+        Coupon.objects.create(code='GONE', amount=5, max_redemptions=2, redemptions=2)
+        Coupon.objects.create(code='OFF', amount=5, active=False)
+        for code in ('OLD', 'SOON', 'GONE', 'OFF', 'NOPE'):
+            self.client.post(reverse('mysite:add-coupon'), {'coupon_code': code})
+            order.refresh_from_db()
+            self.assertIsNone(order.coupon_id, code)
+
+        # Refused as unknown first; creating the coupon clears that.
+        self.client.post(reverse('mysite:add-coupon'), {'coupon_code': 'new'})
+        Coupon.objects.create(code='NEW', amount=5, max_redemptions=2, redemptions=1)
+        self.client.post(reverse('mysite:add-coupon'), {'coupon_code': 'new'})
+        order.refresh_from_db()
+        self.assertEqual(order.coupon.code, 'NEW')
+
+    def test_checkout_takes_a_redemption_within_the_limit(self):
+        coupon = Coupon.objects.create(code='SAVE5', amount=5, max_redemptions=1)
+        first = make_cart(self.user, 1, coupon)
+        second_user = User.objects.create_user('other', 'other@example.com', 'secret')
+        second = make_cart(second_user, 1, coupon)
+
+        payment = initiate_payment(first, self.user)
+        with self.assertRaises(CouponUnavailable):
+            initiate_payment(second, second_user)
+        second.refresh_from_db()
+        self.assertEqual((second.status, second.payment_id), ('C', None))
+
+        # A failed checkout gives its redemption back; a completed one keeps it.
+        fail_order(payment.pk)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.redemptions, 0)
+        payment = initiate_payment(second, second_user)
+        complete_order(payment.pk)
+        complete_order(payment.pk)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.redemptions, 1)
+        self.assertEqual(coupon.unavailable_reason(), 'This coupon has been fully redeemed.')
+
+
+class ProductPageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = Item.objects.create(title='Oxford', category='Shirt', price=20)
+        self.url = self.item.get_absolute_url()
+
+    def test_revalidation_returns_304(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'Oxford')
+        etag = response.headers['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_cached_page_skips_item_queries(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertContains(response, 'Oxford')
+
+    def test_saving_item_invalidates_page(self):
+        etag = self.client.get(self.url).headers['ETag']
+        self.item.description = 'Now in linen'
+        self.item.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Now in linen')
+
+    def test_cart_badge_stays_per_user(self):
+        user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        self.client.force_login(user)
+        etag = self.client.get(self.url).headers['ETag']
+        CartService(user).add(self.item.slug)
+        cache.clear()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<span class="badge red z-depth-1 mr-1">1</span>', html=True)
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new('RGBA', (1200, 800), (200, 30, 30, 255)).save(buffer, 'PNG')
+        self.name = default_storage.save('shirt.png', ContentFile(buffer.getvalue()))
+
+    def test_build_derivatives(self):
+        from PIL import Image
+        self.assertEqual(build_derivatives(self.name), 6)
+        self.assertEqual(build_derivatives(self.name), 0)
+        with default_storage.open(derivative_name(self.name, 'card', 'webp')) as f:
+            self.assertEqual(Image.open(f).size, (400, 267))
+
+    def test_template_tag_emits_srcset_once_ready(self):
+        item = Item.objects.create(title='Oxford', category='Shirt', price=20, image=self.name)
+        template = Template("{% load image_tags %}{% item_image item 'card' 'card-img-top' %}")
+
+        html = template.render(Context({'item': item}))
+        self.assertIn('src="/media/shirt.png"', html)
+
+        build_derivatives(self.name)
+        html = template.render(Context({'item': item}))
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('/media/derivatives/shirt-card.webp 400w', html)
+
+
+class CatalogImportTests(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.settings_override = override_settings(MEDIA_ROOT=os.path.join(self.workdir, 'media'))
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def write(self, name, content):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_csv_import_upserts_by_slug(self):
+        # No slug column value: the import derives the same slug as the model.
+        Item.objects.create(title='Oxford', category='Shirt', price=20)
+        path = self.write('catalog.csv', (
+            'title,category,price,discount_price,label,slug\n'
+            'Oxford,Shirt,25,,P,\n'
+            'Chino,Pant,30,28,,chino\n'
+            'Broken,Hat,10,,,\n'
+        ))
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_catalog', path, '--skip-images', '--batch-size', '2', stdout=out, stderr=err)
+        call_command('import_catalog', path, '--skip-images', stdout=io.StringIO(), stderr=io.StringIO())
+
+        self.assertIn('1 created, 1 updated, 1 skipped', out.getvalue())
+        self.assertIn("unknown category 'Hat'", err.getvalue())
+        self.assertEqual(Item.objects.count(), 2)
+        oxford = Item.objects.get(title='Oxford')
+        self.assertEqual((oxford.price, oxford.label), (25, 'P'))
+        self.assertEqual(Item.objects.get(slug='chino').discount_price, 28)
+
+    def test_given_slugs_are_normalized(self):
+        path = self.write('catalog.jsonl', '\n'.join(json.dumps(row) for row in [
+            {'title': 'Polo', 'category': 'Shirt', 'price': 20, 'slug': ' Polo Shirt/Blue '},
+            {'title': 'Tee', 'category': 'T-Shirt', 'price': 9, 'slug': 'tee ' * 20},
+            {'title': 'Odd', 'category': 'Shirt', 'price': 9, 'slug': '///'},
+        ]) + '\n')
+        err = io.StringIO()
+        call_command('import_catalog', path, '--skip-images', stdout=io.StringIO(), stderr=err)
+
+        self.assertIn("invalid slug '///'", err.getvalue())
+        slugs = sorted(Item.objects.values_list('slug', flat=True))
+        self.assertEqual(slugs, ['polo-shirtblue', ('tee-' * 11)[:43]])
+
+    def test_jsonl_import_processes_images(self):
+        from PIL import Image
+        Image.new('RGB', (600, 400), (20, 90, 200)).save(os.path.join(self.workdir, 'cap.png'))
+        path = self.write('catalog.jsonl', json.dumps(
+            {'title': 'Cap', 'category': 'T-Shirt', 'price': 12, 'slug': 'cap', 'image': 'cap.png'}
+        ) + '\n')
+        call_command('import_catalog', path, '--workers', '1', stdout=io.StringIO(), stderr=io.StringIO())
+
+        item = Item.objects.get(slug='cap')
+        self.assertTrue(item.image.name.startswith('catalog/'))
+        self.assertTrue(default_storage.exists(derivative_name(item.image.name, 'card', 'webp')))
+
+
+class StaticAssetTests(TestCase):
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root)
+        self.name = 'css/site.0123456789ab.css'
+        path = f'{self.static_root}/{self.name}'
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('body { color: red; }\n' * 100)
+        compress_file(path)
+
+    def get(self, **headers):
+        request = RequestFactory().get('/static/' + self.name, **headers)
+        with override_settings(STATIC_ROOT=self.static_root):
+            return serve_static(request, self.name)
+
+    def test_serves_precompressed_variant(self):
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(response.headers['Content-Type'], 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip, br;q=0')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        response = self.get()
+        self.assertNotIn('Content-Encoding', response.headers)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class TwoPhaseCheckoutTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        self.client.force_login(self.user)
+        self.order = make_cart(self.user, 2)
+        self.item = Item.objects.create(title='Chino', category='Pant', price=30)
+
+    def submit(self):
+        with mock.patch('mysite.views.schedule_payment') as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    reverse('mysite:payment', kwargs={'payment_option': 'stripe'}),
+                    {'stripeToken': 'tok_visa'}
+                )
+        self.order.refresh_from_db()
+        return response, schedule
+
+    def test_submit_only_initiates(self):
+        with mock.patch('stripe.Charge.create') as charge:
+            response, schedule = self.submit()
+        self.assertRedirects(response, reverse('mysite:home'), fetch_redirect_response=False)
+        charge.assert_not_called()
+        schedule.assert_called_once_with(self.order.payment_id, 'tok_visa', False, False)
+        self.assertEqual(self.order.status, PENDING)
+        self.assertFalse(self.order.ordered)
+
+        # The cart is locked and a second submit does not start another payment.
+        self.assertEqual(CartService(self.user).add(self.item.slug)[1], CartService.LOCKED)
+        response, schedule = self.submit()
+        schedule.assert_not_called()
+
+    def test_worker_completes_order(self):
+        self.submit()
+        payment = self.order.payment
+        with mock.patch('stripe.Charge.create', return_value=fake_charge(payment)):
+            self.assertTrue(process_payment(payment.pk, 'tok_visa', False, False))
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, PAID)
+        self.assertTrue(self.order.ordered)
+        self.assertFalse(self.order.items.filter(unit_price=None).exists())
+        self.assertEqual(self.order.total, self.order.payment.amount)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_prices_are_fixed_when_checkout_starts(self):
+        self.submit()
+        payment = self.order.payment
+        Item.objects.update(price=99, discount_price=None)
+        complete_order(payment.pk, 'ch_1')
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total, payment.amount)
+        self.assertEqual(DailySales.objects.aggregate(gross=Sum('gross'))['gross'], 2 * (10 + 11))
+
+    def test_failed_payment_drops_the_price_snapshot(self):
+        self.submit()
+        fail_order(self.order.payment_id)
+        Item.objects.update(price=99, discount_price=None)
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertIsNone(order.total)
+        self.assertEqual(order.calculate_order_total(), 2 * 99 * 2)
+
+    def test_charged_order_is_never_failed(self):
+        self.submit()
+        payment = self.order.payment
+        charge = fake_charge(payment)
+        with mock.patch('stripe.Charge.create', return_value=charge), \
+                mock.patch('mysite.checkout.record_sale', side_effect=RuntimeError('rollup down')), \
+                self.assertLogs('mysite.checkout', 'ERROR'):
+            self.assertFalse(process_payment(payment.pk, 'tok_visa', False, False))
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, PENDING)
+        self.assertEqual(self.order.payment.stripe_charge_id, charge['id'])
+
+        # The webhook (or the sweeper) finishes the job later.
+        FakeStripeWebhookSender(self.client).send('charge.succeeded', charge)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, PAID)
+
+    def test_charge_for_a_failed_order_is_refunded(self):
+        self.submit()
+        payment = self.order.payment
+        gateway = FakeGateway()
+        create_charge = gateway.create_charge
+
+        def sweep_during_charge(**kwargs):
+            # The sweeper gives up on the order while Stripe is still charging.
+            fail_order(payment.pk)
+            return create_charge(**kwargs)
+
+        gateway.create_charge = sweep_during_charge
+        set_gateway(gateway)
+        try:
+            with self.assertLogs('mysite.checkout', 'CRITICAL'):
+                self.assertFalse(process_payment(payment.pk, 'tok_visa', False, False))
+        finally:
+            set_gateway(None)
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, FAILED)
+        self.assertEqual([refund['charge'] for refund in gateway.refunds], [gateway.charges[0]['id']])
+
+    def test_repeated_webhook_does_not_refund(self):
+        self.submit()
+        charge = fake_charge(self.order.payment)
+        gateway = FakeGateway()
+        set_gateway(gateway)
+        try:
+            sender = FakeStripeWebhookSender(self.client)
+            sender.send('charge.succeeded', charge)
+            sender.send('charge.succeeded', charge)
+        finally:
+            set_gateway(None)
+        self.assertEqual(gateway.refunds, [])
+
+    @mock.patch('mysite.checkout.CHARGE_RETRY_DELAY', 0)
+    def test_unknown_charge_outcome_keeps_the_idempotency_key(self):
+        self.submit()
+        payment = self.order.payment
+        timeout = stripe.error.APIConnectionError('read timed out')
+        with mock.patch('stripe.Charge.create', side_effect=[timeout, fake_charge(payment)]) as create:
+            self.assertTrue(process_payment(payment.pk, 'tok_visa', False, False))
+        keys = {call.kwargs['idempotency_key'] for call in create.call_args_list}
+        self.assertEqual(keys, {f'payment-{payment.pk}'})
+
+    @mock.patch('mysite.checkout.CHARGE_RETRY_DELAY', 0)
+    def test_unanswered_charge_stays_pending(self):
+        self.submit()
+        payment = self.order.payment
+        gateway = FakeGateway()
+        gateway.create_charge = mock.Mock(side_effect=stripe.error.APIConnectionError('read timed out'))
+        set_gateway(gateway)
+        try:
+            with self.assertLogs('mysite.checkout', 'ERROR'):
+                self.assertFalse(process_payment(payment.pk, 'tok_visa', False, False))
+        finally:
+            set_gateway(None)
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, PENDING)
+        self.assertEqual(self.order.payment_id, payment.pk)
+
+        # A declined card is certain, so that one reopens the cart.
+        gateway.create_charge.side_effect = stripe.error.CardError('Your card was declined.', None, 'card_declined')
+        set_gateway(gateway)
+        try:
+            with self.assertLogs('mysite.checkout', 'WARNING'):
+                self.assertFalse(process_payment(payment.pk, 'tok_visa', False, False))
+        finally:
+            set_gateway(None)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, FAILED)
+
+    def test_webhook_completes_order_once(self):
+        self.submit()
+        charge = fake_charge(self.order.payment)
+        sender = FakeStripeWebhookSender(self.client)
+
+        self.assertEqual(sender.send('charge.succeeded', charge).status_code, 200)
+        self.assertEqual(sender.send('charge.succeeded', charge).status_code, 200)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, PAID)
+        self.assertEqual(self.order.payment.stripe_charge_id, charge['id'])
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed_charge_reopens_cart(self):
+        self.submit()
+        sender = FakeStripeWebhookSender(self.client)
+        sender.send('charge.failed', fake_charge(self.order.payment, status='failed'))
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, FAILED)
+        self.assertIsNone(self.order.payment)
+        self.assertEqual(CartService(self.user).add(self.item.slug)[1], CartService.ADDED)
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='')
+    def test_webhook_without_secret_rejects_everything(self):
+        self.submit()
+        sender = FakeStripeWebhookSender(self.client, secret='')
+        with self.assertLogs('mysite.views', 'ERROR'):
+            response = sender.send('charge.succeeded', fake_charge(self.order.payment))
+        self.assertEqual(response.status_code, 400)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, PENDING)
+
+    def test_webhook_rejects_bad_signature(self):
+        self.submit()
+        sender = FakeStripeWebhookSender(self.client, secret='whsec_wrong')
+        response = sender.send('charge.succeeded', fake_charge(self.order.payment))
+        self.assertEqual(response.status_code, 400)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, PENDING)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        self.order = make_cart(self.user, 1)
+        self.item = self.order.items.get().item
+        self.stock = Stock.objects.create(item=self.item, available=3)
+
+    def assertStock(self, available, reserved):
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.available, self.stock.reserved), (available, reserved))
+
+    def test_completed_checkout_commits_the_hold(self):
+        payment = initiate_payment(self.order, self.user)
+        self.assertStock(1, 2)
+        complete_order(payment.pk)
+        self.assertStock(1, 0)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_failed_checkout_releases_the_hold(self):
+        payment = initiate_payment(self.order, self.user)
+        fail_order(payment.pk)
+        self.assertStock(3, 0)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_out_of_stock_leaves_the_cart_open(self):
+        Stock.objects.filter(pk=self.item.pk).update(available=1)
+        with self.assertRaises(OutOfStock):
+            initiate_payment(self.order, self.user)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'C')
+        self.assertFalse(Payment.objects.exists())
+        self.assertStock(1, 0)
+
+    def sweep(self, gateway):
+        later = timezone.now() + datetime.timedelta(seconds=settings.STOCK_HOLD_SECONDS + 1)
+        set_gateway(gateway)
+        try:
+            return expire_pending_checkouts(now=later)
+        finally:
+            set_gateway(None)
+
+    def test_sweeper_fails_stale_uncharged_checkouts(self):
+        initiate_payment(self.order, self.user)
+        set_gateway(FakeGateway())
+        try:
+            self.assertEqual(expire_pending_checkouts(), (0, 0))
+        finally:
+            set_gateway(None)
+        self.assertEqual(self.sweep(FakeGateway()), (0, 1))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, FAILED)
+        self.assertStock(3, 0)
+
+    def test_sweeper_completes_charged_checkouts_without_holds(self):
+        # The worker died after Stripe took the money, and the item is not
+        # stock-tracked, so there is no reservation to find the order by.
+        self.stock.delete()
+        payment = initiate_payment(self.order, self.user)
+        gateway = FakeGateway()
+        gateway.create_charge(amount=100, currency='usd', metadata={'payment_id': payment.pk})
+        self.assertEqual(self.sweep(gateway), (1, 0))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, PAID)
+
+    def test_sweeper_leaves_checkouts_stripe_cannot_settle(self):
+        payment = initiate_payment(self.order, self.user)
+        gateway = FakeGateway()
+        gateway.find_charge = mock.Mock(side_effect=stripe.error.APIConnectionError('timed out'))
+        with self.assertLogs('mysite.checkout', 'WARNING'):
+            self.assertEqual(self.sweep(gateway), (0, 0))
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.payment_id), (PENDING, payment.pk))
+
+
+class StockConcurrencyTests(TransactionTestCase):
+    # Real threads and connections: every buyer races for the same item.
+    def test_parallel_checkouts_never_oversell(self):
+        item = Item.objects.create(title='Drop', category='Shirt', price=50)
+        Stock.objects.create(item=item, available=5)
+        buyers = []
+        for n in range(20):
+            user = User.objects.create_user(f'buyer{n}')
+            order = Order.objects.create(user=user, ordered_date=timezone.now())
+            OrderItem.objects.create(order=order, item=item)
+            buyers.append((order, user))
+
+        results, errors = [], []
+        barrier = threading.Barrier(len(buyers))
+
+        def buy(order, user):
+            try:
+                barrier.wait()
+                while True:
+                    try:
+                        results.append(initiate_payment(order, user) is not None)
+                        return
+                    except OutOfStock:
+                        results.append(False)
+                        return
+                    except OperationalError as e:
+                        if not is_lock_error(e):
+                            raise
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=buyer) for buyer in buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results.count(True), 5)
+        stock = Stock.objects.get(item=item)
+        self.assertEqual((stock.available, stock.reserved), (0, 5))
+        self.assertEqual(StockReservation.objects.count(), 5)
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('buyer', 'buyer@example.com', 'secret')
+        coupon = Coupon.objects.create(code='SAVE5', amount=5)
+        # Lines: 2 x 10 and 2 x 11 discounted to 9; the coupon splits 2 + 3.
+        self.order = make_cart(self.user, 2, coupon)
+        payment = Payment.objects.create(user=self.user, stripe_charge_id='ch_1', amount=33)
+        Order.objects.filter(pk=self.order.pk).update(payment=payment, status=PENDING)
+        complete_order(payment.pk)
+
+    def totals(self):
+        return DailySales.objects.aggregate(
+            units=Sum('units'), gross=Sum('gross'), discount=Sum('discount'),
+            coupon=Sum('coupon'), refunds=Sum('refunds')
+        )
+
+    def test_completion_and_refund_update_rollups(self):
+        self.assertEqual(self.totals(), {'units': 4, 'gross': 42, 'discount': 4, 'coupon': 5, 'refunds': 0})
+
+        Refund.objects.create(user=self.user, email='buyer@example.com', reason='Too small', order=self.order)
+        Order.objects.filter(pk=self.order.pk).update(refund_requested=True)
+        self.client.force_login(self.user)
+        for _ in range(2):
+            # A second submit of the same action grants nothing more.
+            self.client.post(reverse('admin:mysite_order_changelist'), {
+                'action': 'make_refund_accepted', '_selected_action': [self.order.pk]
+            })
+        self.assertEqual(self.totals()['refunds'], 33)
+
+        response = self.client.get(reverse('admin:mysite_dailysales_report'))
+        self.assertContains(response, '<th>42</th>', html=True)
+
+    def test_rebuild_reproduces_rollups(self):
+        Order.objects.filter(pk=self.order.pk).update(refund_granted=True)
+        DailySales.objects.update(units=0, gross=0)
+        call_command('rebuild_sales_rollups', '--chunk-days', '1', stdout=io.StringIO())
+        self.assertEqual(self.totals(), {'units': 4, 'gross': 42, 'discount': 4, 'coupon': 5, 'refunds': 33})
+        self.assertEqual(DailySales.objects.count(), 2)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite specific')
+class QueryPlanTests(TestCase):
+    # Every hot lookup must be answered from an index; a plain
+    # "SCAN mysite_..." line means a full table scan crept back in.
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        self.order = make_cart(self.user, 2)
+        self.item = self.order.items.first().item
+
+    def assertNoTableScan(self, plan):
+        scans = [line for line in plan.splitlines() if re.search(r'\bSCAN mysite_', line)]
+        self.assertEqual(scans, [], plan)
+
+    def assertCallIndexed(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        selects = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        with connection.cursor() as cursor:
+            for sql in selects:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                self.assertNoTableScan('\n'.join(row[-1] for row in cursor.fetchall()))
+
+    def test_view_lookups_use_indexes(self):
+        querysets = [
+            Order.objects.filter(user=self.user, ordered=False),
+            Order.objects.filter(user=self.user, ordered=True),
+            Order.objects.for_cart().filter(user=self.user, ordered=False),
+            OrderItem.objects.filter(order__user=self.user, order__ordered=False, item=self.item),
+            Item.objects.filter(slug=self.item.slug),
+            Coupon.objects.filter(code='TEN'),
+            Order.objects.filter(refrence_key='abc'),
+            Address.objects.filter(user=self.user, address_type='S', default=True),
+        ]
+        for queryset in querysets:
+            with self.subTest(query=str(queryset.query)):
+                self.assertNoTableScan(queryset.explain())
+
+    def test_cart_paths_use_indexes(self):
+        self.assertCallIndexed(lambda: CartService(self.user).lookup(self.item.slug))
+        self.assertCallIndexed(lambda: get_cart_summary(self.user))
+
+    def test_lookup_keys_are_unique(self):
+        Coupon.objects.create(code='TEN', amount=10)
+        with self.assertRaises(IntegrityError):
+            Coupon.objects.create(code='TEN', amount=5)
+
+
+class OrderAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        buyers = [User.objects.create_user(f'buyer{n}') for n in range(5)]
+        addresses = Address.objects.bulk_create([
+            Address(user=user, street_address='1 Main St', apartment_address='', zipcode='11181',
+                    country='MM', address_type=kind)
+            for user in buyers for kind in 'SB'
+        ])
+        payments = Payment.objects.bulk_create([
+            Payment(user=user, stripe_charge_id=f'ch_{user.pk}', amount=20) for user in buyers
+        ])
+        coupon = Coupon.objects.create(code='SAVE5', amount=5)
+        Order.objects.bulk_create([
+            Order(
+                user=buyers[n % 5], ordered=True, ordered_date=timezone.now(), status='S',
+                shipping_address=addresses[2 * (n % 5)], billing_address=addresses[2 * (n % 5) + 1],
+                payment=payments[n % 5], coupon=coupon, refund_requested=n < 3
+            )
+            for n in range(1000)
+        ])
+        cls.requested = list(Order.objects.filter(refund_requested=True))
+        # Lines on the same item and day, so their refunds share a rollup row.
+        cls.item = Item.objects.create(title='Oxford', category='Shirt', price=20)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, item=cls.item, quantity=1, unit_price=20) for order in cls.requested
+        ])
+        Refund.objects.bulk_create([
+            Refund(user=order.user, email='buyer@example.com', reason='Too small', order=order)
+            for order in cls.requested
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def test_changelist_query_budget(self):
+        url = reverse('admin:mysite_order_changelist')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'buyer0')
+        self.assertLessEqual(len(ctx.captured_queries), 8, [q['sql'] for q in ctx.captured_queries])
+
+    def test_refund_action_is_set_based(self):
+        url = reverse('admin:mysite_order_changelist')
+        selected = list(Order.objects.filter(refund_requested=False).values_list('pk', flat=True)[:7])
+        selected += [order.pk for order in self.requested]
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(url, {'action': 'make_refund_accepted', '_selected_action': selected})
+        # Refunds, orders and the one rollup row, whatever the number of orders.
+        writes = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith(('UPDATE', 'INSERT'))]
+        self.assertEqual(len(writes), 4, writes)
+        self.assertEqual(DailySales.objects.get(item=self.item).refunds, 3 * (20 - 5))
+
+        self.assertEqual(Order.objects.filter(refund_granted=True).count(), 3)
+        self.assertFalse(Order.objects.filter(refund_requested=True).exists())
+        self.assertEqual(Refund.objects.filter(accepted=True).count(), 3)
+
+    def test_coupon_codes_clash_case_insensitively(self):
+        url = reverse('admin:mysite_coupon_add')
+        form = {'code': ' save5 ', 'kind': Coupon.FIXED, 'amount': 3, 'active': 'on'}
+        response = self.client.post(url, form)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('code', response.context['adminform'].form.errors)
+        self.assertEqual(Coupon.objects.count(), 1)
+
+        self.client.post(url, dict(form, code='save10'))
+        self.assertTrue(Coupon.objects.filter(code='SAVE10').exists())
+
+
+class PaymentGatewayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        self.order = make_cart(self.user, 1)
+
+    def tearDown(self):
+        set_gateway(None)
+
+    def test_fake_gateway_saves_card(self):
+        gateway = FakeGateway()
+        set_gateway(gateway)
+        self.client.force_login(self.user)
+        with mock.patch('mysite.views.schedule_payment'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    reverse('mysite:payment', kwargs={'payment_option': 'stripe'}),
+                    {'stripeToken': 'tok_visa', 'save': 'on'}
+                )
+        self.order.refresh_from_db()
+        self.assertTrue(process_payment(self.order.payment_id, 'tok_visa', True, False))
+
+        profile = self.user.userprofile
+        profile.refresh_from_db()
+        self.assertTrue(profile.one_click_purchasing)
+        self.assertEqual(gateway.calls, ['create_customer', 'create_charge'])
+        self.assertEqual(gateway.list_cards(profile.stripe_customer_id)[0]['last4'], '4242')
+
+    def test_card_list_is_cached_until_a_card_is_added(self):
+        gateway = StripeGateway()
+        cards = {'data': [{'id': 'card_1', 'last4': '4242', 'exp_month': 1, 'exp_year': 2030}]}
+        with mock.patch('stripe.Customer.list_sources', return_value=cards) as list_sources:
+            gateway.list_cards('cus_1')
+            gateway.list_cards('cus_1')
+            self.assertEqual(list_sources.call_count, 1)
+
+            with mock.patch('stripe.Customer.create_source', return_value={'id': 'card_2'}):
+                gateway.create_source('cus_1', source='tok_visa')
+            gateway.list_cards('cus_1')
+            self.assertEqual(list_sources.call_count, 2)
+
+    def test_breaker_fails_fast_after_repeated_errors(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        gateway = StripeGateway()
+        gateway.breaker = breaker
+        error = stripe.error.APIConnectionError('timed out')
+        with mock.patch('stripe.Charge.create', side_effect=error) as create:
+            for _ in range(2):
+                with self.assertRaises(stripe.error.APIConnectionError):
+                    gateway.create_charge(amount=100, currency='usd')
+            with self.assertRaises(GatewayUnavailable):
+                gateway.create_charge(amount=100, currency='usd')
+            self.assertEqual(create.call_count, 2)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create_user('staff', 'staff@example.com', 'secret', is_staff=True)
+
+    def scrape(self, **headers):
+        return self.client.get(reverse('mysite:metrics'), **headers)
+
+    def test_requires_staff_or_token(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        with override_settings(METRICS_TOKEN='scrape-me'):
+            self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer scrape-me').status_code, 200)
+
+    def test_records_request_sql_and_template_timings(self):
+        self.client.get(reverse('mysite:home'))
+        self.client.force_login(self.staff)
+        body = self.scrape().content.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",status="2xx",view="mysite:home"}', body)
+        self.assertIn('http_request_sql_queries_count{view="mysite:home"}', body)
+        self.assertIn('template_render_duration_seconds_count{template="shopping/home-page.html"}', body)
+
+    def test_merges_worker_snapshots(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        key = json.dumps([['method', 'GET'], ['status', '2xx'], ['view', 'other:worker']])
+        counts = [3] + [0] * len(REQUEST_LATENCY.buckets)
+        with open(os.path.join(directory, '99999.json'), 'w') as f:
+            json.dump({'http_request_duration_seconds': {key: [counts, 0.003]}}, f)
+        with override_settings(METRICS_DIR=directory):
+            body = REGISTRY.render()
+        self.assertIn('http_request_duration_seconds_count{method="GET",status="2xx",view="other:worker"} 3', body)
+        self.assertTrue(os.path.exists(os.path.join(directory, f'{os.getpid()}.json')))
+
+
+class ReplicaRouterTests(TestCase):
+    router = ReplicaRouter()
+
+    @override_settings(DATABASE_REPLICAS={'replica1': 1})
+    def test_only_catalog_reads_use_replicas(self):
+        self.assertEqual(self.router.db_for_read(Item), 'default')
+        with catalog_reads():
+            self.assertEqual(self.router.db_for_read(Item), 'replica1')
+            self.assertEqual(self.router.db_for_read(Order), 'default')
+        self.assertFalse(self.router.allow_migrate('replica1', 'mysite'))
+
+    @override_settings(DATABASE_REPLICAS={'replica1': 1})
+    def test_writes_pin_the_request_to_the_primary(self):
+        state, token = begin_request(pinned=False)
+        try:
+            with catalog_reads():
+                self.assertEqual(self.router.db_for_read(Item), 'replica1')
+                self.router.db_for_write(OrderItem)
+                self.assertEqual(self.router.db_for_read(Item), 'default')
+        finally:
+            end_request(token)
+        self.assertTrue(state.wrote)
+
+    # "default" stands in for a replica so the views can run against the
+    # test database.
+    @override_settings(DATABASE_REPLICAS={'default': 1})
+    def test_pin_cookie_after_write(self):
+        user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        item = Item.objects.create(title='Oxford', category='Shirt', price=20)
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('mysite:home'))
+        self.assertNotIn('pin_primary', response.cookies)
+        response = self.client.get(item.add_to_cart())
+        self.assertIn('pin_primary', response.cookies)
+
+
+class LockRetryTests(SimpleTestCase):
+    # Not a TestCase: retries are skipped inside an outer transaction.
+    def test_retries_lock_errors_only(self):
+        calls = []
+
+        @retry_on_lock
+        def contended():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('database is locked')
+            return 'done'
+
+        with mock.patch('mysite.transactions.time.sleep'):
+            self.assertEqual(contended(), 'done')
+        self.assertEqual(len(calls), 3)
+
+        @retry_on_lock
+        def broken():
+            calls.append(1)
+            raise OperationalError('no such table: nowhere')
+
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            broken()
+        self.assertEqual(len(calls), 1)
+
+
+class AsyncViewTests(TestCase):
+    # Runs the views through the ASGI handler, where any query made from the
+    # event loop raises SynchronousOnlyOperation.
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+        self.order = make_cart(self.user, 2)
+        self.item = Item.objects.create(title='Chino', category='Pant', price=30)
+        self.async_client.force_login(self.user)
+
+    async def test_catalog_and_cart_pages(self):
+        response = await self.async_client.get(reverse('mysite:home'))
+        self.assertContains(response, 'Chino')
+        self.assertContains(response, '<span class="badge red z-depth-1 mr-1">2</span>', html=True)
+
+        response = await self.async_client.get(self.item.get_absolute_url())
+        self.assertContains(response, 'Chino')
+
+        response = await self.async_client.get(reverse('mysite:add-to-cart', kwargs={'slug': self.item.slug}))
+        self.assertRedirects(response, self.item.get_absolute_url(), fetch_redirect_response=False)
+
+        response = await self.async_client.get(reverse('mysite:order-summary'))
+        self.assertContains(response, 'Chino')
+        self.assertContains(response, '<span class="badge red z-depth-1 mr-1">3</span>', html=True)
+
+    async def test_payment_page_awaits_saved_cards(self):
+        gateway = FakeGateway()
+        await sync_to_async(self.prepare_one_click)(gateway)
+        set_gateway(gateway)
+        self.addCleanup(set_gateway, None)
+
+        response = await self.async_client.get(reverse('mysite:payment', kwargs={'payment_option': 'stripe'}))
+        self.assertContains(response, '**** **** **** 4242')
+        self.assertEqual(gateway.calls, ['create_customer', 'list_cards'])
+
+    def prepare_one_click(self, gateway):
+        self.order.billing_address = Address.objects.create(
+            user=self.user, street_address='1 Main St', apartment_address='', zipcode='11181',
+            country='MM', address_type='B'
+        )
+        self.order.save()
+        profile = self.user.userprofile
+        profile.stripe_customer_id = gateway.create_customer('buyer@example.com', 'tok_visa')['id']
+        profile.one_click_purchasing = True
+        profile.save()
+
+    async def test_guest_cart(self):
+        guest = AsyncClient()
+        response = await guest.get(reverse('mysite:add-to-cart', kwargs={'slug': self.item.slug}))
+        self.assertIn('guest_cart', response.cookies)
+
+        guest.cookies.update(response.cookies)
+        response = await guest.get(reverse('mysite:order-summary'))
+        self.assertContains(response, 'Chino')
+        self.assertContains(response, '<span class="badge red z-depth-1 mr-1">1</span>', html=True)
@@ -0,0 +1,51 @@
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+# Write transactions for the SQLite profile (mysite.backends.sqlite3). On any
+# other backend immediate_atomic() is a plain atomic() and retry_on_lock()
+# only retries errors that really are lock timeouts.
+
+LOCK_RETRY_ATTEMPTS = 4
+LOCK_RETRY_DELAY = 0.05
+
+@contextmanager
+def immediate_atomic(using=None):
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    if connection.in_atomic_block or not hasattr(connection, 'begin_immediate'):
+        with transaction.atomic(using=using):
+            yield
+        return
+    connection.begin_immediate = True
+    try:
+        with transaction.atomic(using=using):
+            connection.begin_immediate = False
+            yield
+    finally:
+        connection.begin_immediate = False
+
+def is_lock_error(error):
+    message = str(error).lower()
+    return 'database is locked' in message or 'database table is locked' in message
+
+def retry_on_lock(func=None, attempts=LOCK_RETRY_ATTEMPTS, using=None):
+    # Re-runs a whole unit of work that lost the race for the write lock,
+    # with jittered exponential backoff. Never retries inside an outer
+    # transaction, whose earlier statements are already gone.
+    if func is None:
+        return lambda func: retry_on_lock(func, attempts, using)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                connection = connections[using or DEFAULT_DB_ALIAS]
+                if attempt == attempts or connection.in_atomic_block or not is_lock_error(e):
+                    raise
+                time.sleep(LOCK_RETRY_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+    return wrapper
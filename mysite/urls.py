@@ -21,4 +21,6 @@ urlpatterns = [
     path('payment/<payment_option>/', views.PaymentView.as_view(), name='payment'),
     path('add-coupon/', views.AddCounponView.as_view(), name='add-coupon'),
     path('refund/', views.CreateRefundView.as_view(), name='refund'),
+    path('stripe/webhook/', views.stripeWebhook, name='stripe-webhook'),
+    path('metrics', views.metrics, name='metrics'),
 ]
@@ -1,69 +1,155 @@
-from django.shortcuts import render, get_object_or_404, reverse, redirect
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, redirect
 from django.views import generic
-from django.utils import timezone
 from django.contrib import messages
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import send_mail
 from django.conf import settings
-from django.db.models import Q
-
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund, UserProfile
+from django.db import transaction
+from django.core.paginator import InvalidPage
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.crypto import constant_time_compare
+
+from .models import Item, Order, Address, Refund, UserProfile
 from .forms import CheckOutForm, CouponForm, RefundForm, PaymentForm
+from .cart import CartService, aget_cart_summary, get_cart, invalidates_cart_summary
+from .search import search_items
+from .page_cache import aget_product_meta, aget_product_html, product_etag, has_pending_messages
+from .pagination import CachedCountPaginator, akeyset_paginate, encode_cursor
+from .gateway import get_gateway, run_in_gateway_pool
+from .metrics import REGISTRY
+from .routers import catalog_reads
+from .checkout import CART, PENDING, FAILED, initiate_payment, schedule_payment, handle_stripe_event
+from .inventory import OutOfStock
+from .coupons import CouponUnavailable, find_coupon
+
+import logging, stripe
 
-import stripe, random, string
+logger = logging.getLogger(__name__)
 
 # Create your views here.
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
-def create_refrence_key():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-
-def search_Item(query, qs, context):
-    qs = qs.filter(
-        Q(title__icontains=query) |
-        Q(category__icontains=query)
-    )
-    context.update({
-        'items': qs
-    })
-
-class ItemListView(generic.ListView):
+async def resolve_user(request):
+    # request.user is a lazy object that hits the session and user tables on
+    # first use, which async code may not do. Load it in a thread once; it
+    # can be read freely afterwards. (Django 4.1 has no request.auser().)
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    async def dispatch(self, request, *args, **kwargs):
+        user = await resolve_user(request)
+        if not user.is_authenticated:
+            return self.handle_no_permission()
+        return await super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
+
+class CatalogReadMixin:
+    # Lets the view's Item queries go to a read replica (mysite.routers).
+    # Catalog views are async and render() their templates before returning.
+    async def dispatch(self, *args, **kwargs):
+        with catalog_reads():
+            return await super().dispatch(*args, **kwargs)
+
+class ItemListView(CatalogReadMixin, generic.View):
     template_name = 'shopping/home-page.html'
-    context_object_name = 'items'
     paginate_by = 8
+    # Past this page number the "next" link switches to a keyset cursor,
+    # so deep pages never pay for a large OFFSET.
+    max_page_number = 5
+    # Hard cap on search results, ordered by relevance.
+    search_limit = 96
 
-    def get_queryset(self):
-        return Item.objects.order_by('-price')
-    
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        query = self.request.GET.get('search')
+    def get_search_query(self):
+        return self.request.GET.get('search', '').strip()
+
+    async def get_queryset(self):
+        query = self.get_search_query()
         if query:
-            qs = self.get_queryset()
-            search_Item(query, qs, context)
-        return context
-    
-class ItemDetailView(generic.DetailView):
+            # Ranking runs raw FTS5 SQL, which has no async API.
+            return await sync_to_async(search_items)(query, Item.objects.all(), limit=self.search_limit)
+        return Item.objects.order_by('-price', '-id')
+
+    async def paginate_queryset(self, queryset):
+        cursor = self.request.GET.get('cursor')
+        if cursor and not self.get_search_query():
+            page = await akeyset_paginate(queryset, cursor, self.paginate_by)
+            return None, page
+
+        paginator = CachedCountPaginator(queryset, self.paginate_by)
+        page_number = self.request.GET.get('page') or 1
+        try:
+            if page_number == 'last':
+                await paginator.acount()
+                page_number = paginator.num_pages
+            page = await paginator.apage(int(page_number))
+        except (ValueError, InvalidPage):
+            raise Http404('Invalid page')
+        return paginator, page
+
+    async def get(self, request, *args, **kwargs):
+        user = await resolve_user(request)
+        query = self.get_search_query()
+        paginator, page = await self.paginate_queryset(await self.get_queryset())
+        context = {
+            'items': page.object_list,
+            'object_list': page.object_list,
+            'paginator': paginator,
+            'page_obj': page,
+            'is_paginated': paginator is None or paginator.num_pages > 1,
+            'search_query': query,
+            'cart_summary': await aget_cart_summary(user),
+        }
+        if paginator is not None and not query:
+            if page.number >= self.max_page_number and page.has_next() and page.object_list:
+                context['next_cursor'] = encode_cursor(page.object_list[-1], 'next')
+        return render(request, self.template_name, context)
+
+class ItemDetailView(CatalogReadMixin, generic.View):
     template_name = 'shopping/product-page.html'
-    context_object_name = 'item'
 
-    def get_queryset(self):
-        return Item.objects.all()
+    async def get(self, request, *args, **kwargs):
+        user = await resolve_user(request)
+        slug = kwargs['slug']
+        meta = await aget_product_meta(slug)
+        cart_summary = await aget_cart_summary(user)
+        etag = product_etag(request, slug, meta, cart_summary)
+        last_modified = meta['updated_at'].timestamp()
+
+        # Pending messages are shown once, so never answer 304 over them.
+        if not await sync_to_async(has_pending_messages)(request):
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                return response
+
+        context = {
+            'product_html': await aget_product_html(slug, meta),
+            'cart_summary': cart_summary,
+        }
+        response = render(request, self.template_name, context)
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Cookie'])
+        return response
     
-class OrderSummaryView(LoginRequiredMixin, generic.View):
-    def get(self, *args, **kwargs):
-        try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            context = {
-                'order': order
-            }
-            return render(self.request, 'shopping/summary-page.html' ,context) 
-        except ObjectDoesNotExist:
-            messages.info(self.request, 'You do not have active order.')
-            return render(self.request, 'shopping/summary-page.html') 
+class OrderSummaryView(generic.View):
+    async def get(self, request, *args, **kwargs):
+        user = await resolve_user(request)
+        order = await get_cart(request).aget_order()
+        context = {
+            'cart_summary': await aget_cart_summary(user),
+        }
+        if order is None:
+            messages.info(request, 'You do not have active order.')
+            return render(request, 'shopping/summary-page.html', context)
+        context['order'] = order
+        return render(request, 'shopping/summary-page.html' ,context) 
             
         
 # class OrderSummaryView(generic.ListView):
@@ -73,10 +159,10 @@ class OrderSummaryView(LoginRequiredMixin, generic.View):
 #     def get_queryset(self):
 #         return Order.objects.filter(user=self.request.user, ordered=False)
 
-class CheckoutView(generic.View):
+class CheckoutView(LoginRequiredMixin, generic.View):
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.for_cart().get(user=self.request.user, ordered=False)
             form = CheckOutForm
             if order.billing_address:
                 return redirect('mysite:payment', payment_option='stripe')
@@ -130,7 +216,7 @@ class CheckoutView(generic.View):
                     order.shipping_address = shipping_address_qs[len(shipping_address_qs)-1]
                     order.save()
                 else:
-                    print('User is entering a new shipping addresss')
+                    logger.debug('User %s is entering a new shipping address', self.request.user.pk)
                     shipping_address_1 = form.cleaned_data.get('shipping_address_1') 
                     shipping_address_2 = form.cleaned_data.get('shipping_address_2')
                     shipping_country = form.cleaned_data.get('shipping_country')
@@ -177,7 +263,7 @@ class CheckoutView(generic.View):
                     order.billing_address = billing_address_qs[len(billing_address_qs)-1]
                     order.save()
                 else:
-                    print('User is entering a new billing addresss')
+                    logger.debug('User %s is entering a new billing address', self.request.user.pk)
                     billing_address_1 = form.cleaned_data.get('billing_address_1') 
                     billing_address_2 = form.cleaned_data.get('billing_address_2')
                     billing_country = form.cleaned_data.get('billing_country')
@@ -227,35 +313,44 @@ class CheckoutView(generic.View):
                 return False
         return True
         
-class PaymentView(generic.View):
-    def get(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        if not order.billing_address:
+class PaymentView(AsyncLoginRequiredMixin, generic.View):
+    async def get(self, request, *args, **kwargs):
+        order = await Order.objects.for_cart().aget(user=request.user, ordered=False)
+        if order.status == PENDING:
+            messages.info(request, 'Your payment is being processed.')
+            return redirect('mysite:home')
+        if order.status == FAILED:
+            messages.warning(request, 'Your last payment did not go through and you were not charged. Please try again.')
+        if not order.billing_address_id:
             return redirect('mysite:checkout')
         context = {
             'order': order,
             'STRIPE_PUBLIC_KEY': settings.STRIPE_PUBLIC_KEY,
             'show_promo_code_section': False,
+            'cart_summary': await aget_cart_summary(request.user),
         }
-        userprofile = self.request.user.userprofile
+        userprofile = await UserProfile.objects.aget(user=request.user)
         if userprofile.one_click_purchasing:
-            cards = stripe.Customer.list_sources(
-                userprofile.stripe_customer_id,
-                limit=3,
-                object='card'
-            )
-            # print(cards)
-            card_list = cards['data']
+            try:
+                card_list = await run_in_gateway_pool(
+                    get_gateway().list_cards, userprofile.stripe_customer_id, limit=3
+                )
+            except stripe.error.StripeError:
+                # Without the saved cards the customer can still pay with a new one.
+                card_list = []
             if len(card_list) > 0:
                 context.update({
                     'card': card_list[0] if len(card_list) == 1 else card_list[1]
                 })
-        return render(self.request, 'shopping/payment.html', context)
+        return render(request, 'shopping/payment.html', context)
 
-    def post(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
+    async def post(self, request, *args, **kwargs):
+        # initiate_payment() needs a transaction, which async code cannot hold.
+        return await sync_to_async(self.submit_payment)()
+
+    def submit_payment(self):
+        order = Order.objects.with_totals().get(user=self.request.user, ordered=False)
         # token = self.request.POST.get('stripeToken')
-        userprofile = UserProfile.objects.get(user=self.request.user)
         form = PaymentForm(self.request.POST)
 
         if form.is_valid():
@@ -264,116 +359,72 @@ class PaymentView(generic.View):
             save = form.cleaned_data.get('save')
             user_default = form.cleaned_data.get('use_default')
 
-            if save:
-                if userprofile.stripe_customer_id != '' and userprofile.stripe_customer_id is not None:
-                    # customer = stripe.Customer.retrieve(userprofile.stripe_customer_id)
-                    # customer.sources.create(source=token)
-                    customer = stripe.Customer.create_source(
-                        userprofile.stripe_customer_id,
-                        source=token
-                    )
-                else:
-                    # customer = stripe.Customer.create(email=self.request.user.email)
-                    # customer.sources.create(source=token)
-                    customer = stripe.Customer.create(
-                        email=self.request.user.email,
-                        source=token
-                    )
-                    userprofile.stripe_customer_id = customer['id']
-                    userprofile.one_click_purchasing = True
-                    userprofile.save()
-
-            amount = int(order.calculate_order_total() * 100)
-
             try:
-                if user_default or save:
-                    charge = stripe.Charge.create(
-                        amount = amount,
-                        currency = 'usd',
-                        customer = userprofile.stripe_customer_id
-                    )
-                else:
-                    charge = stripe.Charge.create(
-                        amount = amount,
-                        currency = 'usd',
-                        source = token
-                    )
-
-                payment = Payment()
-                payment.user = self.request.user
-                payment.stripe_charge_id = charge['id']
-                payment.amount = order.calculate_order_total()
-                payment.save()
-
-                order_items = order.items.all()
-                order_items.update(ordered=True)
-                for item in order_items:
-                    item.save()
-
-                order.ordered = True
-                order.payment = payment
-                order.refrence_key = create_refrence_key()
-                order.save()
-
-                send_mail(
-                    subject='Yo!',
-                    message=f'Purchased successfully. Your refrence code for the order is {order.refrence_key}. Please use that key to refund your order.',
-                    from_email='admin-luffy@hello.com',
-                    recipient_list=[self.request.user.email]
-                )
-
-                messages.success(self.request, "Your order was successful and please check your email for the detail")
+                payment = initiate_payment(order, self.request.user)
+            except OutOfStock as e:
+                messages.warning(self.request, f'Sorry, there is not enough stock left of: {e}')
+                return redirect('mysite:order-summary')
+            except CouponUnavailable:
+                Order.objects.filter(pk=order.pk, status__in=(CART, FAILED)).update(coupon=None)
+                messages.warning(self.request, 'Your coupon can no longer be used and was removed from your order.')
+                return redirect('mysite:order-summary')
+            if payment is None:
+                messages.info(self.request, 'Your payment is already being processed.')
                 return redirect('mysite:home')
-            
-            except stripe.error.CardError as e:
-                body = e.json_body
-                err = body.get('error', {})
-                messages.error(self.request, f"{err.get('message')}")
-            except stripe.error.RateLimitError as e:
-                # Too many requests made to the API too quickly
-                messages.success(self.request, "Rate limit error")
-                return redirect("/")
-            except stripe.error.InvalidRequestError as e:
-                # Invalid parameters were supplied to Stripe's API
-                messages.success(self.request, "Invalid parameters")
-                return redirect("/")
-            except stripe.error.AuthenticationError as e:
-                # Authentication with Stripe's API failed
-                # (maybe you changed API keys recently)
-                messages.success(self.request, "Not authenticated")
-                return redirect("/")
-            except stripe.error.APIConnectionError as e:
-                # Network communication with Stripe failed
-                messages.success(self.request, "Newtwork error")
-                return redirect("/")
-            except stripe.error.StripeError as e:
-                # Display a very generic error to the user, and maybe send
-                # yourself an email
-                messages.success(
-                    self.request, "Something went wrong. You were not charged. Please try again")
-                return redirect("/")
-            except Exception as e:
-                # Something else happened, completely unrelated to Stripe
-                messages.success(
-                    self.request, "A serious error occured. We have been notified.")
-                return redirect("/")
+
+            # Stripe is called by the checkout worker once the pending payment
+            # is committed, so this request never waits on it.
+            transaction.on_commit(lambda: schedule_payment(payment.pk, token, save, user_default))
+            messages.success(self.request, "Your payment is being processed. We will email you as soon as your order is confirmed.")
+            return redirect('mysite:home')
 
         messages.warning(self.request, 'Invalid data received')
         return redirect('mysite:payment', payment_option='stripe')
 
+@csrf_exempt
+@require_POST
+def stripeWebhook(request):
+    # Without a secret, construct_event would accept events signed with an
+    # empty key, i.e. anyone could mark an order paid.
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        logger.error('Stripe webhook called but STRIPE_WEBHOOK_SECRET is not set')
+        return HttpResponse(status=400)
+    try:
+        event = stripe.Webhook.construct_event(
+            request.body,
+            request.META.get('HTTP_STRIPE_SIGNATURE', ''),
+            settings.STRIPE_WEBHOOK_SECRET
+        )
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return HttpResponse(status=400)
+    handle_stripe_event(event)
+    return HttpResponse(status=200)
+
+def metrics(request):
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (request.user.is_staff or (token and constant_time_compare(authorization, f'Bearer {token}'))):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 class AddCounponView(generic.View):
     def post(self, *args, **kwargs):
         form = CouponForm(self.request.POST or None)
         if form.is_valid():
             try:
                 order = Order.objects.get(user=self.request.user, ordered=False)
-                coupon = self.get_coupon(form.cleaned_data['coupon_code'])
-                if coupon: 
-                    order.coupon = coupon 
-                else:
+                coupon = find_coupon(form.cleaned_data['coupon_code'])
+                if coupon is None:
                     messages.info(self.request, 'Invalid Coupon Code')
                     return redirect('mysite:checkout')
-                order.save()
+                reason = coupon.unavailable_reason()
+                if reason:
+                    messages.info(self.request, reason)
+                    return redirect('mysite:checkout')
+                # Not order.save(), which could undo a checkout's status change.
+                if not Order.objects.filter(pk=order.pk, status__in=(CART, FAILED)).update(coupon=coupon):
+                    messages.info(self.request, 'Your payment is already being processed.')
+                    return redirect('mysite:home')
                 messages.info(self.request, 'Successfully added cupon code')
                 return redirect('mysite:payment', payment_option='stripe')
             except ObjectDoesNotExist:
@@ -381,13 +432,6 @@ class AddCounponView(generic.View):
                 return redirect('mysite:order-summary')
         
         return None
-    
-    def get_coupon(self, input_coupon):
-        try:
-            coupon = Coupon.objects.get(code=input_coupon)
-            return coupon
-        except ObjectDoesNotExist:
-            return None
 
 class CreateRefundView(generic.View):
     def get(self, *args, **kwargs):
@@ -420,148 +464,82 @@ class CreateRefundView(generic.View):
                 return redirect('mysite:refund')
 
 
-@login_required
-def addItemToCart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    ordered_item, created = OrderItem.objects.get_or_create(
-        user = request.user,
-        item = item,
-        ordered = False
-    )
-    order_qs = Order.objects.filter(user = request.user, ordered = False)
-    # print(order_qs)
-
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            ordered_item.quantity += 1
-            ordered_item.save()
-            messages.info(request, f'The quantity of {item.title} is updated.')
-        else:
-            order.items.add(ordered_item)
-            messages.info(request, f'{item.title} is addded to your cart.')
+async def update_cart(request, operation, slug):
+    # Cart writes run as one sync unit in a thread: they are transactional
+    # and the async ORM cannot hold a transaction open.
+    await resolve_user(request)
+    cart = get_cart(request)
+    return await sync_to_async(getattr(cart, operation))(slug)
+
+@invalidates_cart_summary
+async def addItemToCart(request, slug):
+    item, status = await update_cart(request, 'add', slug)
+    if status == CartService.LOCKED:
+        messages.info(request, 'Your payment is being processed, so your cart cannot be changed right now.')
         return redirect('mysite:product', slug=slug)
-    else:
-        order = Order.objects.create(
-            user = request.user, 
-            ordered_date = timezone.now(), 
-            ordered = False
-        )
-        order.items.add(ordered_item)
+    if status == CartService.UPDATED:
+        messages.info(request, f'The quantity of {item.title} is updated.')
+    elif status == CartService.ADDED:
         messages.info(request, f'{item.title} is addded to your cart.')
-        return redirect('mysite:product', slug=slug)
-
-@login_required    
-def removeItemFromCart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    ordered_item, created = OrderItem.objects.get_or_create(
-        user = request.user,
-        item = item,
-        ordered = False
-    )
-    order_qs = Order.objects.filter(user = request.user, ordered = False)
-
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            ordered_item.delete()
-            messages.info(request, f'{item.title} is removed from your cart.')
-            if not order.items.count():
-                order.delete()
-                messages.info(request, 'You have no active order.')    
-            return redirect('mysite:product', slug=slug)
-        else:
-            messages.info(request, f'{item.title} is not from your cart.')
-            return redirect('mysite:product', slug=slug)
     else:
-        messages.info(request, "You do not have an active order.")
+        messages.warning(request, 'Your cart is full.')
+    return redirect('mysite:product', slug=slug)
+
+@invalidates_cart_summary
+async def removeItemFromCart(request, slug):
+    item, status = await update_cart(request, 'remove', slug)
+    if status == CartService.LOCKED:
+        messages.info(request, 'Your payment is being processed, so your cart cannot be changed right now.')
         return redirect('mysite:product', slug=slug)
+    if status == CartService.NO_ORDER:
+        messages.info(request, "You do not have an active order.")
+    elif status == CartService.NOT_IN_CART:
+        messages.info(request, f'{item.title} is not from your cart.')
+    else:
+        messages.info(request, f'{item.title} is removed from your cart.')
+        if status == CartService.EMPTIED:
+            messages.info(request, 'You have no active order.')
+    return redirect('mysite:product', slug=slug)
     
-@login_required
-def increaseQuantity(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    ordered_item, created = OrderItem.objects.get_or_create(
-        user = request.user,
-        item = item,
-        ordered = False
-    )
-    order_qs = Order.objects.filter(user = request.user, ordered = False)
-    # print(order_qs)
-
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            ordered_item.quantity += 1
-            ordered_item.save()
-            messages.info(request, f'The quantity of {item.title} is updated.')
-        else:
-            order.items.add(ordered_item)
-            messages.info(request, f'{item.title} is addded to your cart.')
+@invalidates_cart_summary
+async def increaseQuantity(request, slug):
+    item, status = await update_cart(request, 'add', slug)
+    if status == CartService.LOCKED:
+        messages.info(request, 'Your payment is being processed, so your cart cannot be changed right now.')
         return redirect('mysite:order-summary')
-    else:
-        order = Order.objects.create(
-            user = request.user, 
-            ordered_date = timezone.now(), 
-            ordered = False
-        )
-        order.items.add(ordered_item)
+    if status == CartService.UPDATED:
+        messages.info(request, f'The quantity of {item.title} is updated.')
+    elif status == CartService.ADDED:
         messages.info(request, f'{item.title} is addded to your cart.')
-        return redirect('mysite:order-summary')
-
-@login_required
-def decreaseQuantity(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    ordered_item, created = OrderItem.objects.get_or_create(
-        user = request.user,
-        item = item,
-        ordered = False
-    )
-    order_qs = Order.objects.filter(user = request.user, ordered = False)
-    # print(order_qs)
-
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            ordered_item.quantity -= 1
-            ordered_item.save()
-            if not ordered_item.quantity:
-                ordered_item.delete()
-                if not order.items.exists():
-                    order.delete()
-                return redirect('mysite:order-summary')
-            messages.info(request, f'The quantity of {item.title} is updated.')
-            return redirect('mysite:order-summary')
-        else:
-            messages.info(request, f'{item.title} is not from your cart.')
-            return redirect('mysite:order-summary')
     else:
-        messages.info(request, "You do not have an active order.")
+        messages.warning(request, 'Your cart is full.')
+    return redirect('mysite:order-summary')
+
+@invalidates_cart_summary
+async def decreaseQuantity(request, slug):
+    item, status = await update_cart(request, 'decrease', slug)
+    if status == CartService.LOCKED:
+        messages.info(request, 'Your payment is being processed, so your cart cannot be changed right now.')
         return redirect('mysite:order-summary')
+    if status == CartService.NO_ORDER:
+        messages.info(request, "You do not have an active order.")
+    elif status == CartService.NOT_IN_CART:
+        messages.info(request, f'{item.title} is not from your cart.')
+    elif status == CartService.UPDATED:
+        messages.info(request, f'The quantity of {item.title} is updated.')
+    return redirect('mysite:order-summary')
     
-@login_required    
-def removeItem(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    ordered_item, created = OrderItem.objects.get_or_create(
-        user = request.user,
-        item = item,
-        ordered = False
-    )
-    order_qs = Order.objects.filter(user = request.user, ordered = False)
-
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            ordered_item.delete()
-            messages.info(request, f'{item.title} is removed from your cart.')
-            if not order.items.exists():
-                order.delete()
-                # messages.info(request, 'You have no active order.')    
-                
-            return redirect('mysite:order-summary')
-        else:
-            messages.info(request, f'{item.title} is not from your cart.')
-            return redirect('mysite:product', slug=slug)
-    else:
+@invalidates_cart_summary
+async def removeItem(request, slug):
+    item, status = await update_cart(request, 'remove', slug)
+    if status == CartService.LOCKED:
+        messages.info(request, 'Your payment is being processed, so your cart cannot be changed right now.')
+        return redirect('mysite:order-summary')
+    if status == CartService.NO_ORDER:
         messages.info(request, "You do not have an active order.")
         return redirect('mysite:product', slug=slug)
-    
\ No newline at end of file
+    if status == CartService.NOT_IN_CART:
+        messages.info(request, f'{item.title} is not from your cart.')
+        return redirect('mysite:product', slug=slug)
+    messages.info(request, f'{item.title} is removed from your cart.')
+    return redirect('mysite:order-summary')